@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import random
+import tempfile
+from optparse import OptionParser
+from structures import NoteList, composition_from_melodies
+from rules import all_notes_line_up, voice_crossing, coincident_maxima, illegal_third_species_dissonances
+from species import third_species
+from equivalence import random_melodies
+from packing import exercise_rows
+from exporting import write_midi_file
+
+###
+# Benchmarks. Each one times a stage of the program on generated exercises
+# of growing size, and prints how long it took per note. The stages are all
+# meant to take time in proportion to the number of notes, so each is also
+# checked for it: the time per note at the largest size may be at most
+# max_growth times the time per note at the smallest. Fixed costs make the
+# smallest size the slowest per note, so this only fails when the time
+# really grows faster than the notes do.
+###
+
+max_growth = 2.0
+
+def best_time(fn, repeats=3):
+    """
+    Takes a function of no arguments and an (optional) number of times to
+    run it.
+
+    Returns the shortest time it took, in seconds.
+    """
+    times = []
+    for i in range(repeats):
+        started = time.time()
+        fn()
+        times.append(time.time() - started)
+    return min(times)
+
+def long_exercise(bars, species=1, voices=('Soprano', 'Bass'), seed=0):
+    """
+    Takes a number of bars, and an (optional) species, list of voice names
+    and random seed.
+
+    Returns a mingus.containers.Composition object of that many bars of
+    generated melodies (see equivalence.random_melodies()), with the lowest
+    voice as the cantus firmus.
+    """
+    melodies = random_melodies(random.Random(seed), species, list(voices), bars)
+    return composition_from_melodies(melodies)
+
+def onset_rules(size, repeats=3):
+    # the rules that match notes up by their onsets, on two voices of size
+    # whole notes each.
+    a_list, b_list = [NoteList(track) for track in long_exercise(size)]
+    times = []
+    for rule in [all_notes_line_up, voice_crossing, coincident_maxima]:
+        def run():
+            # views memoized by an earlier run would make this one free.
+            a_list.memo.clear()
+            b_list.memo.clear()
+            rule(a_list, b_list)
+        times.append((rule.__name__, best_time(run, repeats)))
+    return len(a_list), times
+
+def third_species_checks(size, repeats=3):
+    # the whole third species check, and its dissonance rule alone, on size
+    # bars of quarter notes against a cantus firmus.
+    composition = long_exercise(size, 3)
+    a_list, b_list = [NoteList(track) for track in composition]
+
+    def run():
+        a_list.memo.clear()
+        b_list.memo.clear()
+        illegal_third_species_dissonances(a_list, b_list)
+
+    return len(a_list), [
+        ('third_species', best_time(lambda: third_species(composition), repeats)),
+        ('illegal_third_species_dissonances', best_time(run, repeats)),
+    ]
+
+def midi_export(size, repeats=3):
+    # writing two voices of size whole notes each as a MIDI file: first
+    # reading the notes from the composition, then writing them out (see
+    # exporting.py).
+    composition = long_exercise(size)
+    rows = exercise_rows(composition)
+    handle, file_name = tempfile.mkstemp(suffix='.mid')
+    os.close(handle)
+    try:
+        times = [
+            ('exercise_rows', best_time(lambda: exercise_rows(composition), repeats)),
+            ('write_midi_file', best_time(lambda: write_midi_file(file_name, rows), repeats)),
+        ]
+    finally:
+        os.remove(file_name)
+    return len(rows[0][4]), times
+
+# name => (function, sizes). Each function takes a size and a number of
+# repeats, and returns a tuple of (int: notes per voice, list of (str: name,
+# float: seconds) tuples).
+benchmarks = {
+    'onsets': (onset_rules, [1250, 2500, 5000, 10000]),
+    'third-species': (third_species_checks, [250, 500, 1000, 2000]),
+    'midi': (midi_export, [1250, 2500, 5000, 10000]),
+}
+
+def run_benchmark(name, repeats=3, out=sys.stdout):
+    """
+    Takes the name of a benchmark, and an (optional) number of times to run
+    each stage and file to print to.
+
+    Prints the time each stage took at each size, and how much the time per
+    note grew from the smallest size to the largest.
+
+    Returns a list of the names of the stages that grew by more than
+    max_growth.
+    """
+    fn, sizes = benchmarks[name]
+    per_note = {}
+    print >> out, '%s:' % name
+    for size in sizes:
+        notes, times = fn(size, repeats)
+        for stage, seconds in times:
+            per_note.setdefault(stage, []).append((notes, seconds / notes))
+            print >> out, '  %-40s %6d notes %8.3fs %8.2f us/note' % (stage, notes, seconds, seconds / notes * 1e6)
+
+    too_slow = []
+    for stage in sorted(per_note):
+        (first_notes, first), (last_notes, last) = per_note[stage][0], per_note[stage][-1]
+        growth = last / first if first else 0.0
+        if growth > max_growth:
+            too_slow.append(stage)
+        print >> out, '  %s: %.2fx per note from %d to %d notes: %s' % (
+            stage, growth, first_notes, last_notes, 'TOO SLOW' if growth > max_growth else 'ok')
+    return too_slow
+
+def main():
+    parser = OptionParser(usage='%prog [options] [BENCHMARK ...]')
+    parser.add_option('-r', '--repeat', dest='repeats', help='Run each stage REPEATS times, and keep the fastest. Defaults to 3.', metavar='REPEATS', type='int', default=3)
+    parser.add_option('-l', '--list', action='store_true', dest='list', help='List the benchmarks, and exit.')
+
+    options, args = parser.parse_args()
+    if options.list:
+        for name in sorted(benchmarks):
+            print name
+        return
+    for name in args:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark "%s". Use the -l argument to list them.' % name)
+
+    too_slow = []
+    for name in args or sorted(benchmarks):
+        too_slow.extend(run_benchmark(name, options.repeats))
+    if too_slow:
+        print '%d stage(s) grew faster than the number of notes: %s' % (len(too_slow), ', '.join(too_slow))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from multiprocessing import Pool
+from structures import NoteList
+from rules import get_and_split_voices
+from errors import written_errors
+from species import first_species, second_species, third_species, fourth_species
+
+###
+# Analysing one long piece in chunks. The bars are split into chunks, and
+# each chunk is checked in a worker process along with a halo of bars either
+# side of it, so that every note in the chunk is seen with its neighbours.
+# Each error is kept only by the chunk that holds its first event, so errors
+# found in the overlapping halos aren't counted twice. The errors of each
+# rule and voice (or pair of voices) are put back together from the chunks,
+# so they come out in the same order as for the whole piece at once: the
+# local rules give them voice by voice, in order of time (see group_order()).
+#
+# Only rules that look at nearby notes can be checked this way. The others
+# look along whole runs, contours or the whole melody, and are checked once
+# on the whole piece, while the chunks are being checked.
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+
+# errors found by looking at a note, and at the notes next to it in each
+# voice. Suspensions are included, because the halo never splits a tied note.
+local_errors = frozenset([
+    'accidental_errors',
+    'alignment_errors',
+    'direct_motion_errors',
+    'horizontal_errors',
+    'strong_beat_dissonance_errors',
+    'strong_beat_horizontals',
+    'suspension_resolution_errors',
+    'unprepared_suspension_errors',
+    'vertical_interval_errors',
+    'voice_crossing_errors',
+    'weak_beat_dissonance_errors',
+    'weak_horizontal_errors',
+])
+
+def is_local(name):
+    return name in local_errors
+
+def is_global(name):
+    return name not in local_errors
+
+def error_position(error):
+    # (bar, beat) of the first event of an error in the standard format, or
+    # (-1, -1) if it has none, like the cantus firmus.
+    times = [(bar, beat) for voices, name, bar, beat in error[0] if bar is not None]
+    if not times:
+        return (-1, -1)
+    return min(times)
+
+def error_groups(error_dict):
+    """
+    Takes an error dict, as returned by one of the species functions.
+
+    Returns a list of (str: error name, key, list of errors in the standard
+    format) tuples, one for each voice or pair of voices (the key) that each
+    rule looked at, in the order standardize_errors() gives them.
+    """
+    groups = []
+    for name in error_dict:
+        if name in written_errors and callable(written_errors[name]):
+            for key in error_dict[name]:
+                groups.append((name, key, written_errors[name]({key: error_dict[name][key]})))
+    return groups
+
+def group_order(key):
+    # the order of the errors a local rule finds for a key: by the voice of
+    # their first event, if it is one of the key's two voices, then by time.
+    def order(error):
+        voice = error[0][0][0]
+        if type(key) is tuple and voice in key:
+            return (key.index(voice), error_position(error))
+        return (0, error_position(error))
+    return order
+
+def halo_start(a_list, bar, halo):
+    """
+    Takes a NoteList, the first bar of a chunk and the number of bars in
+    its halo.
+
+    Returns the first bar of the halo in this voice: far enough back to take
+    in halo bars with notes in them, and never part way through a tied note.
+    """
+    bars_seen = set()
+    for i in xrange(bisect_left(a_list.starts, (bar, 0)) - 1, -1, -1):
+        note = a_list[i]
+        if note.is_rest:
+            continue
+        bars_seen.add(note.bar)
+        if len(bars_seen) >= halo and not note.is_tied:
+            return note.bar
+    return 0
+
+def halo_end(a_list, bar, halo):
+    """
+    Takes a NoteList, the bar after the end of a chunk and the number of bars
+    in its halo.
+
+    Returns the bar after the end of the halo in this voice (see
+    halo_start()), or None for the end of the piece.
+    """
+    bars_seen = set()
+    for i in xrange(bisect_left(a_list.starts, (bar, 0)), len(a_list)):
+        note = a_list[i]
+        if note.is_rest:
+            continue
+        bars_seen.add(note.bar)
+        if len(bars_seen) >= halo and note.tie_run[-1] is note:
+            return note.bar + 1
+    return None
+
+def chunk_windows(n, chunk_bars=16, halo=2):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList), the
+    number of bars in each chunk, and the number of bars with notes that
+    each voice should have either side of a chunk.
+
+    Returns a list of (first bar, end bar, first bar read, end bar read)
+    tuples, one for each chunk. End bars are not included, and an end bar
+    read of None means to the end of the piece.
+    """
+    bar_count = max([len(a_list.track.bars) for a_list in n.values()])
+    windows = []
+    for start in range(0, bar_count, chunk_bars):
+        end = min(start + chunk_bars, bar_count)
+        read_start = min([halo_start(n[voice], start, halo) for voice in n])
+        read_ends = [halo_end(n[voice], end, halo) for voice in n]
+        if None in read_ends:
+            read_end = None
+        else:
+            read_end = max(read_ends)
+        windows.append((start, end, read_start, read_end))
+    return windows
+
+# the piece each worker process checks chunks of, set by start_worker().
+worker = {}
+
+def start_worker(composition, species, rulebook):
+    worker['arguments'] = (composition, species, rulebook)
+
+def check_chunk(window):
+    composition, species, rulebook = worker['arguments']
+    return window_error_groups(composition, window, species, rulebook)
+
+def window_error_groups(composition, window, species=1, rulebook=None):
+    """
+    Takes a mingus.containers.Composition object, a tuple of (first bar,
+    end bar, first bar read, end bar read), as returned by chunk_windows(),
+    and an (optional) species and rulebook.
+
+    Returns the local errors whose first event is in the chunk, grouped by
+    rule and voice (see error_groups()).
+    """
+    start, end, read_start, read_end = window
+    n = {}
+    for track in composition:
+        n[track.name] = NoteList(track, read_start, read_end)
+
+    error_dict = rulesets[species-1](n, rulebook=rulebook, only=is_local)
+    return [
+        (name, key, [error for error in errors if start <= error_position(error)[0] < end])
+        for name, key, errors in error_groups(error_dict) if is_local(name)
+    ]
+
+def check_window(composition, window, species=1, rulebook=None):
+    """
+    Takes a mingus.containers.Composition object, a tuple of (first bar,
+    end bar, first bar read, end bar read), as returned by chunk_windows(),
+    and an (optional) species and rulebook.
+
+    Returns a list of the local errors in the standard format (see
+    errors.py) whose first event is in the chunk.
+    """
+    errors = []
+    for name, key, group in window_error_groups(composition, window, species, rulebook):
+        errors.extend(group)
+    return errors
+
+def check_in_chunks(composition, species=1, chunk_bars=16, halo=2, processes=None, rulebook=None):
+    """
+    Takes a mingus.containers.Composition object, and an (optional) species,
+    number of bars in each chunk, number of bars in each halo, number of
+    worker processes and rulebook (see rulebook.py).
+
+    Returns a list of errors in the standard format (see errors.py), the
+    same errors, in the same order, that standardize_errors() gives for a
+    whole run of the species function.
+
+    The halo must be large enough for the local rules to see the notes they
+    look at either side of each note: two bars is enough for every species.
+    """
+    n = get_and_split_voices(composition)[0]
+    windows = chunk_windows(n, chunk_bars, halo)
+
+    if processes is not None and processes > 1:
+        pool = Pool(processes, start_worker, (composition, species, rulebook))
+        chunk_results = pool.map_async(check_chunk, windows)
+    else:
+        start_worker(composition, species, rulebook)
+        chunk_results = None
+
+    # the other rules are checked on the whole piece, meanwhile.
+    try:
+        error_dict = rulesets[species-1](n, rulebook=rulebook, only=is_global)
+        chunk_keys = {} # error name => keys, in the order the rule took them
+        chunk_errors = {} # (error name, key) => errors from every chunk
+        if error_dict.get('cantus_firmus', True) is not None:
+            if chunk_results is None:
+                chunk_results = [check_chunk(window) for window in windows]
+            else:
+                chunk_results = chunk_results.get()
+            for groups in chunk_results:
+                for name, key, errors in groups:
+                    if (name, key) not in chunk_errors:
+                        chunk_keys.setdefault(name, []).append(key)
+                        chunk_errors[(name, key)] = []
+                    chunk_errors[(name, key)].extend(errors)
+    finally:
+        if processes is not None and processes > 1:
+            pool.close()
+            pool.join()
+
+    # the local rules are left empty in error_dict, but still in their
+    # places (see species.evaluate_rules()), so their errors go there.
+    errors = []
+    for name in error_dict:
+        if is_local(name):
+            for key in chunk_keys.get(name, []):
+                errors.extend(sorted(chunk_errors[(name, key)], key=group_order(key)))
+        elif name in written_errors and callable(written_errors[name]):
+            errors.extend(written_errors[name](error_dict[name]))
+    return errors
@@ -0,0 +1,266 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+from multiprocessing import Pool
+from optparse import OptionParser
+from errors import standardize_errors, written_rules
+from species import first_species, second_species, third_species, fourth_species
+from counterpoint import setup_midi
+from packing import load_corpus, unpack_exercise
+
+###
+# Corpus statistics. Each file is analysed in a worker process, which only
+# sends back a small table of counts. The tables are merged as they arrive,
+# and can be saved and merged again later, so a run can be resumed or split
+# across machines.
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+
+# count tables, each of the form: rule name => (str: key => int: count)
+tables = ['voices', 'bars', 'beats', 'intervals']
+
+def empty_stats():
+    """
+    Returns an empty statistics dict:
+    {
+        'files': list of files analysed,
+        'failed': dict of file name => reason it could not be analysed,
+        'rules': dict of rule name => number of errors,
+        'voices', 'bars', 'beats', 'intervals':
+            dicts of rule name => (key => number of errors)
+    }
+    """
+    stats = dict(files=[], failed={}, rules={})
+    for table in tables:
+        stats[table] = {}
+    return stats
+
+def count(table, rule, key, n=1):
+    rule_table = table.setdefault(rule, {})
+    rule_table[key] = rule_table.get(key, 0) + n
+
+def error_stats(errors):
+    """
+    Takes a list of errors in the standard format (see errors.py).
+
+    Returns a statistics dict (see empty_stats()) counting them:
+        voices: the voice, or pair of voices ('Soprano-Alto') of each error
+        bars: the 0 offset bar number of each event
+        beats: the position of each event within its bar
+        intervals: the interval named by each event between two voices,
+            other than against a rest
+    """
+    stats = empty_stats()
+    for error in errors:
+        events, rule = error[0], error[-1]
+        stats['rules'][rule] = stats['rules'].get(rule, 0) + 1
+
+        voice_keys = []
+        for voices, name, bar, beat in events:
+            if type(voices) is tuple:
+                voice_key = '-'.join(voices)
+                if name != ' ':
+                    # ' ' is a voice against a rest, not an interval.
+                    count(stats['intervals'], rule, name)
+            else:
+                voice_key = voices
+            if voice_key not in voice_keys:
+                voice_keys.append(voice_key)
+            if bar is not None:
+                count(stats['bars'], rule, str(bar))
+                count(stats['beats'], rule, '%.2f' % beat)
+        for voice_key in voice_keys:
+            count(stats['voices'], rule, voice_key)
+    return stats
+
+def add_stats(stats, other):
+    """
+    Takes two statistics dicts (see empty_stats()).
+
+    Adds the counts of the second to the first, in place, and returns the
+    first. The second isn't modified. This takes time in proportion to the
+    size of the second only, so results can be added one at a time to a
+    running total.
+    """
+    for f in other['files']:
+        if f not in stats['failed']:
+            stats['files'].append(f)
+    stats['failed'].update(other['failed'])
+    for rule, n in other['rules'].items():
+        stats['rules'][rule] = stats['rules'].get(rule, 0) + n
+    for table in tables:
+        for rule, keys in other[table].items():
+            for key, n in keys.items():
+                count(stats[table], rule, key, n)
+    return stats
+
+def merge_stats(a, b):
+    """
+    Takes two statistics dicts (see empty_stats()).
+
+    Returns a new statistics dict with the counts of both added together.
+    Neither argument is modified.
+    """
+    return add_stats(add_stats(empty_stats(), a), b)
+
+def analyse_composition(name, composition, species):
+    # the statistics for one exercise, or the reason it couldn't be analysed.
+    stats = empty_stats()
+    try:
+        error_dict = rulesets[species-1](composition)
+        if 'cantus_firmus' in error_dict and error_dict['cantus_firmus'] is None:
+            stats['failed'][name] = 'No cantus firmus found.'
+            return stats
+        stats = error_stats(standardize_errors(error_dict))
+    except Exception, e:
+        stats['failed'][name] = '%s: %s' % (type(e).__name__, e)
+        return stats
+    stats['files'].append(name)
+    return stats
+
+def analyse_file(args):
+    """
+    Takes a tuple of (str: MIDI file name, int: species).
+
+    Returns a statistics dict (see empty_stats()) for the one file.
+    Runs in a worker process, so only counts are sent back.
+    """
+    midi_file, species = args
+    try:
+        composition, errors = setup_midi(midi_file)
+    except Exception, e:
+        errors = ['%s: %s' % (type(e).__name__, e)]
+    if errors:
+        stats = empty_stats()
+        stats['failed'][midi_file] = '; '.join(errors)
+        return stats
+    return analyse_composition(midi_file, composition, species)
+
+# the packed corpus each worker process reads from, set by attach_corpus().
+packed_corpus = {}
+
+def attach_corpus(corpus):
+    packed_corpus.clear()
+    packed_corpus.update(corpus)
+
+def analyse_packed_exercise(args):
+    """
+    Takes a tuple of (int: index of an exercise in the packed corpus,
+    int: species).
+
+    Returns a statistics dict (see empty_stats()) for the one exercise.
+    Runs in a worker process, which reads the exercise from the packed
+    corpus it shares with the others (see packing.py).
+    """
+    i, species = args
+    name = packed_corpus['names'][i]
+    try:
+        composition = unpack_exercise(packed_corpus, i)
+    except Exception, e:
+        stats = empty_stats()
+        stats['failed'][name] = '%s: %s' % (type(e).__name__, e)
+        return stats
+    return analyse_composition(name, composition, species)
+
+def analyse_corpus(midi_files, species=1, jobs=None, stats=None, output=None, save_every=50, packed=None):
+    """
+    Takes a list of MIDI file names, an (optional) species, an (optional)
+    number of worker processes, (optional) statistics to resume from, an
+    (optional) file to save the statistics to every save_every files, and
+    an (optional) packed corpus (see packing.py).
+
+    Returns a statistics dict (see empty_stats()) for the whole corpus: the
+    one given, with the new counts added to it, or a new one. Files already
+    counted in stats are skipped. With a packed corpus, its
+    exercises are analysed instead of midi_files, and the workers read
+    them from memory they share, rather than each reading its own files.
+    """
+    if stats is None:
+        stats = empty_stats()
+    done = set(stats['files']) | set(stats['failed'])
+
+    if packed is None:
+        todo = [(f, species) for f in midi_files if f not in done]
+        analyse, initializer, initargs = analyse_file, None, ()
+    else:
+        todo = [(i, species) for i, name in enumerate(packed['names']) if name not in done]
+        analyse, initializer, initargs = analyse_packed_exercise, attach_corpus, (packed,)
+        packed_failures = empty_stats()
+        packed_failures['failed'] = dict(packed['failed'])
+        add_stats(stats, packed_failures)
+
+    if jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = (analyse(x) for x in todo)
+    else:
+        pool = Pool(jobs, initializer, initargs)
+        results = pool.imap_unordered(analyse, todo)
+
+    for i, result in enumerate(results):
+        add_stats(stats, result)
+        if output and (i + 1) % save_every == 0:
+            save_stats(stats, output)
+
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    return stats
+
+def load_stats(file_name):
+    f = open(file_name)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def save_stats(stats, file_name):
+    f = open(file_name, 'w')
+    try:
+        json.dump(stats, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+def print_report(stats, out=sys.stdout):
+    print >> out, '%d file(s) analysed, %d failed.' % (len(stats['files']), len(stats['failed']))
+    print >> out, ''
+    rules = sorted(stats['rules'].items(), key=lambda x: (-x[1], x[0]))
+    for rule, n in rules:
+        print >> out, '%6d  %s' % (n, rule)
+        if rule in written_rules:
+            print >> out, '        %s' % written_rules[rule]
+        for table in tables:
+            keys = sorted(stats[table].get(rule, {}).items(), key=lambda x: (-x[1], x[0]))
+            if keys:
+                print >> out, '        %s: %s' % (table, ', '.join(['%s (%d)' % k for k in keys[:8]]))
+        print >> out, ''
+
+def main():
+    parser = OptionParser(usage='%prog [options] MIDI_FILE [MIDI_FILE ...]')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4.', metavar='SPECIES', type='int', default=1)
+    parser.add_option('-j', '--jobs', dest='jobs', help='Analyse files in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+    parser.add_option('-o', '--output', dest='output', help='Save the statistics to STATS_FILE as the run goes, to be resumed or merged later.', metavar='STATS_FILE')
+    parser.add_option('-p', '--packed', dest='packed', help='Analyse the exercises in PACKED_FILE, made with packing.py, as well as any MIDI files.', metavar='PACKED_FILE')
+    parser.add_option('-m', '--merge', dest='merge', action='append', default=[], help='Start from the statistics in STATS_FILE. Files already counted there are skipped. May be given more than once.', metavar='STATS_FILE')
+
+    options, args = parser.parse_args()
+    if not args and not options.merge and not options.packed:
+        parser.error('No MIDI files, packed corpus or statistics provided. Use the -h argument to display help.')
+
+    stats = empty_stats()
+    for file_name in options.merge:
+        add_stats(stats, load_stats(file_name))
+
+    if options.packed:
+        stats = analyse_corpus([], options.species, options.jobs, stats, options.output, packed=load_corpus(options.packed))
+    stats = analyse_corpus(args, options.species, options.jobs, stats, options.output)
+
+    if options.output:
+        save_stats(stats, options.output)
+    print_report(stats)
+
+if __name__ == "__main__":
+    main()
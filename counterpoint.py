@@ -4,12 +4,19 @@
 from mingus.midi.MidiFileIn import MIDI_to_Composition
 from mingus.midi.MidiFileOut import write_Composition
 from mingus.containers import Note, NoteContainer, Bar, Composition, Instrument, Track
-from mingus.extra.LilyPond import from_Composition, to_png, to_pdf
-from structures import Soprano, Alto, Tenor, Bass, NoteNode, NoteList, create_note_lists
+from rendering import lilypond_string, error_lilypond_string, render_png
+from structures import Soprano, Alto, Tenor, Bass, NoteNode, NoteList, create_note_lists, composition_from_melodies
 from rules import *
 from errors import *
-from species import first_species, second_species, third_species, fourth_species
+from species import first_species, second_species, third_species, fourth_species, evaluate_rulebooks
+from rulebook import default_rulebook, load_rulebook
+from chunking import check_in_chunks
+from grouping import check_in_groups, use_groups
+from exporting import write_composition
+from screening import screen_composition
+import os
 import sys
+import time
 from optparse import OptionParser
 
 ###
@@ -20,25 +27,16 @@ from optparse import OptionParser
 
 def setup_tracks(midi_file_out=None):
     from tracks import melodies, cantus_firmus, key, meter, species, author
-    # Create a composition, and add the vocal tracks to it.
-    composition = Composition()
-    composition.set_title('Counterpoint Exercise', '')
-    composition.set_author(author, '')
-
     # Set up our vocal 'tracks' with the notes, key, meter defined in tracks.py
-    tracks = {}
-    for voice in [Soprano, Alto, Tenor, Bass]:
-        if len(melodies[voice.name]):
-            tracks[voice.name] = Track(instrument=voice())
-            tracks[voice.name].add_bar(Bar(key=key, meter=meter))
-            tracks[voice.name].name = voice.name
-            for note in melodies[voice.name]:
-                tracks[voice.name].add_notes(*note)
-            composition.add_track(tracks[voice.name])
+    try:
+        composition = composition_from_melodies(melodies, key, meter, author)
+    except ValueError, e:
+        return None, [str(e)], species
 
     if midi_file_out is not None:
         # Save the midi file!
-        write_Composition(midi_file_out, composition, verbose=True)
+        size = write_composition(midi_file_out, composition)
+        print 'Written %d bytes to %s.' % (size, midi_file_out)
 
     return composition, [], species
 
@@ -56,30 +54,176 @@ def setup_midi(midi_file_in):
                     track.instrument = voice
     return composition, errors
 
+def write_typeset_music(composition, options):
+    if not (options.png_file or options.lilypond_file):
+        return
+
+    # Generate the Lilypond string once, for both outputs.
+    string = lilypond_string(composition)
+
+    if options.png_file:
+        # Save the PNG
+        render_png(string, options.png_file, cache_dir=options.render_cache)
+
+    if options.lilypond_file:
+        # save the Lilypond file
+        lf = open(options.lilypond_file, 'w')
+        lf.write(string)
+        lf.close()
+
+def write_error_music(composition, errors, options):
+    if not (options.error_png_file or options.error_lilypond_file):
+        return
+    if not errors:
+        # there are no bars to show, only empty staves.
+        print >> sys.stderr, '%s: NO ERRORS FOUND. NOT WRITING %s.' % (
+            sys.argv[0], ' OR '.join([f for f in [options.error_png_file, options.error_lilypond_file] if f])
+        )
+        return
+
+    # Typeset only the bars around each error.
+    string = error_lilypond_string(composition, errors, options.context)
+
+    if options.error_png_file:
+        render_png(string, options.error_png_file, cache_dir=options.render_cache)
+
+    if options.error_lilypond_file:
+        lf = open(options.error_lilypond_file, 'w')
+        lf.write(string)
+        lf.close()
+
+def check_composition(composition, species, options, cache=None):
+    # Compute any errors, once for each rulebook.
+    rulesets = [first_species, second_species, third_species, fourth_species]
+    if options.chunk_bars or (cache is None and use_groups(composition, options.jobs)):
+        # long pieces are checked a few bars at a time, and large ones a
+        # voice or pair of voices at a time, in JOBS processes. --watch
+        # re-checks from its cache instead.
+        error_dicts = [None for rulebook in options.rulebooks]
+    else:
+        error_dicts = evaluate_rulebooks(
+            rulesets[species-1], composition, options.rulebooks,
+            max_errors=options.max_errors, cache=cache
+        )
+
+    all_errors = []
+    budget_exceeded = False
+    for rulebook, error_dict in zip(options.rulebooks, error_dicts):
+        if len(options.rulebooks) > 1:
+            print '-' * 20, 'Rulebook:', rulebook['name'], '-' * 20
+            print ""
+
+        if error_dict is None:
+            if options.chunk_bars:
+                errors = check_in_chunks(composition, species, options.chunk_bars, options.halo, options.jobs, rulebook)
+            else:
+                errors = check_in_groups(composition, species, options.jobs, rulebook)
+            error_dict = dict(budget_exceeded=options.max_errors is not None and len(errors) > options.max_errors)
+        else:
+            # Convert the errors dict to a standard format
+            errors = standardize_errors(error_dict)
+
+        # Print out the standardized errors, and their corresponding rules.
+        for error in errors:
+            print get_error_text(error)
+            rule = error[-1]
+            if rule in written_rules:
+                print "Rule:", written_rules[rule]
+            print ""
+
+        all_errors.extend([error for error in errors if error not in all_errors])
+        budget_exceeded = budget_exceeded or error_dict.get('budget_exceeded')
+
+    return all_errors, budget_exceeded
+
+def watch(composition, species, options):
+    # Re-check the music every time its input file is saved. Rule results
+    # are cached by voice, so only voices whose notes changed are checked
+    # again.
+    if options.from_tracks:
+        import tracks
+        watched = os.path.splitext(tracks.__file__)[0] + '.py'
+        # tracks.pyc would be rewritten with a one second resolution
+        # timestamp, and could be reused after a quick second save.
+        sys.dont_write_bytecode = True
+    else:
+        watched = options.input_midi_file
+
+    cache = {}
+    read_errors = []
+    last_modified = None
+    while True:
+        try:
+            modified = os.stat(watched).st_mtime
+        except OSError:
+            modified = None
+
+        if modified is not None and modified != last_modified:
+            last_modified = modified
+            started = time.time()
+            try:
+                if composition is None:
+                    if options.from_tracks:
+                        reload(sys.modules['tracks'])
+                        composition, read_errors, species = setup_tracks()
+                    else:
+                        composition, read_errors = setup_midi(watched)
+                if read_errors:
+                    print >> sys.stderr, '%s: ERROR(S) ENCOUNTERED WHEN READING MUSIC:' % sys.argv[0]
+                    print >> sys.stderr, '\n'.join(read_errors)
+                else:
+                    print '=' * 20, time.strftime('%H:%M:%S'), watched, '=' * 20
+                    print ""
+                    errors, budget_exceeded = check_composition(composition, species, options, cache)
+                    if budget_exceeded:
+                        print >> sys.stderr, '%s: MORE THAN %d ERROR(S) FOUND. STOPPED CHECKING.' % (sys.argv[0], options.max_errors)
+                    print '%d error(s) found in %d ms.' % (len(errors), (time.time() - started) * 1000)
+                    print ""
+                    sys.stdout.flush()
+                    write_error_music(composition, errors, options)
+                    write_typeset_music(composition, options)
+            except Exception, e:
+                # the file may be half written, or mid-edit. Wait for the next save.
+                print >> sys.stderr, '%s: %s: %s' % (sys.argv[0], type(e).__name__, e)
+            composition = None
+
+        time.sleep(options.poll_interval / 1000.)
+
 def main():
     parser = OptionParser()
     parser.add_option('-t', action='store_true', dest='from_tracks', help='Read tracks from tracks.py. If encountered, will ignore instructions to read from MIDI file.')
     parser.add_option('-r', '--read-midi', dest='input_midi_file', help='Read tracks from midi provided MIDI_FILE. If encountered, will ignore instructions to write to MIDI file.', metavar='MIDI_FILE')
-    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, or 4. Only applies to MIDI files.', metavar='SPECIES', type='int', default=1)
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4. Only applies to MIDI files.', metavar='SPECIES', type='int', default=1)
     parser.add_option('-w', '--write-midi', dest='output_midi_file', help='Write midi file OUTPUT_FILE', metavar='OUTPUT_FILE')
     parser.add_option('-p', '--write-png', dest='png_file', help='Write printed music to PNG_FILE', metavar='PNG_FILE')
     parser.add_option('-z', dest='typeset_midi_file', help="Testing option. Read in a midi file, but do not test it for errors. Can be used with -w, -p and -l", metavar='MIDI_FILE')
     parser.add_option('-l', dest='lilypond_file', help="Testing option. Write lilypond string to LY_FILE.", metavar="LY_FILE")
+    parser.add_option('--error-png', dest='error_png_file', help='Write printed music of only the bars with errors to PNG_FILE', metavar='PNG_FILE')
+    parser.add_option('--error-ly', dest='error_lilypond_file', help='Write a lilypond string of only the bars with errors to LY_FILE', metavar='LY_FILE')
+    parser.add_option('--context', dest='context', help='Show BARS bars either side of each error with --error-png and --error-ly', metavar='BARS', type='int', default=1)
+    parser.add_option('-c', '--render-cache', dest='render_cache', help='Keep rendered PNG files in CACHE_DIR, and reuse them when the same music is rendered again.', metavar='CACHE_DIR')
+    parser.add_option('-m', '--max-errors', dest='max_errors', help='Stop checking once more than MAX_ERRORS errors are found, and exit with status 3.', metavar='MAX_ERRORS', type='int')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Check the voices and pairs of voices of large pieces, or with --chunk-bars the chunks, in JOBS worker processes.', metavar='JOBS', type='int', default=1)
+    parser.add_option('--chunk-bars', dest='chunk_bars', help='Check long pieces BARS bars at a time, in JOBS worker processes. Finds the same errors, listed in the order they occur.', metavar='BARS', type='int')
+    parser.add_option('--halo', dest='halo', help='With --chunk-bars, also read BARS bars either side of each chunk. Defaults to 2, which is enough for every species.', metavar='BARS', type='int', default=2)
+    parser.add_option('--rulebook', dest='rulebook_files', action='append', default=[], help='Check the music against the rules in RULEBOOK_FILE instead of the default rules. May be given more than once, to check against several rulebooks.', metavar='RULEBOOK_FILE')
+    parser.add_option('--screen', action='store_true', dest='screen', help='Screen the music for out of key notes, parallel perfect intervals and notes that don\'t line up first, and only check it in full if none are found. Exits with status 4 if the screen finds one.')
+    parser.add_option('--watch', action='store_true', dest='watch', help='Keep running, and check the music again every time tracks.py or MIDI_FILE is saved.')
+    parser.add_option('--poll-interval', dest='poll_interval', help='With --watch, check for changes every MS milliseconds. Defaults to 50.', metavar='MS', type='int', default=50)
 
     options, args = parser.parse_args()
 
+    # Compile the rulebooks once, up front.
+    try:
+        options.rulebooks = [load_rulebook(f) for f in options.rulebook_files] or [default_rulebook]
+    except (IOError, ValueError), e:
+        parser.error('Could not load rulebook: %s' % e)
+
     if options.typeset_midi_file:
         composition, bpm = MIDI_to_Composition(options.typeset_midi_file)
-        if options.png_file:
-            string = from_Composition(composition)
-            to_png(string, options.png_file)
         if options.output_midi_file:
             write_Composition(options.output_midi_file, composition, verbose=True)
-        if options.lilypond_file:
-            string = from_Composition(composition)
-            lf = open(options.lilypond_file, 'w')
-            lf.write(string)
-            lf.close()
+        write_typeset_music(composition, options)
         return
 
 
@@ -102,33 +246,31 @@ def main():
         parser.error('Insufficient arguments provided. Use the -h argument to display help.')
         sys.exit(0)
 
-    # Compute any errors.
-    rulesets = [first_species, second_species, third_species, fourth_species]
-    error_dict = rulesets[species-1](composition)
+    if options.watch:
+        try:
+            watch(composition, species, options)
+        except KeyboardInterrupt:
+            pass
+        return
 
-    # Convert the errors dict to a standard format
-    errors = standardize_errors(error_dict)
+    if options.screen:
+        # skip the full check if the music is sure to fail it under every rulebook.
+        problems = [screen_composition(composition, species, rulebook) for rulebook in options.rulebooks]
+        if None not in problems:
+            print get_error_text(problems[0])
+            print ""
+            print >> sys.stderr, '%s: FAILED SCREENING. NOT CHECKED IN FULL.' % sys.argv[0]
+            sys.exit(4)
 
-    # Print out the standardized errors, and their corresponding rules.
-    for error in errors:
-        print get_error_text(error)
-        rule = error[-1]
-        if rule in written_rules:
-            print "Rule:", written_rules[rule]
-        print ""
+    errors, budget_exceeded = check_composition(composition, species, options)
 
+    write_error_music(composition, errors, options)
 
-    if options.png_file:
-        # Save the PNG
-        string = from_Composition(composition)
-        to_png(string, options.png_file)
+    if budget_exceeded:
+        print >> sys.stderr, '%s: MORE THAN %d ERROR(S) FOUND. STOPPED CHECKING.' % (sys.argv[0], options.max_errors)
+        sys.exit(3)
 
-    if options.lilypond_file:
-        # save the Lilypond file
-        string = from_Composition(composition)
-        lf = open(options.lilypond_file, 'w')
-        lf.write(string)
-        lf.close()
+    write_typeset_music(composition, options)
 
 if __name__ == "__main__":
     main()
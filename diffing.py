@@ -0,0 +1,270 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from difflib import SequenceMatcher
+from collections import defaultdict
+from optparse import OptionParser
+from structures import NoteList
+from errors import standardize_errors, get_error_text
+from chunking import rulesets, is_global, error_position, halo_start, halo_end, check_window
+
+###
+# Comparing two versions of an exercise. The bars of the two versions are
+# lined up by their notes, so that an error in bars that are the same in
+# both versions is the same error, even if the bars have moved. Only the
+# bars around the bars that changed are checked again for the rules that
+# look at nearby notes (see chunking.py). The other rules are checked on
+# each whole version, sharing one cache, so voices that didn't change aren't
+# checked twice.
+#
+# Errors that are only in the new version were introduced, errors that are
+# only in the old version were resolved, and an error that is in both, but
+# not in the same lined up place, has moved.
+###
+
+def bar_signatures(n, bar_count):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList) and
+    the number of bars.
+
+    Returns a list with one hashable value per bar, of everything the rules
+    can see in that bar: which voices there are, their key and meter, and
+    their notes.
+    """
+    signatures = [[] for bar in range(bar_count)]
+    for voice in sorted(n):
+        a_list = n[voice]
+        first_bar = a_list.track.bars[0]
+        setting = (voice, getattr(first_bar.key, 'name', first_bar.key), tuple(first_bar.meter))
+        notes = defaultdict(list)
+        for note in a_list:
+            notes[note.bar].append((note.name, note.octave, note.beat, note.duration))
+        for bar in range(bar_count):
+            signatures[bar].append((setting, tuple(notes[bar])))
+    return [tuple(signature) for signature in signatures]
+
+def bar_count(n):
+    return max([len(a_list.track.bars) for a_list in n.values()])
+
+def align_bars(old_n, new_n):
+    """
+    Takes the dicts of NoteLists of the old and new versions.
+
+    Returns a list of (tag, old first bar, old end bar, new first bar, new
+    end bar) tuples, as from difflib.SequenceMatcher.get_opcodes(), lining
+    up the bars that are the same in both versions.
+    """
+    matcher = SequenceMatcher(None, bar_signatures(old_n, bar_count(old_n)),
+                              bar_signatures(new_n, bar_count(new_n)), False)
+    return matcher.get_opcodes()
+
+def bar_map(opcodes):
+    # old bar => new bar, for the bars that are the same in both versions.
+    mapping = {}
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            for bar in range(i1, i2):
+                mapping[bar] = bar - i1 + j1
+    return mapping
+
+def around(n, start, end, halo):
+    # the bars from halo bars with notes before start, to halo bars with
+    # notes after end, in every voice (see chunking.halo_start()).
+    first = min([halo_start(n[voice], start, halo) for voice in n])
+    ends = [halo_end(n[voice], end, halo) for voice in n]
+    if None in ends:
+        return first, bar_count(n)
+    return first, max(ends)
+
+def changed_regions(old_n, new_n, opcodes, halo=2):
+    """
+    Takes the dicts of NoteLists of the old and new versions, the opcodes
+    from align_bars() and the number of bars with notes around each change
+    whose errors could change (see chunking.check_in_chunks()).
+
+    Returns a list of ((old first bar, old end bar), (new first bar, new end
+    bar)) tuples: the bars of each version in which the local errors could
+    differ. Changes close enough for their regions to touch are merged.
+    """
+    mapping = bar_map(opcodes)
+    inverse = dict([(new_bar, old_bar) for old_bar, new_bar in mapping.items()])
+    regions = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            continue
+        old, new = around(old_n, i1, i2, halo), around(new_n, j1, j2, halo)
+        # a tie into a changed bar can end the halo in a different place in
+        # each version, so each takes in the other's lined up bars too.
+        old, new = (
+            (min(old[0], inverse.get(new[0], old[0])), max(old[1], inverse.get(new[1] - 1, old[1] - 1) + 1)),
+            (min(new[0], mapping.get(old[0], new[0])), max(new[1], mapping.get(old[1] - 1, new[1] - 1) + 1)),
+        )
+        if regions and (old[0] <= regions[-1][0][1] or new[0] <= regions[-1][1][1]):
+            last_old, last_new = regions.pop()
+            old = (min(old[0], last_old[0]), max(old[1], last_old[1]))
+            new = (min(new[0], last_new[0]), max(new[1], last_new[1]))
+        regions.append((old, new))
+    return regions
+
+def region_errors(composition, n, region, species=1, halo=2, rulebook=None):
+    # the local errors whose first event is in the region.
+    start, end = region
+    read_start, read_end = around(n, start, end, halo)
+    return check_window(composition, (start, end, read_start, read_end), species, rulebook)
+
+def global_errors(n, species=1, rulebook=None, cache=None):
+    error_dict = rulesets[species-1](n, cache=cache, rulebook=rulebook, only=is_global)
+    return [error for error in standardize_errors(error_dict) if is_global(error[-1])]
+
+def map_error(error, mapping):
+    """
+    Takes an error in the standard format (see errors.py) and a dict of old
+    bar => new bar (see bar_map()).
+
+    Returns the error with its bars in the new version, or None if one of
+    them was changed.
+    """
+    events = []
+    for voices, name, bar, beat in error[0]:
+        if bar is not None:
+            if bar not in mapping:
+                return None
+            bar = mapping[bar]
+        events.append((voices, name, bar, beat))
+    return (tuple(events),) + tuple(error[1:])
+
+def error_shape(error):
+    # everything about an error but where it is.
+    return (tuple([(voices, name) for voices, name, bar, beat in error[0]]),) + tuple(error[1:])
+
+def compare_errors(old_errors, new_errors, mapping):
+    """
+    Takes the errors of the old and new versions in the standard format,
+    and a dict of old bar => new bar (see bar_map()).
+
+    Returns a tuple:
+    (
+        list of errors only in the new version,
+        list of errors only in the old version,
+        list of (old error, new error) tuples of errors that moved
+    )
+    """
+    remaining = defaultdict(int)
+    for error in new_errors:
+        remaining[error] += 1
+    resolved = []
+    for error in old_errors:
+        mapped = map_error(error, mapping)
+        if mapped is not None and remaining[mapped]:
+            remaining[mapped] -= 1
+        else:
+            resolved.append(error)
+    introduced = []
+    for error in new_errors:
+        if remaining[error]:
+            remaining[error] -= 1
+            introduced.append(error)
+
+    # pair what is left by shape, nearest first.
+    order = lambda error: (error_position(error), repr(error))
+    introduced.sort(key=order)
+    resolved.sort(key=order)
+    by_shape = defaultdict(list)
+    for error in introduced:
+        by_shape[error_shape(error)].append(error)
+    moved = []
+    still_resolved = []
+    for error in resolved:
+        candidates = by_shape[error_shape(error)]
+        if not candidates:
+            still_resolved.append(error)
+            continue
+        bar = error_position(error)[0]
+        nearest = min(candidates, key=lambda e: (abs(error_position(e)[0] - bar), error_position(e), repr(e)))
+        candidates.remove(nearest)
+        moved.append((error, nearest))
+    introduced = [error for candidates in by_shape.values() for error in candidates]
+
+    introduced.sort(key=order)
+    moved.sort(key=lambda x: order(x[1]))
+    return introduced, still_resolved, moved
+
+def note_lists(composition):
+    return dict([(track.name, NoteList(track)) for track in composition])
+
+def diff_compositions(old_composition, new_composition, species=1, halo=2, rulebook=None):
+    """
+    Takes two mingus.containers.Composition objects, the old and new
+    versions of an exercise, and an (optional) species, halo (see
+    changed_regions()) and rulebook (see rulebook.py).
+
+    Returns a tuple:
+    (
+        list of errors introduced in the new version,
+        list of errors resolved since the old version,
+        list of (old error, new error) tuples of errors that moved,
+        list of the opcodes lining up the bars (see align_bars())
+    )
+
+    Errors are in the standard format (see errors.py), with bars numbered
+    as in their own version. The result is the same as comparing all the
+    errors of both versions with compare_errors().
+    """
+    old_n, new_n = note_lists(old_composition), note_lists(new_composition)
+    opcodes = align_bars(old_n, new_n)
+    mapping = bar_map(opcodes)
+
+    cache = {}
+    old_errors = global_errors(old_n, species, rulebook, cache)
+    new_errors = global_errors(new_n, species, rulebook, cache)
+    for old_region, new_region in changed_regions(old_n, new_n, opcodes, halo):
+        old_errors.extend(region_errors(old_composition, old_n, old_region, species, halo, rulebook))
+        new_errors.extend(region_errors(new_composition, new_n, new_region, species, halo, rulebook))
+
+    introduced, resolved, moved = compare_errors(old_errors, new_errors, mapping)
+    return introduced, resolved, moved, opcodes
+
+def main():
+    parser = OptionParser(usage='%prog [options] OLD_MIDI_FILE NEW_MIDI_FILE')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4.', metavar='SPECIES', type='int', default=1)
+    parser.add_option('--halo', dest='halo', help='Check BARS bars with notes either side of each change again. Defaults to 2, which is enough for every species.', metavar='BARS', type='int', default=2)
+
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('An old and a new MIDI file are required. Use the -h argument to display help.')
+
+    from counterpoint import setup_midi
+    compositions = []
+    for midi_file in args:
+        composition, errors = setup_midi(midi_file)
+        if errors:
+            print >> sys.stderr, '%s: ERROR(S) ENCOUNTERED WHEN READING %s:' % (sys.argv[0], midi_file)
+            print >> sys.stderr, '\n'.join(errors)
+            sys.exit(1)
+        compositions.append(composition)
+
+    started = time.time()
+    introduced, resolved, moved, opcodes = diff_compositions(compositions[0], compositions[1], options.species, options.halo)
+    changed = sum([j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag != 'equal'])
+
+    for heading, errors in [('Introduced', introduced), ('Resolved', resolved)]:
+        if errors:
+            print '%s:' % heading
+            for error in errors:
+                print '   ', get_error_text(error)
+            print ""
+    if moved:
+        print 'Moved:'
+        for old, new in moved:
+            bar, beat = error_position(new)
+            print '   ', get_error_text(old)
+            print '        now at mm. %d beat %.2f' % (bar + 1, beat * 4 + 1)
+        print ""
+
+    print '%d introduced, %d resolved, %d moved; %d bar(s) changed, compared in %d ms.' % (
+        len(introduced), len(resolved), len(moved), changed, (time.time() - started) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from multiprocessing import Pool
+from optparse import OptionParser
+from mingus.containers import Note, NoteContainer
+from mingus.core.diatonic import get_notes
+from structures import Soprano, Alto, Tenor, Bass, NoteNode
+from views import get_interval, get_semitones
+from rulebook import default_rulebook, load_rulebook
+
+###
+# Enumerating every cantus firmus of a given length in a key: every melody
+# of whole notes, in the notes of the key and the range of a voice, that
+# breaks none of these rules:
+#
+#     starts_with_tonic
+#     illegal_horizontal_intervals
+#     missed_leap_turnarounds
+#     illegal_indirect_horizontal_intervals
+#     ends_with_lt_tonic
+#
+# Melodies are built a note at a time, depth first, and each rule is checked
+# as soon as the notes so far are enough to break it, so that no melody
+# starting with a broken rule is ever extended. The rules are the same as in
+# rules.py, walked along the melody one note at a time (see
+# melodic_contour() in views.py for the leaps and turning points).
+###
+
+voices = [Soprano, Alto, Tenor, Bass]
+
+def scale_notes(key, voice):
+    """
+    Takes the name of a key and a voice (eg. structures.Soprano).
+
+    Returns a list of NoteNode objects, one for each note of the key in the
+    voice's range, from lowest to highest.
+    """
+    low, high = [int(note) for note in voice.range]
+    names = get_notes(key)
+    notes = []
+    for octave in range(10):
+        for name in names:
+            note = Note(name, octave)
+            if low <= int(note) <= high:
+                notes.append(NoteNode(NoteContainer([note]), 0, 0.0, 1))
+    notes.sort(key=int)
+    return notes
+
+def pitch_tables(notes, rulebook=default_rulebook):
+    """
+    Takes a list of NoteNode objects and an (optional) rulebook.
+
+    Returns a tuple of tables, each indexed [from note][to note] by position
+    in notes:
+    (
+        list of lists of the notes allowed to follow each note
+            (see illegal_horizontal_intervals()),
+        semitones between the notes,
+        direction from one note to the other: 1 up, -1 down or 0,
+        whether the interval is allowed between turning points
+            (see illegal_indirect_horizontal_intervals())
+    )
+    """
+    allowed_movements = rulebook['allowed_movements']
+    allowed_indirect = rulebook['allowed_indirect_intervals']
+    following = []
+    semitones = []
+    directions = []
+    indirect = []
+    for a in notes:
+        intervals = [get_interval(a, b) for b in notes]
+        following.append([j for j, i in enumerate(intervals) if i[0] in allowed_movements])
+        semitones.append([get_semitones(i) for i in intervals])
+        directions.append([cmp(int(b), int(a)) for b in notes])
+        indirect.append([i[0] in allowed_indirect for i in intervals])
+    return following, semitones, directions, indirect
+
+# a leap larger than this must be followed by a step the other way
+# (see missed_leap_turnarounds())
+largest_leap_without_turnaround = 6
+largest_step = 2
+
+class Enumeration(object):
+    """
+    Everything the search needs to know about one key, voice, length and
+    rulebook, worked out once, so that worker processes can be given it.
+    """
+    def __init__(self, key='C', voice=Soprano, length=8, rulebook=default_rulebook):
+        self.key = key
+        self.length = length
+        self.notes = scale_notes(key, voice)
+        self.names = ['%s-%d' % (n.name, n.octave) for n in self.notes]
+        self.following, self.semitones, self.directions, self.indirect = pitch_tables(self.notes, rulebook)
+
+        # the notes the melody may start on, and the two it must end on.
+        self.tonics = [i for i, n in enumerate(self.notes) if n.name == key]
+        leading_tone = Note(key).transpose('7', True).name
+        self.endings = set([
+            (i, j) for i, a in enumerate(self.notes) for j, b in enumerate(self.notes)
+            if (a.name, b.name) == (leading_tone, key) and int(b) - int(a) == 1
+        ])
+        self.leading_tones = set([i for i, j in self.endings])
+        self.final_tonics = dict(self.endings)
+
+    def start_states(self):
+        # a state is everything the rules need to know about the melody so
+        # far: (list of note positions, direction of the last move that
+        # wasn't a repeat, the note it reached, the last turning point (or
+        # None), the direction of a leap still to be turned around (or 0)).
+        return [([i], 0, None, None, 0) for i in self.tonics]
+
+    def extend(self, state, j):
+        """
+        Takes a state (see start_states()) and the position of the next note.
+
+        Returns the state after the next note, or None if the melody now
+        breaks a rule, whatever notes follow.
+        """
+        melody, last_dir, turning, extremity, leap_dir = state
+        i = melody[-1]
+        position = len(melody)
+        dir = self.directions[i][j]
+        semitones = self.semitones[i][j]
+
+        if semitones != 0:
+            if leap_dir and not (dir == -leap_dir and semitones <= largest_step):
+                return None
+            leap_dir = 0
+        if semitones > largest_leap_without_turnaround:
+            leap_dir = dir
+
+        if dir != 0:
+            if extremity is None:
+                # the first move makes the first note a turning point.
+                extremity = (0, melody[0])
+            elif dir == -last_dir:
+                # the note the last move reached was a turning point.
+                if not self.outlines(extremity, turning):
+                    return None
+                extremity = turning
+            last_dir = dir
+            turning = (position, j)
+        return (melody + [j], last_dir, turning, extremity, leap_dir)
+
+    def outlines(self, a, b):
+        # whether the interval between two turning points is allowed. Those
+        # right beside each other are checked as horizontal intervals.
+        (position_a, i), (position_b, j) = a, b
+        return position_b == position_a + 1 or self.indirect[i][j]
+
+    def finished(self, state):
+        # whether a melody of the full length breaks no rule at its end.
+        melody, last_dir, turning, extremity, leap_dir = state
+        if leap_dir:
+            return False
+        if (melody[-2], melody[-1]) not in self.endings:
+            return False
+        if turning is not None and turning[0] == len(melody) - 1:
+            # a melody that ends with a move ends on a turning point.
+            return self.outlines(extremity, turning)
+        return True
+
+    def candidates(self, state):
+        # the notes that may come next.
+        melody = state[0]
+        remaining = self.length - len(melody)
+        following = self.following[melody[-1]]
+        if remaining == 2:
+            return [j for j in following if j in self.leading_tones]
+        if remaining == 1:
+            j = self.final_tonics.get(melody[-1])
+            return [j] if j in following else []
+        return following
+
+    def search(self, state):
+        """
+        Takes a state (see start_states()).
+
+        Yields every finished melody that starts with it, depth first, as a
+        list of note positions.
+        """
+        stack = [state]
+        while stack:
+            state = stack.pop()
+            if len(state[0]) == self.length:
+                if self.finished(state):
+                    yield state[0]
+                continue
+            for j in reversed(self.candidates(state)):
+                next_state = self.extend(state, j)
+                if next_state is not None:
+                    stack.append(next_state)
+
+    def prefixes(self, depth):
+        """
+        Takes a number of notes.
+
+        Returns a list of the states of every melody of that many notes (or
+        of the full length, if shorter) that breaks no rule yet, in order.
+        """
+        states = self.start_states()
+        for position in range(1, min(depth, self.length)):
+            states = [
+                next_state
+                for state in states
+                for j in self.candidates(state)
+                for next_state in [self.extend(state, j)]
+                if next_state is not None
+            ]
+        return states
+
+    def melody_string(self, melody):
+        return ' '.join([self.names[i] for i in melody])
+
+def enumerate_cantus_firmi(key='C', voice=Soprano, length=8, rulebook=default_rulebook):
+    """
+    Takes the name of a key, a voice (eg. structures.Soprano), the number of
+    notes and an (optional) rulebook.
+
+    Yields every cantus firmus that follows the rules (see above), in order
+    from lowest to highest, each as a list of (str: note name, int: octave)
+    tuples.
+    """
+    if length < 2:
+        return
+    enumeration = Enumeration(key, voice, length, rulebook)
+    for state in enumeration.start_states():
+        for melody in enumeration.search(state):
+            yield [(enumeration.notes[i].name, enumeration.notes[i].octave) for i in melody]
+
+# the enumeration each worker process searches part of, set by start_worker().
+worker = {}
+
+def start_worker(enumeration):
+    worker['enumeration'] = enumeration
+
+def search_prefix(state):
+    # every melody starting with one prefix, as lines of text.
+    enumeration = worker['enumeration']
+    lines = [enumeration.melody_string(melody) + '\n' for melody in enumeration.search(state)]
+    return len(lines), ''.join(lines)
+
+def write_cantus_firmi(f, key='C', voice=Soprano, length=8, rulebook=default_rulebook, processes=None, split_depth=3):
+    """
+    Takes an open file, the name of a key, a voice, the number of notes, an
+    (optional) rulebook, number of worker processes and number of notes to
+    split the search on.
+
+    Writes every cantus firmus to the file as it is found, one per line,
+    like "C-4 D-4 B-3 C-4", in the same order as enumerate_cantus_firmi().
+
+    Returns the number written.
+    """
+    if length < 2:
+        return 0
+    enumeration = Enumeration(key, voice, length, rulebook)
+    if processes == 1:
+        start_worker(enumeration)
+        results = (search_prefix(state) for state in enumeration.prefixes(split_depth))
+    else:
+        # each worker searches every melody starting with one prefix at a
+        # time, and the results are written in order as they arrive.
+        pool = Pool(processes, start_worker, (enumeration,))
+        results = pool.imap(search_prefix, enumeration.prefixes(split_depth))
+
+    count = 0
+    try:
+        for found, lines in results:
+            f.write(lines)
+            count += found
+    finally:
+        if processes != 1:
+            pool.close()
+            pool.join()
+    return count
+
+def main():
+    parser = OptionParser(usage='%prog [options] -n LENGTH')
+    parser.add_option('-n', '--length', dest='length', help='The number of notes in each cantus firmus.', metavar='LENGTH', type='int')
+    parser.add_option('-k', '--key', dest='key', help='The key. Defaults to C.', metavar='KEY', default='C')
+    parser.add_option('-v', '--voice', dest='voice', help='The voice whose range to use. One of Soprano, Alto, Tenor or Bass. Defaults to Soprano.', metavar='VOICE', default='Soprano')
+    parser.add_option('-o', '--output', dest='output', help='Write the cantus firmi to OUTPUT_FILE, rather than standard output.', metavar='OUTPUT_FILE')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Search in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+    parser.add_option('--split', dest='split', help='Give each worker process the melodies starting with the same NOTES notes at a time. Defaults to 3.', metavar='NOTES', type='int', default=3)
+    parser.add_option('--rulebook', dest='rulebook_file', help='Use the melodic intervals allowed in RULEBOOK_FILE instead of the default rules.', metavar='RULEBOOK_FILE')
+
+    options, args = parser.parse_args()
+    if not options.length:
+        parser.error('A length is required. Use the -h argument to display help.')
+    voice = [v for v in voices if v.name == options.voice]
+    if not voice:
+        parser.error('Unknown voice %s.' % options.voice)
+    try:
+        rulebook = options.rulebook_file and load_rulebook(options.rulebook_file) or default_rulebook
+    except (IOError, ValueError), e:
+        parser.error('Could not load rulebook: %s' % e)
+
+    if options.output:
+        f = open(options.output, 'w', 1 << 16)
+    else:
+        f = sys.stdout
+    started = time.time()
+    try:
+        count = write_cantus_firmi(f, options.key, voice[0], options.length, rulebook, options.jobs, options.split)
+    finally:
+        if options.output:
+            f.close()
+    print >> sys.stderr, '%d cantus firmi of %d notes found in %d ms.' % (count, options.length, (time.time() - started) * 1000)
+
+if __name__ == "__main__":
+    main()
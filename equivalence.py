@@ -0,0 +1,279 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+from optparse import OptionParser
+from structures import composition_from_melodies
+from errors import standardize_errors
+from species import first_species, second_species, third_species, fourth_species
+from chunking import check_in_chunks
+from grouping import check_in_groups
+
+###
+# Differential testing. Runs the reference species functions and another
+# engine side by side over the same exercises, and reports any difference in
+# the errors they find, along with how long each took. Rule results hold
+# NoteNodes, which are compared by identity, so both sets of results are
+# compared after they have been converted to the standard error format.
+# Engines may also give the errors in that format already, as a list.
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+
+def reference_engine(composition, species):
+    return rulesets[species-1](composition)
+
+def cached_engine(composition, species):
+    # the second run is answered entirely from the cache.
+    cache = {}
+    rulesets[species-1](composition, cache=cache)
+    return rulesets[species-1](composition, cache=cache)
+
+def budget_engine(composition, species):
+    # a budget too large to be exceeded, which checks one rule at a time.
+    return rulesets[species-1](composition, max_errors=sys.maxint)
+
+def chunked_engine(composition, species):
+    # chunks of two bars, so that even short exercises are split up.
+    return check_in_chunks(composition, species, chunk_bars=2)
+
+def grouped_engine(composition, species):
+    # two worker processes, whatever the size of the exercise.
+    return check_in_groups(composition, species, processes=2)
+
+engines = {
+    'reference': reference_engine,
+    'cached': cached_engine,
+    'budget': budget_engine,
+    'chunked': chunked_engine,
+    'grouped': grouped_engine,
+}
+
+def get_engine(name):
+    """
+    Takes the name of an engine: one of the keys of engines, or the full
+    name of a function, like 'module.function'. The function must take a
+    mingus.containers.Composition object and a species number, and return
+    a dict of errors like the species functions do, or a list of errors in
+    the standard format (see errors.py).
+
+    Returns the engine function.
+    """
+    if name in engines:
+        return engines[name]
+    module_name, dot, function_name = name.rpartition('.')
+    if not module_name:
+        raise ValueError('Unknown engine "%s"' % name)
+    module = __import__(module_name, {}, {}, [function_name])
+    return getattr(module, function_name)
+
+# diatonic steps from C-0, for the range each voice is generated in.
+note_names = 'CDEFGAB'
+voice_ranges = {
+    'Soprano': (30, 38),
+    'Alto': (26, 34),
+    'Tenor': (22, 30),
+    'Bass': (17, 25),
+}
+
+def step_name(step):
+    return '%s-%d' % (note_names[step % 7], step // 7)
+
+def random_melodies(rng, species=1, voices=None, bars=None):
+    """
+    Takes a random.Random object, an (optional) species, an (optional) list
+    of voice names and an (optional) number of bars.
+
+    Returns a dict of melodies in the format of tracks.py, with the lowest
+    voice as a cantus firmus of whole notes. The melodies move mostly by
+    step, but are not expected to follow the rules.
+    """
+    if voices is None:
+        voices = rng.choice([
+            ['Soprano', 'Bass'], ['Soprano', 'Alto'], ['Alto', 'Bass'],
+            ['Soprano', 'Alto', 'Bass'], ['Soprano', 'Alto', 'Tenor', 'Bass'],
+        ])
+    if bars is None:
+        bars = rng.randint(4, 12)
+    notes_per_bar = {1: 1, 2: 2, 3: 4, 4: 2}[species]
+
+    melodies = {}
+    for voice in voices:
+        low, high = voice_ranges[voice]
+        step = rng.randint(low, high)
+        melody = []
+        for bar in range(bars):
+            count = notes_per_bar
+            if voice == voices[-1] or bar == bars - 1:
+                count = 1
+            for i in range(count):
+                tied = species == 4 and count == 2 and i == 0 and bar > 0
+                if not (tied and rng.random() < 0.8):
+                    step += rng.choice([-2, -1, -1, 1, 1, 2, 0, 3, -3, 4, -4])
+                    step = min(high, max(low, step))
+                melody.append((step_name(step), count))
+        melodies[voice] = melody
+    return melodies
+
+def canonical_errors(error_dict, ordered=False):
+    """
+    Takes a dict of errors, as returned by the species functions, or a list
+    of errors in the standard format (see errors.py), and (optional) whether
+    to keep them in order.
+
+    Returns a list of the errors in the standard format, with beats rounded
+    and names converted to str so that equal errors compare equal, sorted
+    unless ordered is set. Errors with and without a message are both kept
+    as they are, with two or three items.
+    """
+    if isinstance(error_dict, dict):
+        error_dict = standardize_errors(error_dict)
+    errors = []
+    for error in error_dict:
+        events = tuple([
+            (voices, str(name), bar, round(beat, 6) if beat is not None else None)
+            for voices, name, bar, beat in error[0]
+        ])
+        errors.append((events,) + tuple(error[1:]))
+    if not ordered:
+        # errors mix None, str and unicode, which don't sort consistently
+        # among themselves, so sort by their representations.
+        errors.sort(key=repr)
+    return errors
+
+def run_engine(engine, composition, species, ordered=False):
+    """
+    Takes an engine function, a mingus.containers.Composition object, a
+    species number and (optional) whether to keep the errors in the order
+    the engine gives them (see canonical_errors()).
+
+    Returns a tuple of (canonical errors, or a str describing the exception
+    raised, seconds).
+    """
+    started = time.time()
+    try:
+        result = canonical_errors(engine(composition, species), ordered)
+    except Exception, e:
+        result = '%s: %s' % (type(e).__name__, e)
+    return result, time.time() - started
+
+def compare_engines(exercises, engine, reference=reference_engine, out=sys.stdout, ordered=False):
+    """
+    Takes a list of (str: name, mingus.containers.Composition, int: species)
+    tuples, an engine function, an (optional) reference engine function,
+    file to print to, and whether the engines must give the errors in the
+    same order too.
+
+    Prints any exercise that the engines disagree on, and a summary. An
+    exercise that either engine raises an exception on counts as a
+    divergence, even if both raise the same one, since no errors were
+    compared.
+
+    Returns a tuple of (int: number of divergences, float: total reference
+    time, float: total engine time).
+    """
+    divergences = 0
+    reference_time = 0.
+    engine_time = 0.
+    for name, composition, species in exercises:
+        expected, expected_time = run_engine(reference, composition, species, ordered)
+        actual, actual_time = run_engine(engine, composition, species, ordered)
+        reference_time += expected_time
+        engine_time += actual_time
+
+        if actual == expected and not isinstance(actual, str):
+            continue
+        divergences += 1
+        print >> out, 'DIVERGENCE: %s (species %d)' % (name, species)
+        if isinstance(expected, str) or isinstance(actual, str):
+            for label, result in [('reference', expected), ('engine', actual)]:
+                if not isinstance(result, str):
+                    result = '%d error(s)' % len(result)
+                print >> out, '    %-10s %s' % (label + ':', result)
+            continue
+        for error in [e for e in expected if e not in actual]:
+            print >> out, '    missing: %r' % (error,)
+        for error in [e for e in actual if e not in expected]:
+            print >> out, '    extra:   %r' % (error,)
+        if sorted(expected, key=repr) == sorted(actual, key=repr):
+            print >> out, '    the same errors, in a different order'
+
+    ratio = reference_time / engine_time if engine_time else 0
+    print >> out, '%d exercise(s), %d divergence(s).' % (len(exercises), divergences)
+    print >> out, 'reference: %.3fs, engine: %.3fs, speedup: %.2fx' % (reference_time, engine_time, ratio)
+    return divergences, reference_time, engine_time
+
+def generated_melodies(count, seed=0, species=None):
+    """
+    Takes a number of exercises, an (optional) random seed and an
+    (optional) species. Without a species, all four are generated in turn.
+
+    Yields a tuple of (str: name, dict of melodies in the format of
+    tracks.py, int: species) for each exercise, one at a time.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        exercise_species = species or i % 4 + 1
+        yield 'generated #%d (seed %d)' % (i, seed), random_melodies(rng, exercise_species), exercise_species
+
+def generated_exercises(count, seed=0, species=None):
+    """
+    Takes a number of exercises, an (optional) random seed and an
+    (optional) species, as generated_melodies().
+
+    Returns a list of (str: name, mingus.containers.Composition, int: species)
+    tuples.
+    """
+    return [
+        (name, composition_from_melodies(melodies), exercise_species)
+        for name, melodies, exercise_species in generated_melodies(count, seed, species)
+    ]
+
+def stored_exercises(midi_files, species=1, from_tracks=False):
+    """
+    Takes a list of MIDI file names, the species to check them as, and
+    (optional) whether to include the music in tracks.py.
+
+    Returns a list of (str: name, mingus.containers.Composition, int: species)
+    tuples. Files that can't be read are reported and skipped.
+    """
+    from counterpoint import setup_tracks, setup_midi
+    exercises = []
+    if from_tracks:
+        composition, errors, tracks_species = setup_tracks()
+        exercises.append(('tracks.py', composition, tracks_species))
+    for midi_file in midi_files:
+        composition, errors = setup_midi(midi_file)
+        if errors:
+            print >> sys.stderr, '%s: skipping %s: %s' % (sys.argv[0], midi_file, '; '.join(errors))
+            continue
+        exercises.append((midi_file, composition, species))
+    return exercises
+
+def main():
+    parser = OptionParser(usage='%prog [options] [MIDI_FILE ...]')
+    parser.add_option('-e', '--engine', dest='engine', help='The engine to compare with the reference: one of %s, or a function given as module.function. Defaults to cached.' % ', '.join(sorted(engines)), metavar='ENGINE', default='cached')
+    parser.add_option('-g', '--generate', dest='generate', help='Also compare COUNT generated exercises. Defaults to 100.', metavar='COUNT', type='int', default=100)
+    parser.add_option('--seed', dest='seed', help='Random seed for the generated exercises.', metavar='SEED', type='int', default=0)
+    parser.add_option('-t', action='store_true', dest='from_tracks', help='Also compare the music in tracks.py.')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4. Applies to MIDI files, and limits the generated exercises to one species.', metavar='SPECIES', type='int')
+    parser.add_option('-o', '--ordered', action='store_true', dest='ordered', help='The engine must also give the errors in the same order as the reference.')
+
+    options, args = parser.parse_args()
+    try:
+        engine = get_engine(options.engine)
+    except (ImportError, AttributeError, ValueError), e:
+        parser.error('Could not load engine: %s' % e)
+
+    exercises = generated_exercises(options.generate, options.seed, options.species)
+    if args or options.from_tracks:
+        exercises.extend(stored_exercises(args, options.species or 1, options.from_tracks))
+
+    divergences, reference_time, engine_time = compare_engines(exercises, engine, ordered=options.ordered)
+    if divergences:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
+from array import array
+from functools import wraps
 
-# The rules of first and second species counterpoint, described:
+# The rules of first, second, third and fourth species counterpoint, described:
 # Each key in the following dictionary corresponds to a key in the result
-# dict from either species.first_species() or species.second_species()
+# dict from one of the species functions in species.py
 written_rules = dict(
     accidental_errors = "This note is not within the key.",
     alignment_errors = "First Species counterpoint requires 1:1 correspondence between notes in the melody and the cantus firmus.",
+    broken_chain_errors = "Strong beats must be tied from the previous note. The chain of suspensions may only be broken twice, and not in consecutive bars.",
     cantus_firmus = "I have detected that this voice is the cantus firmus.",
     consecutive_parallel_errors = "No parallel interval may repeat more than 3 times.",
     direct_motion_errors = "Direct (similar) motion to a P5, P1, or their octaves, is forbidden.",
@@ -16,13 +19,44 @@ written_rules = dict(
     indirect_horizontal_errors = "Consecutive high/low points of a melody must not outline dissonant intervals.",
     low_voice_beginning_error = "Lower voice must begin with the tonic.",
     parallel_errors = "The only acceptable parallel intervals are m3, M3, m6, M6 and their octaves.",
+    strong_beat_dissonance_errors = "The first note of each bar must be consonant, unless it is a suspension.",
+    suspension_resolution_errors = "Suspended dissonances must resolve down by step to a consonance.",
     strong_beat_horizontals = "Adjacent strong beats must not outline dissonant intervals.",
     turnaround_errors = "Leaps equal to or greater than a P5 must be left by step in the opposite direction.",
+    unprepared_suspension_errors = "Suspended dissonances must be tied from a consonance.",
     vertical_interval_errors = "Vertical intervals must not be dissonant. The permissible vertical intervals are P1, m3, M3, P4, P5, m6, M6, and their octaves.",
     voice_crossing_errors = "Voices must not cross into the space of other voices within one note.",
+    weak_beat_dissonance_errors = "Dissonances off the downbeat must be passing tones, neighbour tones, or the second note of a cambiata.",
     weak_horizontal_errors = "Leaps greater than a 5th may only go from strong to weak beats.",
 )
 
+# How bad each kind of error is, for ranking exercises against each other:
+# 3 for errors against the basic rules of harmony, 2 for melodic errors, and
+# 1 for matters of style. Errors not listed count as 1.
+error_severities = dict(
+    accidental_errors = 2,
+    alignment_errors = 3,
+    broken_chain_errors = 2,
+    consecutive_parallel_errors = 1,
+    direct_motion_errors = 3,
+    high_point_errors = 1,
+    high_voice_beginning_error = 3,
+    high_voice_ending_error = 3,
+    horizontal_errors = 2,
+    indirect_horizontal_errors = 2,
+    low_voice_beginning_error = 3,
+    parallel_errors = 3,
+    strong_beat_dissonance_errors = 3,
+    strong_beat_horizontals = 2,
+    suspension_resolution_errors = 3,
+    turnaround_errors = 1,
+    unprepared_suspension_errors = 3,
+    vertical_interval_errors = 3,
+    voice_crossing_errors = 2,
+    weak_beat_dissonance_errors = 3,
+    weak_horizontal_errors = 2,
+)
+
 jazz_to_classical = {
     # TODO: update this dict to be a function that can handle wierd combinations of accidentals.
     '1': 'P1',
@@ -106,33 +140,72 @@ def get_error_text(error):
 # The following methods are a bit of a hack.
 # We need to get the errors into a common format somehow, though.
 # A more ideal solution would be to refactor the rules to standardize the output.
+#
+# Each takes the results of one rule (key => voice or pair of voices; value
+# => what the rule found there), and gives each error to emit(), as its
+# events and name, and its message, if it has one, as a message and the
+# values to format it with. Given no emit(), it returns the errors as a list
+# in the standard format instead (see converter()).
+
+def append_to(errors):
+    """
+    Takes a list.
+
+    Returns an emit() function that appends each error it is given to the
+    list, in the standard format, with its message formatted.
+    """
+    def emit(events, errid, *message):
+        if message:
+            template, values = message
+            errors.append((events, template % values if values else template, errid))
+        else:
+            errors.append((events, errid))
+    return emit
 
-def accidental_errors(x):
+def converter(fn):
+    """
+    Decorates one of the functions below, so that it returns a list of the
+    errors it finds, in the standard format, if it isn't given emit().
+    """
+    @wraps(fn)
+    def convert(x, emit=None):
+        if emit is not None:
+            return fn(x, emit)
+        errors = []
+        fn(x, append_to(errors))
+        return errors
+    return convert
+
+@converter
+def accidental_errors(x, emit):
 #    {u'Alto': [], u'Soprano': [<NoteNode 'Bb-4', 2, 0.00, 2>, <NoteNode 'Bb-4', 2, 0.50, 2>]}
-    errors = []
     for voice in x:
         for note in x[voice]:
-            error = (((voice, note.name, note.bar, note.beat),), 'accidental_errors')
-            errors.append(error)
-    return errors
+            emit(((voice, note.name, note.bar, note.beat),), 'accidental_errors')
 
-def alignment_errors(x):
-    errors = []
+@converter
+def alignment_errors(x, emit):
     for voices in x:
         voice_a, voice_b = voices
         combos = ((voice_a, voice_b, x[voices][0]), (voice_b, voice_a, x[voices][1]))
         for voice_c, voice_d, notes in combos:
             for note in notes:
-                error = (((voice_c, note.name, note.bar, note.beat),), 'Has no matching note in the %s' % voice_d, 'alignment_errors')
-                errors.append(error)
-    return errors
+                emit(((voice_c, note.name, note.bar, note.beat),), 'alignment_errors',
+                    'Has no matching note in the %s', (voice_d,))
+
+@converter
+def broken_chain_errors(x, emit):
+    # {u'Soprano': [<NoteNode 'E-5', 6, 0.00, 2>]}
+    for voice in x:
+        for note in x[voice]:
+            emit(((voice, note.name, note.bar, note.beat),), 'broken_chain_errors')
 
 def cantus_firmus(x):
     return [(((x, None, None, None),), 'cantus_firmus')]
 
-def consecutive_parallel_errors(x):
+@converter
+def consecutive_parallel_errors(x, emit):
     # {('Soprano', 'Alto'): [[(('b3', 0), (1, 0.0)), (('b3', 0), (1, 0.5)), (('b3', 0), (2, 0.0)), (('b3', 0), (2, 0.5))]]}
-    errors = []
     for voices in x:
         for run in x[voices]:
             notes = []
@@ -140,92 +213,71 @@ def consecutive_parallel_errors(x):
                 note = (voices, i, bar, beat)
                 notes.append(note)
             notes = tuple(notes)
-            error = (notes, 'Interval %s is repeated %d times.' % (i, len(notes)), 'consecutive_parallel_errors')
-            errors.append(error)
-    return errors
+            emit(notes, 'consecutive_parallel_errors', 'Interval %s is repeated %d times.', (i, len(notes)))
 
-def direct_motion_errors(x):
+@converter
+def direct_motion_errors(x, emit):
     # {('Soprano', 'Alto'): [(('5', 0), (3, 0.0))]}
-    errors = []
     for voices in x:
         for (i, o), (bar, beat) in x[voices]:
-            notes = ((voices, i, bar, beat),)
-            error = (notes, 'direct_motion_errors')
-            errors.append(error)
-    return errors
+            emit(((voices, i, bar, beat),), 'direct_motion_errors')
 
-def high_point_errors(x):
+@converter
+def high_point_errors(x, emit):
     # {('Soprano', 'Alto'): [(3, 0.0), (6, 0.0)]}
-    errors = []
     for voices in x:
-        notes = []
         for (bar, beat) in x[voices]:
-            note = (voices, 'melodic high point', bar, beat)
-            error = ((note, ), 'high_point_errors')
-            errors.append(error)
-    return errors
+            emit(((voices, 'melodic high point', bar, beat),), 'high_point_errors')
 
-def high_voice_beginning_error(x):
+@converter
+def high_voice_beginning_error(x, emit):
     # {'Soprano': [(1, 0.00)]}
-    errors = []
     for voice in x:
-        for note in x[voice]:
-            error = (((voice, note.name, note.bar, note.beat),), 'high_voice_beginning_error')
-            errors.append(error)
-    return errors
+        for (bar, beat) in x[voice]:
+            emit(((voice, 'first note', bar, beat),), 'high_voice_beginning_error')
 
-def high_voice_ending_error(x):
+@converter
+def high_voice_ending_error(x, emit):
     # {'Soprano': [(8, 0.50), (9, 1.00)]}
-    errors = []
     for voice in x:
         notes = []
-        for note in x[voice]:
-            note = (voice, note.name, note.bar, note.beat)
+        for (bar, beat) in x[voice]:
+            note = (voice, 'final note', bar, beat)
             notes.append(note)
         if notes:
-            notes = tuple(notes)
-            error = (notes, 'high_voice_ending_error')
-            errors.append(error)
-    return errors
+            emit(tuple(notes), 'high_voice_ending_error')
 
-def horizontal_errors(x):
+@converter
+def horizontal_errors(x, emit):
     # {u'Alto': [], u'Soprano': [(('#4', 0), <NoteNode 'Bb-4', 2, 0.50, 2>)]}
-    errors = []
     for voice in x:
         for (i, o), note in x[voice]:
             note = (voice, note.name, note.bar, note.beat)
-            error = ((note, ), 'Approached by %s leap' % jazz_to_classical[i], 'horizontal_errors')
-            errors.append(error)
-    return errors
+            emit((note, ), 'horizontal_errors', 'Approached by %s leap', (jazz_to_classical[i],))
 
-def indirect_horizontal_errors(x):
-    # {u'Alto': [], u'Soprano': [('b5', <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 8, 0.00, 2>), ('b5', <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 4, 0.50, 2>)]}
-    errors = []
+@converter
+def indirect_horizontal_errors(x, emit):
+    # {u'Alto': [], u'Soprano': [(('b5', 0), <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 8, 0.00, 2>), (('b5', 0), <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 4, 0.50, 2>)]}
     for voice in x:
-        for i, note_a, note_b in x[voice]:
+        for (i, o), note_a, note_b in x[voice]:
             note_a = (voice, note_a.name, note_a.bar, note_a.beat)
             note_b = (voice, note_b.name, note_b.bar, note_b.beat)
-            error = ((note_a, note_b), 'outlines a %s' % jazz_to_classical[i], 'indirect_horizontal_errors')
-            errors.append(error)
-    return errors
+            emit((note_a, note_b), 'indirect_horizontal_errors', 'outlines a %s', (jazz_to_classical[i],))
 
-def low_voice_beginning_error(x):
+@converter
+def low_voice_beginning_error(x, emit):
     # {'Bass': [(1, 0.00)]}
-    errors = []
     for voice in x:
         notes = []
-        for note in x[voice]:
-            note = (voice, note.name, note.bar, note.beat)
+        for (bar, beat) in x[voice]:
+            note = (voice, 'first note', bar, beat)
             notes.append(note)
         if notes:
-            notes = tuple(notes)
-            error = (notes, 'low_voice_beginning_error')
-            errors.append(error)
-    return errors
+            emit(tuple(notes), 'low_voice_beginning_error')
 
-def parallel_errors(x):
+@converter
+def parallel_errors(x, emit):
     # {('Soprano', 'Alto'): [[(('5', 0), (1, 0.0)), (('5', 0), (1, 0.5))], [(('1', 1), (2, 0.0)), (('1', 1), (2, 0.5))]}
-    errors = []
     for voices in x:
         for run in x[voices]:
             notes = []
@@ -233,67 +285,82 @@ def parallel_errors(x):
                 note = (voices, i, bar, beat)
                 notes.append(note)
             notes = tuple(notes)
-            error = (notes, 'Interval %s is repeated %d times.' % (i, len(notes)), 'parallel_errors')
-            errors.append(error)
-    return errors
+            emit(notes, 'parallel_errors', 'Interval %s is repeated %d times.', (i, len(notes)))
 
-def strong_beat_horizontals(x):
-    # {u'Alto': [], u'Soprano': [('b5', <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 7, 0.00, 2>), ('b5', <NoteNode 'F-5', 7, 0.00, 2>, <NoteNode 'B-4', 8, 0.00, 2>)]}
-    errors = []
+@converter
+def strong_beat_dissonance_errors(x, emit):
+    # {('Soprano', 'Alto'): [(('7', 0), (3, 0.0))]}
+    for voices in x:
+        for (i, o), (bar, beat) in x[voices]:
+            emit(((voices, i, bar, beat),), 'strong_beat_dissonance_errors')
+
+@converter
+def strong_beat_horizontals(x, emit):
+    # {u'Alto': [], u'Soprano': [(('b5', 0), <NoteNode 'F-5', 6, 0.00, 2>, <NoteNode 'B-4', 7, 0.00, 2>), (('b5', 0), <NoteNode 'F-5', 7, 0.00, 2>, <NoteNode 'B-4', 8, 0.00, 2>)]}
     for voice in x:
-        for i, note_a, note_b in x[voice]:
+        for (i, o), note_a, note_b in x[voice]:
             note_a = (voice, note_a.name, note_a.bar, note_a.beat)
             note_b = (voice, note_b.name, note_b.bar, note_b.beat)
-            error = ((note_a, note_b), 'outlines a %s' % jazz_to_classical[i], 'strong_beat_horizontals')
-            errors.append(error)
-    return errors
+            emit((note_a, note_b), 'strong_beat_horizontals', 'outlines a %s', (jazz_to_classical[i],))
 
-def turnaround_errors(x):
+@converter
+def suspension_resolution_errors(x, emit):
+    # {('Soprano', 'Alto'): [(('7', 0), (3, 0.0))]}
+    for voices in x:
+        for (i, o), (bar, beat) in x[voices]:
+            emit(((voices, i, bar, beat),), 'suspension_resolution_errors')
+
+@converter
+def turnaround_errors(x, emit):
     #{u'Alto': [(6, 0.0)], u'Soprano': []}
-    errors = []
     for voice in x:
         for bar, beat in x[voice]:
-            note = (voice, 'leap', bar, beat)
-            error = ((note, ), 'turnaround_errors')
-            errors.append(error)
-    return errors
+            emit(((voice, 'leap', bar, beat),), 'turnaround_errors')
 
-def vertical_interval_errors(x):
+@converter
+def unprepared_suspension_errors(x, emit):
+    # {('Soprano', 'Alto'): [(('7', 0), (3, 0.0))]}
+    for voices in x:
+        for (i, o), (bar, beat) in x[voices]:
+            emit(((voices, i, bar, beat),), 'unprepared_suspension_errors')
+
+@converter
+def vertical_interval_errors(x, emit):
     # {('Soprano', 'Alto'): [((' ', 0), (0, 0.0)), (('#4', 0), (3, 0.5))]}
-    errors = []
     for voices in x:
         for (i, o), (bar, beat) in x[voices]:
-            notes = ((voices, i, bar, beat),)
-            error = (notes, 'vertical_interval_errors')
-            errors.append(error)
-    return errors
+            emit(((voices, i, bar, beat),), 'vertical_interval_errors')
 
-def voice_crossing_errors(x):
+@converter
+def voice_crossing_errors(x, emit):
     #{('Soprano', 'Alto'): [(<NoteNode 'G-4', 2, 0.00, 1>, <NoteNode 'G-4', 1, 0.50, 2>), (<NoteNode 'G-4', 9, 0.50, 2>, <NoteNode 'G-4', 8, 0.00, 1>)]}
-    errors = []
     for voices in x:
         for note_tuple in x[voices]:
             notes = (
                 (voices[0], note_tuple[0].name, note_tuple[0].bar, note_tuple[0].beat),
                 (voices[1], note_tuple[1].name, note_tuple[1].bar, note_tuple[1].beat)
             )
-            error = (notes, 'voice_crossing_errors')
-            errors.append(error)
-    return errors
+            emit(notes, 'voice_crossing_errors')
 
-def weak_horizontal_errors(x):
+@converter
+def weak_beat_dissonance_errors(x, emit):
+    # {('Soprano', 'Alto'): [(('4', 0), (3, 0.75))]}
+    for voices in x:
+        for (i, o), (bar, beat) in x[voices]:
+            emit(((voices, i, bar, beat),), 'weak_beat_dissonance_errors')
+
+@converter
+def weak_horizontal_errors(x, emit):
     # {u'Alto': [(('6', 0), <NoteNode 'A-4', 6, 0.00, 1>)], u'Soprano': [(('b6', 0), <NoteNode 'D-4', 2, 0.00, 2>), (('1', 1), <NoteNode 'E-5', 3, 0.00, 2>)]}
-    errors = []
     for voice in x:
         for (i, o), note in x[voice]:
             note = (voice, note.name, note.bar, note.beat)
-            error = ((note, ), '%s leap to strong beat' % jazz_to_classical[i], 'weak_horizontal_errors')
-            errors.append(error)
-    return errors
+            emit((note, ), 'weak_horizontal_errors', '%s leap to strong beat', (jazz_to_classical[i],))
 
 written_errors = dict(
     accidental_errors = accidental_errors,
     alignment_errors = alignment_errors,
+    broken_chain_errors = broken_chain_errors,
 #    cantus_firmus = cantus_firmus,
     consecutive_parallel_errors = consecutive_parallel_errors,
     direct_motion_errors = direct_motion_errors,
@@ -304,19 +371,165 @@ written_errors = dict(
     indirect_horizontal_errors = indirect_horizontal_errors,
     low_voice_beginning_error = low_voice_beginning_error,
     parallel_errors = parallel_errors,
+    strong_beat_dissonance_errors = strong_beat_dissonance_errors,
     strong_beat_horizontals = strong_beat_horizontals,
+    suspension_resolution_errors = suspension_resolution_errors,
     turnaround_errors = turnaround_errors,
+    unprepared_suspension_errors = unprepared_suspension_errors,
     vertical_interval_errors = vertical_interval_errors,
     voice_crossing_errors = voice_crossing_errors,
+    weak_beat_dissonance_errors = weak_beat_dissonance_errors,
     weak_horizontal_errors = weak_horizontal_errors,
 )
 
-def standardize_errors(error_dict):
-    errors = []
+def emit_errors(error_dict, emit):
+    """
+    Takes an error dict, as returned by one of the species functions, and a
+    function to give each of its errors to, in the order standardize_errors()
+    lists them: emit(events, error name), or emit(events, error name,
+    message, values) for an error whose message is message % values.
+    """
     for key in error_dict:
         if key in written_errors and callable(written_errors[key]):
-            extra_errors = written_errors[key](error_dict[key])
-            if extra_errors:
-                errors.extend(extra_errors)
+            written_errors[key](error_dict[key], emit)
+
+def standardize_errors(error_dict):
+    errors = []
+    emit_errors(error_dict, append_to(errors))
     return errors
 
+###
+# A compact store of errors in the standard format, for runs that keep a lot
+# of them (see ranking.py). Each error is a few numbers in typed arrays, one
+# array per field, rather than a tuple of tuples: every voice, event name,
+# message, message value and error name is only held once, and referred to
+# by number. Errors can be added straight from the results of the rules,
+# with emit_errors(store.add), so their messages are never formatted until
+# they are read. The errors are put back together, as tuples, only when they
+# are read, and their text only when it is asked for.
+#
+# Batch runs over many exercises, like corpus.py and features.py, don't use
+# it: they count each exercise's errors as soon as they are found, and keep
+# only the counts, so there are never many errors to store.
+###
+
+class ErrorStore(object):
+    """
+    A list of errors in the standard format, stored in columns. Errors are
+    added with append() or extend(), or a part at a time with add(), and
+    read back by index or by iterating, equal to the ones added.
+    """
+    def __init__(self, errors=()):
+        self.strings = [] # every string (or message value) used, once each
+        self.string_ids = {} # string => its index in strings
+
+        # one of each per error
+        self.error_names = array('i')
+        self.messages = array('i') # -1 for None, -2 if the error has no message
+        self.first_events = array('i', [0]) # and one past the last event
+        self.first_values = array('i', [0]) # and one past the last value
+
+        # one of each per value to format a message with
+        self.values = array('i')
+
+        # one of each per event
+        self.voices = array('i') # the voice, or the first of two; -1 for None
+        self.other_voices = array('i') # the second of two voices, or -2
+        self.names = array('i') # -1 for None
+        self.bars = array('i') # -1 for None
+        self.beats = array('d') # -1 for None
+
+        self.extend(errors)
+
+    def string_id(self, string):
+        if string is None:
+            return -1
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def string(self, i):
+        if i == -1:
+            return None
+        return self.strings[i]
+
+    def add(self, events, errid, *message):
+        """
+        Takes the events and name of an error, and its message, if it has
+        one, as a message and a tuple of values to format it with (see
+        emit_errors()). Adds the error; the message is only formatted when
+        the error is read.
+        """
+        for voices, name, bar, beat in events:
+            if type(voices) is tuple:
+                self.voices.append(self.string_id(voices[0]))
+                self.other_voices.append(self.string_id(voices[1]))
+            else:
+                self.voices.append(self.string_id(voices))
+                self.other_voices.append(-2)
+            self.names.append(self.string_id(name))
+            self.bars.append(-1 if bar is None else bar)
+            self.beats.append(-1 if beat is None else beat)
+        self.error_names.append(self.string_id(errid))
+        if message:
+            template, values = message
+            self.messages.append(self.string_id(template))
+            self.values.extend([self.string_id(value) for value in values])
+        else:
+            self.messages.append(-2)
+        self.first_events.append(len(self.names))
+        self.first_values.append(len(self.values))
+
+    def append(self, error):
+        if len(error) == 3:
+            self.add(error[0], error[2], error[1], ())
+        else:
+            self.add(error[0], error[1])
+
+    def error_name(self, i):
+        # the name of error i, without reading the rest of it.
+        return self.strings[self.error_names[i]]
+
+    def extend(self, errors):
+        for error in errors:
+            self.append(error)
+
+    def __len__(self):
+        return len(self.error_names)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('error index out of range')
+
+        events = []
+        for j in range(self.first_events[i], self.first_events[i+1]):
+            voices = self.string(self.voices[j])
+            if self.other_voices[j] != -2:
+                voices = (voices, self.string(self.other_voices[j]))
+            bar, beat = self.bars[j], self.beats[j]
+            events.append((
+                voices,
+                self.string(self.names[j]),
+                None if bar == -1 else bar,
+                None if beat == -1 else beat,
+            ))
+        if self.messages[i] == -2:
+            return (tuple(events), self.strings[self.error_names[i]])
+        message = self.string(self.messages[i])
+        values = tuple([self.strings[j] for j in self.values[self.first_values[i]:self.first_values[i+1]]])
+        if values:
+            message = message % values
+        return (tuple(events), message, self.strings[self.error_names[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text(self, i):
+        return get_error_text(self[i])
+
+    def __repr__(self):
+        return "<ErrorStore of %d error(s)>" % len(self)
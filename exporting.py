@@ -0,0 +1,247 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+from math import log
+from struct import pack
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from mingus.core.notes import note_to_int
+from mingus.core.diatonic import basic_keys
+from packing import voice_names, exercise_rows, load_corpus, unpack_rows, unpack_exercise
+
+###
+# Writing Standard MIDI Files straight from note timelines, without building
+# mingus Bars and Tracks to pass to mingus.midi.MidiFileOut. Each exercise is
+# written as one type 1 file, with one track per voice, timed in whole ticks
+# from each note's bar and beat, so long pieces don't drift.
+#
+# The files hold the same events that write_Composition() writes, and read
+# back the same way: a tempo, the track's name, its meter and key, and a
+# note on and note off for every note, on channel 1 at velocity 64. The
+# meter and key are only written once, at the start of each track.
+###
+
+# the same resolution as mingus.midi.MidiFileOut
+ticks_per_quarter = 72
+ticks_per_whole = ticks_per_quarter * 4
+
+channel = 1
+velocity = 64
+
+def variable_length(value):
+    # a MIDI variable length number: 7 bits a byte, most significant first,
+    # with the high bit set on every byte but the last.
+    data = chr(value & 0x7f)
+    value >>= 7
+    while value:
+        data = chr(0x80 | value & 0x7f) + data
+        value >>= 7
+    return data
+
+def meta_event(delta, kind, data):
+    return variable_length(delta) + '\xff' + chr(kind) + variable_length(len(data)) + data
+
+# MIDI note numbers, by (note name, octave), worked out once each.
+midi_numbers = {}
+
+def midi_number(name, octave):
+    key = (name, octave)
+    if key not in midi_numbers:
+        # as int(Note), which counts octaves from C-0, plus 12.
+        number = octave * 12 + note_to_int(name) + 12
+        if not 0 <= number <= 127:
+            raise ValueError('%s-%d is outside the range of MIDI notes' % (name, octave))
+        midi_numbers[key] = number
+    return midi_numbers[key]
+
+def track_chunk(row, bpm=120):
+    """
+    Takes a voice's row, as returned by packing.exercise_rows(), and an
+    (optional) tempo in beats per minute.
+
+    Returns the voice as a MIDI track chunk, as a string of bytes.
+    """
+    name, key, meter, bar_count, notes = row
+    if key not in basic_keys:
+        raise ValueError('Unknown key %s' % key)
+    bar_ticks = int(round(ticks_per_whole * meter[0] / float(meter[1])))
+
+    sharps = basic_keys.index(key) - 6
+    events = [
+        meta_event(0, 0x51, pack('>I', 60000000 / bpm)[1:]),
+        meta_event(0, 0x03, str(name)),
+        meta_event(0, 0x58, chr(meter[0]) + chr(int(log(meter[1], 2))) + '\x18\x08'),
+        meta_event(0, 0x59, chr(sharps & 0xff) + '\x00'),
+    ]
+    note_on = chr(0x90 | channel)
+    note_off = chr(0x80 | channel)
+    now = 0
+    for bar, beat, duration, note_name, octave in notes:
+        if note_name is None:
+            continue
+        start = bar * bar_ticks + int(round(beat * ticks_per_whole))
+        end = start + int(round(ticks_per_whole / duration))
+        if start < now:
+            raise ValueError('Notes in the %s overlap at bar %d' % (name, bar + 1))
+        number = chr(midi_number(note_name, octave))
+        events.append(variable_length(start - now) + note_on + number + chr(velocity))
+        events.append(variable_length(end - start) + note_off + number + chr(velocity))
+        now = end
+    events.append(meta_event(0, 0x2f, ''))
+
+    data = ''.join(events)
+    return 'MTrk' + pack('>I', len(data)) + data
+
+def midi_file_chunks(rows, bpm=120):
+    """
+    Takes an exercise's rows, as returned by packing.exercise_rows(), and
+    an (optional) tempo in beats per minute.
+
+    Returns a list of strings of bytes, the header and then a track for each
+    voice, which together are the exercise as a type 1 MIDI file.
+    """
+    chunks = [
+        'MThd' + pack('>IHHH', 6, 1, len(rows), ticks_per_quarter)
+    ]
+    for row in rows:
+        chunks.append(track_chunk(row, bpm))
+    return chunks
+
+def write_midi_file(file_name, rows, bpm=120):
+    """
+    Takes the name of a file, an exercise's rows (see midi_file_chunks())
+    and an (optional) tempo, and writes the exercise to the file.
+
+    Returns the number of bytes written.
+    """
+    chunks = midi_file_chunks(rows, bpm)
+    f = open(file_name, 'wb', 1 << 16)
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+    finally:
+        f.close()
+    return sum([len(chunk) for chunk in chunks])
+
+def note_list_rows(n):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList).
+
+    Returns the voices as rows, in the same format as
+    packing.exercise_rows(), from highest to lowest.
+    """
+    rows = []
+    for voice in sorted(n, key=voice_names.index):
+        a_list = n[voice]
+        first_bar = a_list.track.bars[0]
+        notes = [
+            (note.bar, note.beat, note.duration, None if note.is_rest else note.name, note.octave)
+            for note in a_list
+        ]
+        rows.append((voice, getattr(first_bar.key, 'name', first_bar.key),
+                     tuple(first_bar.meter), len(a_list.track.bars), notes))
+    return rows
+
+def write_composition(file_name, composition, bpm=120):
+    """
+    Takes the name of a file, a mingus.containers.Composition object and an
+    (optional) tempo, and writes the composition to the file as
+    write_Composition() would. Only the first note of each NoteContainer is
+    written, as the rules only see that one.
+
+    Returns the number of bytes written.
+    """
+    return write_midi_file(file_name, exercise_rows(composition), bpm)
+
+# the packed corpus each worker process reads from, set by attach_corpus().
+packed_corpus = {}
+
+def attach_corpus(corpus):
+    packed_corpus.clear()
+    packed_corpus.update(corpus)
+
+def write_packed_exercise(job):
+    i, file_name, bpm = job
+    return file_name, write_midi_file(file_name, unpack_rows(packed_corpus, i), bpm)
+
+def write_rows(job):
+    file_name, rows, bpm = job
+    return file_name, write_midi_file(file_name, rows, bpm)
+
+def export_file_name(directory, i, name):
+    # a name for exercise i that won't clash with the others'.
+    base = os.path.splitext(os.path.basename(name))[0]
+    return os.path.join(directory, '%05d-%s.mid' % (i, base))
+
+def png_file_name(file_name):
+    # the PNG of an exercise goes next to its MIDI file.
+    return os.path.splitext(file_name)[0] + '.png'
+
+def main():
+    parser = OptionParser(usage='%prog -o DIRECTORY [options]')
+    parser.add_option('-o', '--output', dest='output', help='Write one MIDI file per exercise into DIRECTORY.', metavar='DIRECTORY')
+    parser.add_option('-p', '--packed', dest='packed', help='Export the exercises in PACKED_FILE, made with packing.py.', metavar='PACKED_FILE')
+    parser.add_option('-g', '--generate', dest='generate', help='Export COUNT randomly generated exercises (see equivalence.py).', metavar='COUNT', type='int')
+    parser.add_option('--seed', dest='seed', help='With --generate, the random seed. Defaults to 0.', metavar='SEED', type='int', default=0)
+    parser.add_option('-s', '--species', dest='species', help='With --generate, only generate exercises of SPECIES. Defaults to all four in turn.', metavar='SPECIES', type='int')
+    parser.add_option('--bpm', dest='bpm', help='The tempo to write. Defaults to 120.', metavar='BPM', type='int', default=120)
+    parser.add_option('-j', '--jobs', dest='jobs', help='Write files in JOBS worker processes, and with --png, run JOBS lilypond processes at once. Defaults to one per CPU.', metavar='JOBS', type='int')
+    parser.add_option('--png', action='store_true', dest='png', help='Also typeset each exercise as a PNG file, next to its MIDI file. Only works if gnu lilypond is in your PATH.')
+    parser.add_option('-c', '--render-cache', dest='render_cache', help='With --png, keep rendered PNG files in CACHE_DIR, and reuse them when the same music is rendered again.', metavar='CACHE_DIR')
+
+    options, args = parser.parse_args()
+    if not options.output or not (options.packed or options.generate):
+        parser.error('An output directory, and a packed corpus or a number of exercises to generate, are required. Use the -h argument to display help.')
+    if options.png:
+        from rendering import lilypond_string, lilypond_command, render_pngs
+        if lilypond_command() is None and not options.render_cache:
+            parser.error('--png needs gnu lilypond in your PATH, or in the LILYPOND environment variable.')
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    started = time.time()
+    if options.packed:
+        corpus = load_corpus(options.packed)
+        jobs = [
+            (i, export_file_name(options.output, i, name), options.bpm)
+            for i, name in enumerate(corpus['names'])
+        ]
+        file_names = [file_name for i, file_name, bpm in jobs]
+        compositions = (unpack_exercise(corpus, i) for i in range(len(jobs)))
+        pool = Pool(options.jobs, attach_corpus, (corpus,))
+        results = pool.imap(write_packed_exercise, jobs, 64)
+    else:
+        from equivalence import generated_exercises
+        exercises = generated_exercises(options.generate, options.seed, options.species)
+        jobs = [
+            (export_file_name(options.output, i, 'generated-species%d' % species), exercise_rows(composition), options.bpm)
+            for i, (name, composition, species) in enumerate(exercises)
+        ]
+        file_names = [file_name for file_name, rows, bpm in jobs]
+        compositions = (composition for name, composition, species in exercises)
+        pool = Pool(options.jobs)
+        results = pool.imap(write_rows, jobs, 64)
+
+    written = 0
+    for file_name, size in results:
+        written += size
+    pool.close()
+    pool.join()
+    print 'Written %d file(s), %d bytes, to %s in %d ms.' % (len(jobs), written, options.output, (time.time() - started) * 1000)
+
+    if options.png:
+        started = time.time()
+        renders = [
+            (lilypond_string(composition), png_file_name(file_name))
+            for composition, file_name in zip(compositions, file_names)
+        ]
+        rendered = render_pngs(renders, options.render_cache, workers=options.jobs or cpu_count())
+        print 'Typeset %d of %d PNG file(s) in %d ms.' % (rendered.count(True), len(renders), (time.time() - started) * 1000)
+        if False in rendered:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from array import array
+from multiprocessing import Pool
+from optparse import OptionParser
+from structures import Soprano, Alto, Tenor, Bass
+from views import horizontal_intervals, vertical_intervals, melodic_contour, combined_directions, direct_motion, parallel_runs
+from errors import standardize_errors, written_rules
+from species import first_species, second_species, third_species, fourth_species
+from rules import get_and_split_voices
+from structures import composition_from_melodies
+from packing import load_corpus, unpack_exercise
+
+###
+# Numeric features of exercises, for training models on. Each exercise is
+# one row of the same features, in the order of feature_names: its size,
+# which voices it has, histograms of its melodic and vertical intervals,
+# its contour, the motion between its voices, how each voice uses its
+# range, and how many errors of each kind the species function finds.
+#
+# The features are read from the same views the rules use, on the same
+# NoteLists, so each view is only worked out once for both. Rows are
+# written in batches, each to its own compressed NumPy archive (.npz), so a
+# corpus of any size can be streamed through in bounded memory. NumPy is
+# only needed to write the archives.
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+voices = [Soprano, Alto, Tenor, Bass]
+
+# interval names, as returned by get_interval(). Any others are counted
+# as 'other', and ' ' (against a rest) as 'rest'.
+interval_names = ['1', 'b2', '2', '#2', 'b3', '3', '4', '#4', 'b5', '5', '#5', 'b6', '6', 'b7', '7']
+perfect_names = ['1', '4', '5']
+rule_names = sorted([name for name in written_rules if name != 'cantus_firmus'])
+
+feature_names = (
+    ['species', 'bars', 'notes', 'rests'] +
+    ['voice.%s' % voice.name for voice in voices] +
+    ['melodic.%s' % name for name in interval_names + ['other']] +
+    ['vertical.%s' % name for name in interval_names + ['rest', 'other']] +
+    ['contour.%s' % name for name in [
+        'extremities', 'leaps', 'unresolved_leaps', 'up', 'down', 'repeated',
+        'steps', 'skips', 'mean_semitones', 'largest_semitones']] +
+    ['motion.%s' % name for name in [
+        'similar', 'contrary', 'oblique', 'direct', 'parallel_runs',
+        'parallel_perfect_runs', 'downbeat_parallel_runs', 'longest_parallel_run']] +
+    ['range.%s.%s' % (voice.name, name) for voice in voices for name in [
+        'lowest_above_floor', 'highest_below_ceiling', 'span', 'outside']] +
+    ['errors.%s' % name for name in rule_names + ['no_cantus_firmus']]
+)
+feature_index = dict([(name, i) for i, name in enumerate(feature_names)])
+
+# the lowest and highest pitch of each voice's range.
+voice_ranges = dict([(voice.name, (int(voice.range[0]), int(voice.range[1]))) for voice in voices])
+
+def interval_feature(prefix, interval):
+    name = interval[0]
+    if name == ' ':
+        return prefix + 'rest'
+    if name in interval_names:
+        return prefix + name
+    return prefix + 'other'
+
+def extract_features(composition, species=1):
+    """
+    Takes a mingus.containers.Composition object, or a dict of NoteLists
+    (key => track name; value => NoteList), and an (optional) species.
+
+    Returns an array of floats, one for each of feature_names.
+    """
+    features = array('f', [0.0]) * len(feature_names)
+
+    def add(name, value=1):
+        features[feature_index[name]] += value
+
+    def at_least(name, value):
+        i = feature_index[name]
+        features[i] = max(features[i], value)
+
+    n, high_voice, low_voice, inner_voices, voice_combos = get_and_split_voices(composition)
+
+    add('species', species)
+    for voice in n:
+        a_list = n[voice]
+        at_least('bars', len(a_list.track.bars))
+        notes = [note for note in a_list if not note.is_rest]
+        add('notes', len(notes))
+        add('rests', len(a_list) - len(notes))
+
+        # melody
+        for interval in horizontal_intervals(a_list):
+            add(interval_feature('melodic.', interval))
+        extremities, leaps = melodic_contour(a_list)
+        add('contour.extremities', len(extremities))
+        add('contour.leaps', len(leaps))
+        add('contour.unresolved_leaps', len([leap for leap in leaps if not leap[3]]))
+        for a, b in zip(notes, notes[1:]):
+            semitones = int(b) - int(a)
+            if semitones > 0:
+                add('contour.up')
+            elif semitones < 0:
+                add('contour.down')
+            else:
+                add('contour.repeated')
+            if 0 < abs(semitones) <= 2:
+                add('contour.steps')
+            elif abs(semitones) > 2:
+                add('contour.skips')
+            add('contour.mean_semitones', abs(semitones))
+            at_least('contour.largest_semitones', abs(semitones))
+
+        # range
+        if voice in voice_ranges and notes:
+            floor, ceiling = voice_ranges[voice]
+            pitches = [int(note) for note in notes]
+            add('voice.%s' % voice)
+            add('range.%s.lowest_above_floor' % voice, min(pitches) - floor)
+            add('range.%s.highest_below_ceiling' % voice, ceiling - max(pitches))
+            add('range.%s.span' % voice, max(pitches) - min(pitches))
+            add('range.%s.outside' % voice, len([p for p in pitches if not floor <= p <= ceiling]))
+
+    moves = features[feature_index['contour.up']] + features[feature_index['contour.down']] + \
+        features[feature_index['contour.repeated']]
+    if moves:
+        features[feature_index['contour.mean_semitones']] /= moves
+
+    # harmony
+    for a, b in voice_combos:
+        a_list, b_list = n[a], n[b]
+        for interval, when in vertical_intervals(a_list, b_list):
+            add(interval_feature('vertical.', interval))
+        for a_dir, b_dir, when in combined_directions(a_list, b_list):
+            if a_dir == 0 and b_dir == 0:
+                continue
+            elif a_dir == 0 or b_dir == 0:
+                add('motion.oblique')
+            elif a_dir == b_dir:
+                add('motion.similar')
+            else:
+                add('motion.contrary')
+        add('motion.direct', len(direct_motion(a_list, b_list)))
+        for downbeats_only, run in parallel_runs(a_list, b_list):
+            if downbeats_only:
+                add('motion.downbeat_parallel_runs')
+                continue
+            add('motion.parallel_runs')
+            if run[0][0][0] in perfect_names:
+                add('motion.parallel_perfect_runs')
+            at_least('motion.longest_parallel_run', len(run))
+
+    # errors
+    error_dict = rulesets[species-1](n)
+    if error_dict.get('cantus_firmus', True) is None:
+        add('errors.no_cantus_firmus')
+    else:
+        for error in standardize_errors(error_dict):
+            if error[-1] in written_rules:
+                add('errors.%s' % error[-1])
+
+    return features
+
+def write_batch(file_name, names, rows):
+    """
+    Takes the name of a file, a list of exercise names and a list of their
+    feature arrays (see extract_features()), and writes them to the file as
+    a compressed NumPy archive, with three arrays:
+        features: a float32 matrix, one row per exercise
+        names: the name of each exercise
+        feature_names: the name of each column (see feature_names)
+    """
+    import numpy
+    features = numpy.frombuffer(''.join([row.tostring() for row in rows]), dtype=numpy.float32)
+    numpy.savez_compressed(
+        file_name,
+        features=features.reshape((len(rows), len(feature_names))),
+        names=numpy.array(names),
+        feature_names=numpy.array(feature_names),
+    )
+
+# the packed corpus each worker process reads from, set by attach_corpus().
+packed_corpus = {}
+
+def attach_corpus(corpus):
+    packed_corpus.clear()
+    packed_corpus.update(corpus)
+
+def extract_job(job):
+    """
+    Takes a tuple of (exercise, int: species), where the exercise is the
+    index of an exercise in the packed corpus, the name of a MIDI file, or
+    a (str: name, dict of melodies in the format of tracks.py) tuple, as
+    generated by equivalence.generated_melodies().
+
+    Returns a tuple of (str: name, array of features, or None if the
+    exercise couldn't be read or checked, str: the reason). Runs in a
+    worker process.
+    """
+    exercise, species = job
+    name = exercise
+    try:
+        if isinstance(exercise, int):
+            name = packed_corpus['names'][exercise]
+            composition = unpack_exercise(packed_corpus, exercise)
+        elif isinstance(exercise, tuple):
+            name, melodies = exercise
+            composition = composition_from_melodies(melodies)
+        else:
+            from counterpoint import setup_midi
+            composition, errors = setup_midi(exercise)
+            if errors:
+                return name, None, '; '.join(errors)
+        return name, extract_features(composition, species), None
+    except Exception, e:
+        return name, None, '%s: %s' % (type(e).__name__, e)
+
+def extract_corpus(jobs, output, batch_size=10000, processes=None, corpus=None):
+    """
+    Takes an iterable of jobs (see extract_job()), the prefix of the
+    archives to write, and an (optional) number of exercises per archive, number of
+    worker processes and packed corpus (see packing.py) the jobs refer to.
+
+    Writes the features of each batch of exercises, in order, to
+    OUTPUT-00000.npz, OUTPUT-00001.npz and so on (see write_batch()), as
+    each batch is finished, so only one batch is held in memory at once.
+
+    Returns a tuple of (list of the archives written, dict of exercise name
+    => reason it was left out, int: number of exercises).
+    """
+    if processes == 1:
+        if corpus is not None:
+            attach_corpus(corpus)
+        results = (extract_job(job) for job in jobs)
+    else:
+        initializer, initargs = (attach_corpus, (corpus,)) if corpus is not None else (None, ())
+        pool = Pool(processes, initializer, initargs)
+        results = pool.imap(extract_job, jobs, 16)
+
+    written = []
+    failed = {}
+    count = 0
+    names, rows = [], []
+    try:
+        for name, features, reason in results:
+            count += 1
+            if features is None:
+                failed[name] = reason
+                continue
+            names.append(name)
+            rows.append(features)
+            if len(rows) == batch_size:
+                written.append('%s-%05d.npz' % (output, len(written)))
+                write_batch(written[-1], names, rows)
+                names, rows = [], []
+        if rows or not written:
+            written.append('%s-%05d.npz' % (output, len(written)))
+            write_batch(written[-1], names, rows)
+    finally:
+        if processes != 1:
+            pool.close()
+            pool.join()
+    return written, failed, count
+
+def main():
+    parser = OptionParser(usage='%prog -o OUTPUT [options] [MIDI_FILE ...]')
+    parser.add_option('-o', '--output', dest='output', help='Write the features to OUTPUT-00000.npz, OUTPUT-00001.npz and so on.', metavar='OUTPUT')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4. Defaults to 1.', metavar='SPECIES', type='int')
+    parser.add_option('-p', '--packed', dest='packed', help='Extract the features of the exercises in PACKED_FILE, made with packing.py, instead of MIDI files.', metavar='PACKED_FILE')
+    parser.add_option('-g', '--generate', dest='generate', help='Extract the features of COUNT randomly generated exercises (see equivalence.py), in every species unless --species is given.', metavar='COUNT', type='int')
+    parser.add_option('--seed', dest='seed', help='With --generate, the random seed. Defaults to 0.', metavar='SEED', type='int', default=0)
+    parser.add_option('-b', '--batch', dest='batch', help='Write BATCH exercises to each archive. Defaults to 10000.', metavar='BATCH', type='int', default=10000)
+    parser.add_option('-j', '--jobs', dest='jobs', help='Extract features in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+
+    options, args = parser.parse_args()
+    if not options.output or not (args or options.packed or options.generate):
+        parser.error('An output prefix, and MIDI files, a packed corpus or a number of exercises to generate, are required. Use the -h argument to display help.')
+    try:
+        import numpy
+    except ImportError:
+        parser.error('NumPy is required to write .npz archives.')
+
+    corpus = None
+    if options.packed:
+        corpus = load_corpus(options.packed)
+        jobs = [(i, options.species or 1) for i in range(len(corpus['names']))]
+    elif options.generate:
+        # only the melodies are generated here, as they're needed; each
+        # Composition is built in the worker process that extracts it.
+        from equivalence import generated_melodies
+        jobs = (
+            ((name, melodies), species)
+            for name, melodies, species in generated_melodies(options.generate, options.seed, options.species)
+        )
+    else:
+        jobs = [(midi_file, options.species or 1) for midi_file in args]
+
+    started = time.time()
+    written, failed, count = extract_corpus(jobs, options.output, options.batch, options.jobs, corpus)
+    for name, reason in sorted(failed.items()):
+        print >> sys.stderr, '%s: left out: %s' % (name, reason)
+    print 'Written the features of %d exercise(s), %d each, to %d archive(s) in %d ms.' % (
+        count - len(failed), len(feature_names), len(written), (time.time() - started) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from multiprocessing import Pool
+from structures import create_note_lists
+from errors import written_errors
+from chunking import error_groups
+from species import first_species, second_species, third_species, fourth_species
+
+###
+# Checking one large piece with its voices and pairs of voices in worker
+# processes. Each voice, and each pair of voices, is a group of rules that
+# only reads its own NoteLists, so each is checked on its own, in whichever
+# worker process is free. The NoteLists are built before the workers are
+# started, so each worker has its own copy of them without building or
+# pickling them, and each sends back only the errors of its groups, in the
+# standard format.
+#
+# The errors of the groups are put back in the places a whole run of the
+# species function gives them, so they come out in the same order too.
+#
+# Starting and stopping the worker processes takes longer than checking a
+# short piece, so only pieces of at least min_group_bars bars with at least
+# min_group_voices voices are worth it (see use_groups()).
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+
+min_group_bars = 500
+min_group_voices = 3
+
+def use_groups(composition, processes=None):
+    """
+    Takes a mingus.containers.Composition object, and an (optional) number of
+    worker processes.
+
+    Returns whether the piece is large enough to check in groups, in that
+    many worker processes.
+    """
+    tracks = [track for track in composition if len(track.bars)]
+    if processes is None or processes < 2 or len(tracks) < min_group_voices:
+        return False
+    return max([len(track.bars) for track in tracks]) >= min_group_bars
+
+def group_keys(n, species=1, rulebook=None):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList), and an
+    (optional) species and rulebook.
+
+    Returns a tuple of (the error dict of the species function, with every
+    error name in its place and nothing checked, list of every voice and
+    pair of voices the rules look at, in the order they look at them).
+    """
+    keys = []
+    def only_keys(key):
+        # nothing is chosen, and each key is offered once, in order.
+        keys.append(key)
+        return False
+    error_dict = rulesets[species-1](n, rulebook=rulebook, only_keys=only_keys)
+    return error_dict, keys
+
+# the piece each worker process checks groups of, set by start_worker().
+worker = {}
+
+def start_worker(n, species, rulebook):
+    worker['n'] = n
+    worker['arguments'] = (species, rulebook)
+
+def check_group(key):
+    species, rulebook = worker['arguments']
+    return key_error_groups(worker['n'], key, species, rulebook)
+
+def key_error_groups(n, key, species=1, rulebook=None):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList), a voice
+    name or a tuple of two voice names, and an (optional) species and
+    rulebook.
+
+    Returns the errors the rules find in that voice or pair of voices,
+    grouped by rule (see chunking.error_groups()).
+    """
+    error_dict = rulesets[species-1](n, rulebook=rulebook, only_keys=lambda k: k == key)
+    return error_groups(error_dict)
+
+def check_in_groups(composition, species=1, processes=None, rulebook=None):
+    """
+    Takes a mingus.containers.Composition object, and an (optional) species,
+    number of worker processes and rulebook (see rulebook.py).
+
+    Returns a list of errors in the standard format (see errors.py), the
+    same errors, in the same order, that standardize_errors() gives for a
+    whole run of the species function.
+    """
+    n = create_note_lists(composition)
+    error_dict, keys = group_keys(n, species, rulebook)
+    if error_dict.get('cantus_firmus', True) is None:
+        return []
+
+    if processes is not None and processes > 1:
+        for voice in n:
+            n[voice]
+        pool = Pool(processes, start_worker, (n, species, rulebook))
+        try:
+            results = pool.map(check_group, keys, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [key_error_groups(n, key, species, rulebook) for key in keys]
+
+    # each rule's keys go in, in the order the whole run puts them in.
+    for groups in results:
+        for name, key, errors in groups:
+            error_dict[name][key] = errors
+
+    errors = []
+    for name in error_dict:
+        if name in written_errors and callable(written_errors[name]):
+            for key in error_dict[name]:
+                errors.extend(error_dict[name][key])
+    return errors
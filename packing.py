@@ -0,0 +1,342 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import mmap
+import array
+import ctypes
+from multiprocessing import Pool
+from optparse import OptionParser
+from mingus.containers import Note, NoteContainer, Bar, Composition, Track
+from structures import Soprano, Alto, Tenor, Bass
+
+###
+# Packed corpora. Many exercises are stored as a few flat columns of numbers,
+# rather than as mingus objects, so that worker processes can share them
+# instead of being sent a pickled copy of each one. A packed corpus is a dict:
+#
+#     {
+#         'names': list of the exercises' names (usually their MIDI files),
+#         'failed': dict of name => reason it could not be packed,
+#         'note_names': list of note names, indexed by the 'note' column,
+#         'keys': list of key names, indexed by the 'key' column,
+#         columns: sequences of numbers (see columns below)
+#     }
+#
+# Exercise i has the voices from exercise_start[i] to exercise_start[i+1],
+# and voice j has the notes from note_start[j] to note_start[j+1]. The
+# columns are array.array objects while packing, and ctypes arrays over the
+# file when loaded (see load_corpus()), which the operating system shares
+# between processes without copying them.
+###
+
+# (column name, array typecode), in the order they are saved
+columns = [
+    # per exercise, and one past the last
+    ('exercise_start', 'i'),
+    # per voice, and one past the last
+    ('note_start', 'i'),
+    ('voice', 'b'), # index into voices
+    ('key', 'i'), # index into the corpus' key names
+    ('meter_beats', 'i'),
+    ('meter_unit', 'i'),
+    ('bars', 'i'),
+    # per note
+    ('bar', 'i'),
+    ('beat', 'd'),
+    ('duration', 'd'),
+    ('note', 'i'), # index into the corpus' note names, or -1 for a rest
+    ('octave', 'b'),
+]
+
+ctypes_types = {'b': ctypes.c_int8, 'i': ctypes.c_int32, 'I': ctypes.c_uint32, 'd': ctypes.c_double}
+
+voices = [Soprano, Alto, Tenor, Bass]
+voice_names = [voice.name for voice in voices]
+
+file_magic = 'COUNTERPOINT-PACKED-1\n'
+
+def empty_corpus():
+    corpus = {'names': [], 'failed': {}, 'note_names': [], 'keys': []}
+    for column, typecode in columns:
+        corpus[column] = array.array(typecode)
+    corpus['exercise_start'].append(0)
+    corpus['note_start'].append(0)
+    return corpus
+
+def index_of(table, value):
+    # add value to a table of names, if it isn't there yet.
+    if value not in table:
+        table.append(value)
+    return table.index(value)
+
+def exercise_rows(composition):
+    """
+    Takes a mingus.containers.Composition object.
+
+    Returns a list of the tracks that rules can see, each as a tuple of
+    (str: voice name, str: key, (int, int): meter, int: number of bars,
+    list of (bar, beat, duration, note name or None, octave) tuples).
+    Only the first note of each NoteContainer is kept, as with NoteList.
+    """
+    rows = []
+    for track in composition:
+        first_bar = track.bars[0]
+        notes = []
+        for i, bar in enumerate(track.bars):
+            for beat, duration, container in bar:
+                if container is None or len(container) == 0:
+                    notes.append((i, beat, duration, None, 0))
+                else:
+                    notes.append((i, beat, duration, container[0].name, container[0].octave))
+        key = getattr(first_bar.key, 'name', first_bar.key)
+        rows.append((track.name, key, tuple(first_bar.meter), len(track.bars), notes))
+    return rows
+
+def add_exercise(corpus, name, rows):
+    """
+    Takes a packed corpus built with array.array columns (see
+    empty_corpus()), the name of an exercise and its rows (see
+    exercise_rows()), and appends the exercise to the corpus.
+    """
+    for voice_name, key, meter, bar_count, notes in rows:
+        corpus['voice'].append(voice_names.index(voice_name))
+        corpus['key'].append(index_of(corpus['keys'], key))
+        corpus['meter_beats'].append(meter[0])
+        corpus['meter_unit'].append(meter[1])
+        corpus['bars'].append(bar_count)
+        for bar, beat, duration, note_name, octave in notes:
+            corpus['bar'].append(bar)
+            corpus['beat'].append(beat)
+            corpus['duration'].append(duration)
+            if note_name is None:
+                corpus['note'].append(-1)
+            else:
+                corpus['note'].append(index_of(corpus['note_names'], note_name))
+            corpus['octave'].append(octave)
+        corpus['note_start'].append(len(corpus['bar']))
+    corpus['exercise_start'].append(len(corpus['voice']))
+    corpus['names'].append(name)
+
+def pack_midi_file(midi_file):
+    """
+    Takes the name of a MIDI file.
+
+    Returns a tuple of (str: file name, list of rows (see exercise_rows()),
+    or None, str: the reason it couldn't be read, or None). Runs in a worker
+    process, so only plain tuples are sent back.
+    """
+    from counterpoint import setup_midi
+    try:
+        composition, errors = setup_midi(midi_file)
+        if errors:
+            return midi_file, None, '; '.join(errors)
+        return midi_file, exercise_rows(composition), None
+    except Exception, e:
+        return midi_file, None, '%s: %s' % (type(e).__name__, e)
+
+def pack_midi_files(midi_files, jobs=None):
+    """
+    Takes a list of MIDI file names and an (optional) number of worker
+    processes to read them in.
+
+    Returns a packed corpus of the files, in the order given. Files that
+    can't be read are listed under 'failed'.
+    """
+    corpus = empty_corpus()
+    if jobs == 1:
+        results = (pack_midi_file(f) for f in midi_files)
+    else:
+        pool = Pool(jobs)
+        results = pool.imap(pack_midi_file, midi_files)
+
+    for midi_file, rows, reason in results:
+        if rows is None:
+            corpus['failed'][midi_file] = reason
+        else:
+            add_exercise(corpus, midi_file, rows)
+
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    return corpus
+
+def exercise_count(corpus):
+    return len(corpus['names'])
+
+def unpack_rows(corpus, i):
+    """
+    Takes a packed corpus and the index of an exercise in it.
+
+    Returns the exercise's rows (see exercise_rows()), read straight from
+    the columns, without building any mingus objects.
+    """
+    note_start = corpus['note_start']
+    note_names = corpus['note_names']
+    bar, beat, duration = corpus['bar'], corpus['beat'], corpus['duration']
+    note, octave = corpus['note'], corpus['octave']
+
+    rows = []
+    for j in xrange(corpus['exercise_start'][i], corpus['exercise_start'][i+1]):
+        notes = []
+        for k in xrange(note_start[j], note_start[j+1]):
+            if note[k] >= 0:
+                notes.append((bar[k], beat[k], duration[k], note_names[note[k]], octave[k]))
+            else:
+                notes.append((bar[k], beat[k], duration[k], None, 0))
+        rows.append((
+            voice_names[corpus['voice'][j]],
+            corpus['keys'][corpus['key'][j]],
+            (corpus['meter_beats'][j], corpus['meter_unit'][j]),
+            corpus['bars'][j],
+            notes
+        ))
+    return rows
+
+def unpack_exercise(corpus, i):
+    """
+    Takes a packed corpus and the index of an exercise in it.
+
+    Returns the exercise as a mingus.containers.Composition object, with
+    the same bars, notes and rests the rules saw when it was packed.
+    """
+    composition = Composition()
+    composition.set_title('Counterpoint Exercise', '')
+    composition.set_author(corpus['names'][i], '')
+
+    note_start = corpus['note_start']
+    note_names = corpus['note_names']
+    bar, beat, duration = corpus['bar'], corpus['beat'], corpus['duration']
+    note, octave = corpus['note'], corpus['octave']
+
+    for j in xrange(corpus['exercise_start'][i], corpus['exercise_start'][i+1]):
+        voice = voices[corpus['voice'][j]]
+        key = corpus['keys'][corpus['key'][j]]
+        meter = (corpus['meter_beats'][j], corpus['meter_unit'][j])
+
+        track = Track(instrument=voice())
+        track.name = voice.name
+        track.bars = [Bar(key=key, meter=meter) for b in xrange(corpus['bars'][j])]
+        for k in xrange(note_start[j], note_start[j+1]):
+            container = NoteContainer()
+            if note[k] >= 0:
+                container.add_note(Note(note_names[note[k]], octave[k]))
+            # place the note exactly where it was, rather than after the
+            # notes before it, so rests are kept as they were.
+            this_bar = track.bars[bar[k]]
+            this_bar.bar.append([beat[k], duration[k], container])
+            this_bar.current_beat = beat[k] + 1. / duration[k]
+        composition.add_track(track)
+    return composition
+
+def save_columns(file_name, magic, header, columns, data):
+    """
+    Takes the name of a file, a magic first line, a dict of information for
+    the header, a list of (column name, array typecode) tuples and a dict of
+    column name => sequence of numbers.
+
+    Saves the header as JSON, followed by the columns, each aligned to 8
+    bytes, so that load_columns() can map them straight into memory.
+    """
+    header = dict(header, byteorder=sys.byteorder, columns={})
+    offset = 0
+    for column, typecode in columns:
+        length = len(data[column])
+        header['columns'][column] = (offset, length)
+        size = length * ctypes.sizeof(ctypes_types[typecode])
+        offset += size + (-size % 8)
+
+    header_string = json.dumps(header) + '\n'
+    start = len(magic) + len(header_string)
+    padding = -start % 8
+
+    f = open(file_name, 'wb')
+    try:
+        f.write(magic)
+        f.write(header_string)
+        f.write(' ' * padding)
+        for column, typecode in columns:
+            values = data[column]
+            if not isinstance(values, array.array) or values.typecode != typecode:
+                values = array.array(typecode, values)
+            values.tofile(f)
+            size = len(values) * values.itemsize
+            f.write('\0' * (-size % 8))
+    finally:
+        f.close()
+
+def load_columns(file_name, magic, columns):
+    """
+    Takes the name of a file saved by save_columns(), its magic first line
+    and its list of (column name, array typecode) tuples.
+
+    Returns a tuple of (dict: the header, dict of column name => ctypes
+    array mapped from the file). Nothing is read into memory until it is
+    used, and worker processes started afterwards share the same pages.
+    """
+    f = open(file_name, 'rb')
+    try:
+        if f.readline() != magic:
+            raise ValueError('%s is not a %s file' % (file_name, magic.strip()))
+        header = json.loads(f.readline())
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('%s was saved on a machine with a different byte order' % file_name)
+        start = f.tell()
+        start += -start % 8
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    finally:
+        f.close()
+
+    mapped = {'mmap': data}
+    for column, typecode in columns:
+        offset, length = header['columns'][column]
+        mapped[column] = (ctypes_types[typecode] * length).from_buffer(data, start + offset)
+    return header, mapped
+
+def save_corpus(corpus, file_name):
+    """
+    Takes a packed corpus and the name of a file to save it to (see
+    save_columns()).
+    """
+    header = {
+        'names': corpus['names'],
+        'failed': corpus['failed'],
+        'note_names': corpus['note_names'],
+        'keys': corpus['keys'],
+    }
+    save_columns(file_name, file_magic, header, columns, corpus)
+
+def load_corpus(file_name):
+    """
+    Takes the name of a file saved by save_corpus().
+
+    Returns the packed corpus, with its columns mapped from the file rather
+    than read into memory (see load_columns()).
+    """
+    header, corpus = load_columns(file_name, file_magic, columns)
+    corpus.update({
+        'names': header['names'],
+        'failed': header['failed'],
+        'note_names': [str(name) for name in header['note_names']],
+        'keys': [str(key) for key in header['keys']],
+    })
+    return corpus
+
+def main():
+    parser = OptionParser(usage='%prog [options] -o PACKED_FILE MIDI_FILE [MIDI_FILE ...]')
+    parser.add_option('-o', '--output', dest='output', help='Save the packed corpus to PACKED_FILE.', metavar='PACKED_FILE')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Read files in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+
+    options, args = parser.parse_args()
+    if not args or not options.output:
+        parser.error('An output file and at least one MIDI file are required. Use the -h argument to display help.')
+
+    corpus = pack_midi_files(args, options.jobs)
+    save_corpus(corpus, options.output)
+    print '%d exercise(s), %d note(s) packed into %s.' % (exercise_count(corpus), len(corpus['bar']), options.output)
+    for midi_file, reason in sorted(corpus['failed'].items()):
+        print '%s: skipped: %s' % (midi_file, reason)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+from multiprocessing import Pool
+from optparse import OptionParser
+from structures import Soprano, Alto, Tenor, Bass, NoteList
+from errors import emit_errors, get_error_text, error_severities, ErrorStore
+from species import first_species, second_species, third_species, fourth_species
+
+###
+# Ranking many harmonizations of one cantus firmus. The cantus firmus is
+# converted to a NoteList once, and that same NoteList is checked against
+# every candidate, so its intervals, contour and onsets are only computed
+# once, and rules that only look at the cantus firmus are only evaluated
+# once (see evaluate_rules()).
+###
+
+rulesets = [first_species, second_species, third_species, fourth_species]
+
+def error_voices(events):
+    # every voice that the events of an error refer to.
+    voices = set()
+    for event_voices, name, bar, beat in events:
+        if type(event_voices) is tuple:
+            voices.update(event_voices)
+        else:
+            voices.add(event_voices)
+    return voices
+
+def error_score(errors):
+    """
+    Takes a list of errors in the standard format (see errors.py), or an
+    ErrorStore of them.
+
+    Returns the sum of their severities (see errors.error_severities).
+    """
+    if isinstance(errors, ErrorStore):
+        return sum([error_severities.get(errors.error_name(i), 1) for i in range(len(errors))])
+    return sum([error_severities.get(error[-1], 1) for error in errors])
+
+def check_candidate(cantus_list, name, tracks, species=1, rulebook=None, cache=None):
+    """
+    Takes the NoteList of the cantus firmus, the name of a candidate, a list
+    of its mingus.containers.Track objects, and (optional) species, rulebook
+    and cache dict (see evaluate_rules()).
+
+    Returns a tuple:
+    (
+        int: score, or None if the candidate couldn't be checked,
+        str: name,
+        ErrorStore of the candidate's errors (see errors.py), or a list of
+            one message if it couldn't be checked,
+        ErrorStore of errors in the cantus firmus alone
+    )
+    """
+    cantus_voice = cantus_list.track.name
+    n = {cantus_voice: cantus_list}
+    for track in tracks:
+        if track.name != cantus_voice:
+            n[track.name] = NoteList(track)
+
+    # the errors are kept, and sent back from worker processes, for every
+    # candidate, so they are stored compactly, straight from the results of
+    # the rules (see errors.ErrorStore).
+    cantus_only = set([cantus_voice])
+    own_errors = ErrorStore()
+    cantus_errors = ErrorStore()
+    def emit(events, errid, *message):
+        if error_voices(events) == cantus_only:
+            cantus_errors.add(events, errid, *message)
+        else:
+            own_errors.add(events, errid, *message)
+
+    try:
+        if len(n) < 2:
+            raise ValueError('no voices besides the cantus firmus')
+        error_dict = rulesets[species-1](n, cache=cache, rulebook=rulebook)
+        if 'cantus_firmus' in error_dict and error_dict['cantus_firmus'] is None:
+            raise ValueError('the cantus firmus must be all whole notes')
+        emit_errors(error_dict, emit)
+    except Exception, e:
+        return (None, name, ['%s: %s' % (type(e).__name__, e)], [])
+    finally:
+        # views of the cantus firmus with this candidate won't be needed again.
+        cantus_list.forget_pair_views()
+
+    return (error_score(own_errors), name, own_errors, cantus_errors)
+
+# state of each worker process, set up once by start_worker().
+worker = {}
+
+def start_worker(cantus_firmus, species, rulebook):
+    worker['arguments'] = (NoteList(cantus_firmus), species, rulebook)
+    worker['cache'] = {}
+
+def check_in_worker(candidate):
+    cantus_list, species, rulebook = worker['arguments']
+    name, tracks = candidate
+    return check_candidate(cantus_list, name, tracks, species, rulebook, worker['cache'])
+
+def rank_candidates(cantus_firmus, candidates, species=1, rulebook=None, processes=None):
+    """
+    Takes a mingus.containers.Track object for the cantus firmus, a list of
+    (str: name, list of mingus.containers.Track objects) tuples for the
+    candidate voices written against it, and (optional) species, rulebook
+    and number of worker processes.
+
+    Returns a tuple:
+    (
+        ErrorStore of errors in the cantus firmus alone,
+        list of (int: score, str: name, ErrorStore of errors) tuples, best
+            first
+    )
+
+    Each candidate's errors are in the standard format (see errors.py), and
+    leave out the errors in the cantus firmus alone, which every candidate
+    shares. The score is the sum of their severities. A candidate that can't
+    be checked is given a score of None, a list of one message, and is
+    ranked last.
+
+    With more than one process, each process builds the cantus firmus once
+    and checks a share of the candidates.
+    """
+    if processes is not None and processes > 1:
+        pool = Pool(processes, start_worker, (cantus_firmus, species, rulebook))
+        try:
+            results = pool.map(check_in_worker, candidates, max(1, len(candidates) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        cantus_list = NoteList(cantus_firmus)
+        cache = {}
+        results = [
+            check_candidate(cantus_list, name, tracks, species, rulebook, cache)
+            for name, tracks in candidates
+        ]
+
+    cantus_errors = []
+    ranking = []
+    for score, name, errors, candidate_cantus_errors in results:
+        if score is not None and not cantus_errors:
+            cantus_errors = candidate_cantus_errors
+        ranking.append((score, name, errors))
+
+    # rank by score, then by number of errors; failures go last.
+    ranking.sort(key=lambda x: (x[0] is None, x[0], len(x[2]), x[1]))
+    return cantus_errors, ranking
+
+def read_voices(midi_file):
+    """
+    Takes the name of a MIDI file.
+
+    Returns a list of its mingus.containers.Track objects that are named
+    after one of the voices, with the voice set as the track's instrument.
+    """
+    from mingus.midi.MidiFileIn import MIDI_to_Composition
+    composition, bpm = MIDI_to_Composition(midi_file)
+    tracks = []
+    for track in composition:
+        for voice in [Soprano, Alto, Tenor, Bass]:
+            if track.name == voice.name:
+                track.instrument = voice
+                tracks.append(track)
+    return tracks
+
+def main():
+    parser = OptionParser(usage='%prog [options] CANTUS_FIRMUS_FILE CANDIDATE_FILE [CANDIDATE_FILE ...]')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4.', metavar='SPECIES', type='int', default=1)
+    parser.add_option('-v', '--cantus-voice', dest='cantus_voice', help='The track in CANTUS_FIRMUS_FILE to use, if it has more than one. One of Soprano, Alto, Tenor or Bass.', metavar='VOICE')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Check candidates in JOBS worker processes.', metavar='JOBS', type='int', default=1)
+    parser.add_option('-q', '--quiet', action='store_true', dest='quiet', help='Only print the ranking, not each error.')
+
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('A cantus firmus and at least one candidate are required. Use the -h argument to display help.')
+
+    tracks = read_voices(args[0])
+    if options.cantus_voice:
+        tracks = [t for t in tracks if t.name == options.cantus_voice]
+    if len(tracks) != 1:
+        parser.error('%s must have exactly one voice, or use --cantus-voice to choose one.' % args[0])
+
+    candidates = [(midi_file, read_voices(midi_file)) for midi_file in args[1:]]
+    cantus_errors, ranking = rank_candidates(tracks[0], candidates, options.species, processes=options.jobs)
+
+    if cantus_errors:
+        print '%d error(s) in the cantus firmus itself, not counted below.' % len(cantus_errors)
+        print ""
+
+    for rank, (score, name, errors) in enumerate(ranking):
+        if score is None:
+            print '  -  %s: could not be checked: %s' % (name, errors[0])
+            continue
+        print '%3d. %s: score %d, %d error(s)' % (rank + 1, name, score, len(errors))
+        if not options.quiet:
+            for error in errors:
+                print '       ', get_error_text(error)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import subprocess
+from hashlib import sha1
+from optparse import OptionParser
+from distutils.spawn import find_executable
+from multiprocessing.dummy import Pool as ThreadPool
+from mingus.core import value
+from mingus.extra.LilyPond import from_Composition, from_Note, from_NoteContainer
+from errors import jazz_to_classical
+
+# Same header that mingus.extra.LilyPond prepends to every file.
+lilypond_version = '\\version "2.10.33"\n'
+
+def lilypond_string(composition):
+    """
+    Takes a mingus.containers.Composition object.
+
+    Returns the LilyPond string for the composition, as a byte string.
+    This should be generated once per composition and shared by every
+    output that needs it.
+    """
+    string = from_Composition(composition)
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return string
+
+def lilypond_command(lilypond=None):
+    """
+    Takes an (optional) name or path of a lilypond executable.
+    Defaults to the LILYPOND environment variable, then to 'lilypond'.
+
+    Returns the full path of the executable, or None if it can't be found.
+    """
+    if lilypond is None:
+        lilypond = os.environ.get('LILYPOND', 'lilypond')
+    if os.path.isfile(lilypond) and os.access(lilypond, os.X_OK):
+        return lilypond
+    return find_executable(lilypond)
+
+def cached_pngs(key, cache_dir):
+    """
+    Takes a hash of a LilyPond string and a cache directory.
+
+    Returns a sorted list of the PNG files rendered for that string.
+    LilyPond writes KEY.png for a single page, or KEY-page1.png, etc.
+    """
+    return sorted(
+        glob.glob(os.path.join(cache_dir, key + '.png')) +
+        glob.glob(os.path.join(cache_dir, key + '-page*.png'))
+    )
+
+def copy_pngs(pngs, key, png_file):
+    """
+    Copies the rendered pages for key to png_file, keeping LilyPond's
+    page suffixes.
+    """
+    base = png_file
+    if base[-4:] == '.png':
+        base = base[:-4]
+    for png in pngs:
+        suffix = os.path.basename(png)[len(key):]
+        shutil.copyfile(png, base + suffix)
+
+def render_png(string, png_file, cache_dir=None, lilypond=None):
+    """
+    Takes a LilyPond string, the name of a PNG file to write, an (optional)
+    cache directory and an (optional) lilypond executable.
+
+    Returns True if the PNG was written, False otherwise.
+
+    Rendered output is stored in cache_dir keyed by the hash of the string,
+    so the same string is only ever typeset once. If lilypond can't be found
+    a warning is printed and nothing is written.
+    """
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    key = sha1(string).hexdigest()
+
+    if cache_dir is not None:
+        pngs = cached_pngs(key, cache_dir)
+        if pngs:
+            copy_pngs(pngs, key, png_file)
+            return True
+
+    command = lilypond_command(lilypond)
+    if command is None:
+        print >> sys.stderr, 'lilypond not found: could not write %s' % png_file
+        return False
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        ly_file = os.path.join(work_dir, key + '.ly')
+        f = open(ly_file, 'w')
+        f.write(lilypond_version + string)
+        f.close()
+
+        devnull = open(os.devnull, 'w')
+        try:
+            status = subprocess.call(
+                [command, '-fpng', '-o', os.path.join(work_dir, key), ly_file],
+                stdout=devnull, stderr=devnull
+            )
+        finally:
+            devnull.close()
+
+        pngs = cached_pngs(key, work_dir)
+        if status != 0 or not pngs:
+            print >> sys.stderr, 'lilypond failed: could not write %s' % png_file
+            return False
+
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # another worker got there first.
+                    pass
+            for png in pngs:
+                shutil.copy(png, cache_dir)
+        copy_pngs(pngs, key, png_file)
+        return True
+    finally:
+        shutil.rmtree(work_dir, True)
+
+def render_pngs(jobs, cache_dir=None, lilypond=None, workers=4):
+    """
+    Takes a list of (LilyPond string, PNG file name) tuples, an (optional)
+    cache directory, an (optional) lilypond executable and an (optional)
+    number of lilypond processes to run at once.
+
+    Returns a list of Booleans, one per job, in the same order as jobs.
+
+    Each distinct string is typeset once; jobs that share a string are
+    copied from the first rendering. Without a cache_dir, a temporary one
+    is used for the duration of the batch.
+    """
+    temporary_cache = cache_dir is None
+    if temporary_cache:
+        cache_dir = tempfile.mkdtemp()
+
+    try:
+        # typeset each distinct string once, on a bounded pool.
+        keys = []
+        firsts = {}
+        for i, (string, png_file) in enumerate(jobs):
+            if isinstance(string, unicode):
+                string = string.encode('utf-8')
+            keys.append(sha1(string).hexdigest())
+            firsts.setdefault(keys[-1], i)
+        first_jobs = sorted(firsts.values())
+
+        def render(i):
+            string, png_file = jobs[i]
+            return render_png(string, png_file, cache_dir, lilypond)
+
+        if workers <= 1 or len(first_jobs) <= 1:
+            rendered = [render(i) for i in first_jobs]
+        else:
+            pool = ThreadPool(min(workers, len(first_jobs)))
+            try:
+                rendered = pool.map(render, first_jobs)
+            finally:
+                pool.close()
+                pool.join()
+        rendered = dict(zip(first_jobs, rendered))
+
+        # everything else is now in the cache.
+        results = []
+        for i, (string, png_file) in enumerate(jobs):
+            first = firsts[keys[i]]
+            if i == first or not rendered[first]:
+                results.append(rendered[first])
+            else:
+                copy_pngs(cached_pngs(keys[i], cache_dir), keys[i], png_file)
+                results.append(True)
+        return results
+    finally:
+        if temporary_cache:
+            shutil.rmtree(cache_dir, True)
+
+def error_bar_ranges(errors, margin=1, bar_count=None):
+    """
+    Takes a list of errors in the standard format (see errors.py), an
+    (optional) number of bars of context to show around each error, and
+    the (optional) number of bars in the composition.
+
+    Returns a sorted list of (int: first bar #, int: last bar #) tuples.
+    Each range includes both ends, and overlapping or touching ranges are
+    merged into one.
+    """
+    bars = set()
+    for error in errors:
+        for voices, name, bar, beat in error[0]:
+            if bar is not None:
+                bars.add(bar)
+
+    ranges = []
+    for bar in sorted(bars):
+        first = max(0, bar - margin)
+        last = bar + margin
+        if bar_count is not None:
+            last = min(bar_count - 1, last)
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+def error_marks(errors):
+    """
+    Takes a list of errors in the standard format (see errors.py).
+
+    Returns a dict of dicts, of the form:
+        (str: voice, int: bar #) => (float: beat # => list of labels)
+    Errors between two voices mark both voices.
+    """
+    marks = {}
+    for error in errors:
+        for voices, name, bar, beat in error[0]:
+            if bar is None:
+                continue
+            if type(voices) is not tuple:
+                voices = (voices,)
+            label = jazz_to_classical.get(name, name)
+            for voice in voices:
+                labels = marks.setdefault((voice, bar), {}).setdefault(beat, [])
+                if label not in labels:
+                    labels.append(label)
+    return marks
+
+def from_annotated_Bar(bar, bar_no, voice, marks, showkey=False, showtime=False):
+    """
+    Takes a mingus.containers.Bar object, its 0 offset bar number, the name
+    of its voice, a dict of the form returned by error_marks(), and
+    (optional) Booleans for showing the key and the time.
+
+    Returns the LilyPond equivalent of the bar in a string, as
+    mingus.extra.LilyPond.from_Bar() does, with each note that is playing
+    at a marked beat coloured and labelled.
+    """
+    # find the labels for each entry in the bar.
+    labels = {}
+    for beat, mark_labels in marks.get((voice, bar_no), {}).items():
+        for i, (start, duration, nc) in enumerate(bar.bar):
+            if start <= beat < start + 1./duration:
+                labels.setdefault(i, []).extend(mark_labels)
+                break
+
+    if showkey:
+        result = "\\key %s \\major " % from_Note(bar.key, False)
+    else:
+        result = ""
+
+    latest_ratio = (1, 1)
+    ratio_has_changed = False
+    for i, (start, duration, nc) in enumerate(bar.bar):
+        entry = from_NoteContainer(nc, duration)
+        if i in labels:
+            entry = "\\once \\override NoteHead #'color = #red %s^\\markup { \\small \"%s\" }" % \
+                (entry, ', '.join(labels[i]))
+        ratio = value.determine(duration)[2:]
+        if ratio != latest_ratio:
+            if ratio_has_changed:
+                result += "}"
+            result += "\\times %d/%d {" % (ratio[1], ratio[0])
+            latest_ratio = ratio
+            ratio_has_changed = True
+        result += entry + " "
+    if ratio_has_changed:
+        result += "}"
+
+    if showtime:
+        return "{ \\time %d/%d %s}" % (bar.meter[0], bar.meter[1], result)
+    return "{ %s}" % result
+
+def error_lilypond_string(composition, errors, margin=1):
+    """
+    Takes a mingus.containers.Composition object, a list of errors in the
+    standard format (see errors.py) and an (optional) number of bars of
+    context to show around each error.
+
+    Returns a LilyPond string of only the bars around the errors, with the
+    offending notes coloured and labelled. Only the bars that are shown are
+    visited, so this takes time proportional to the number of errors rather
+    than the length of the composition.
+    """
+    tracks = [
+        track for track in composition.tracks
+        if [bar for bar in track.bars if bar]
+    ]
+    bar_count = max([len(track.bars) for track in tracks] + [0])
+    ranges = error_bar_ranges(errors, margin, bar_count)
+    marks = error_marks(errors)
+
+    result = '\\header { title = "%s" composer = "%s" opus = "%s" } ' \
+        % (composition.title, composition.author, composition.subtitle)
+    result += '\\new StaffGroup << '
+    for track in tracks:
+        clef = ''
+        if track.instrument is not None:
+            clef = '\\clef %s ' % track.instrument.clef
+        bars = []
+        for first, last in ranges:
+            if bars:
+                bars.append('\\bar "||"')
+            bars.append('\\set Score.currentBarNumber = #%d' % (first + 1))
+            for i in range(first, min(last + 1, len(track.bars))):
+                bars.append(from_annotated_Bar(
+                    track.bars[i], i, track.name, marks,
+                    showkey = i == first,
+                    showtime = i == first
+                ) + ' \\bar "|"')
+        result += '\\new Staff { %s%s } ' % (clef, ' '.join(bars))
+    result += '>>'
+
+    if isinstance(result, unicode):
+        result = result.encode('utf-8')
+    return result
+
+###
+# Checking render_pngs() without lilypond. A stub executable stands in for
+# lilypond: it writes a one page PNG for each file it is given, and logs each
+# run with the number of runs under way when it started, so the checks can
+# see how often, and how many at once, lilypond would have been run.
+###
+
+stub_script = '''#!/bin/sh
+# called as: lilypond -fpng -o OUTPUT_BASE LY_FILE
+touch "%(directory)s/running-$$"
+echo "$(ls "%(directory)s" | grep -c '^running-') $4" >> "%(directory)s/runs.log"
+sleep 0.2
+rm -f "%(directory)s/running-$$"
+if [ -n "%(fail)s" ]; then exit 1; fi
+echo PNG > "$3.png"
+'''
+
+def stub_lilypond(directory, fail=False):
+    """
+    Takes a directory, and whether the stub should fail (optional).
+
+    Writes a stub lilypond executable into the directory, as described
+    above, and returns its path. A failing stub exits with status 1 and
+    writes nothing.
+    """
+    stub = os.path.join(directory, 'lilypond')
+    f = open(stub, 'w')
+    f.write(stub_script % {'directory': directory, 'fail': fail and 'fail' or ''})
+    f.close()
+    os.chmod(stub, 0755)
+    return stub
+
+def stub_runs(directory):
+    # the number of runs under way as each run started.
+    log = os.path.join(directory, 'runs.log')
+    if not os.path.isfile(log):
+        return []
+    return [int(line.split()[0]) for line in open(log)]
+
+def check_render_pngs(directory, workers=2):
+    """
+    Takes a directory to work in, and an (optional) number of lilypond
+    processes to run at once.
+
+    Runs render_pngs() against stub lilypond executables, and prints whether
+    each check passed.
+
+    Returns the number of checks that failed.
+    """
+    stub_dir = os.path.join(directory, 'stub')
+    failing_dir = os.path.join(directory, 'failing')
+    out_dir = os.path.join(directory, 'out')
+    cache_dir = os.path.join(directory, 'cache')
+    for d in [stub_dir, failing_dir, out_dir]:
+        os.makedirs(d)
+    stub = stub_lilypond(stub_dir)
+    failing = stub_lilypond(failing_dir, fail=True)
+
+    strings = ['{ c } ', '{ d } ', '{ c } ', u'{ e } ', '{ d } ', '{ f } ']
+    jobs = [
+        (string, os.path.join(out_dir, '%d.png' % i))
+        for i, string in enumerate(strings)
+    ]
+    written = lambda: [os.path.isfile(png_file) for string, png_file in jobs]
+    def clear():
+        for string, png_file in jobs:
+            if os.path.isfile(png_file):
+                os.remove(png_file)
+
+    checks = []
+    results = render_pngs(jobs, lilypond=stub, workers=workers)
+    checks.append(('every job is written', results == [True] * len(jobs) and all(written())))
+    runs = stub_runs(stub_dir)
+    checks.append(('each distinct string is typeset once', len(runs) == 4))
+    checks.append(('at most %d lilypond processes run at once' % workers, runs and max(runs) <= workers))
+
+    clear()
+    render_pngs(jobs, cache_dir, lilypond=stub, workers=workers)
+    clear()
+    results = render_pngs(jobs, cache_dir, lilypond=stub, workers=workers)
+    checks.append(('a cached string is copied, not typeset again', len(stub_runs(stub_dir)) == 8 and results == [True] * len(jobs) and all(written())))
+
+    clear()
+    results = render_pngs(jobs, lilypond=failing, workers=workers)
+    checks.append(('a failed typesetting writes nothing', results == [False] * len(jobs) and not any(written())))
+
+    results = render_pngs(jobs, lilypond=os.path.join(directory, 'missing'), workers=workers)
+    checks.append(('a missing lilypond writes nothing', results == [False] * len(jobs) and not any(written())))
+
+    failures = 0
+    for check, passed in checks:
+        print '%s: %s' % (check, passed and 'ok' or 'FAILED')
+        failures += not passed
+    return failures
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Run JOBS stub lilypond processes at once. Defaults to 2.', metavar='JOBS', type='int', default=2)
+
+    options, args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='rendering-')
+    try:
+        failures = check_render_pngs(directory, options.jobs)
+    finally:
+        shutil.rmtree(directory)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
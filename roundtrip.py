@@ -0,0 +1,121 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+from itertools import izip_longest
+from optparse import OptionParser
+from packing import exercise_rows
+from exporting import write_composition
+from equivalence import generated_exercises, stored_exercises
+
+###
+# Round trip testing of the MIDI files exporting.py writes. Each exercise is
+# written with exporting.write_composition(), read back with
+# counterpoint.setup_midi(), the reader the program itself uses, and the
+# notes the rules would see in it (see packing.exercise_rows()) compared
+# with the ones that were written: every voice's name, key, meter and
+# number of bars, and every note and rest, where it starts and how long it
+# lasts.
+#
+# The reader adds an empty bar after a track whose last note ends on a
+# barline, as every exercise's does. Bars read back after the last one
+# written don't count, as long as there is nothing in them.
+###
+
+def round_trip(composition, file_name):
+    """
+    Takes a mingus.containers.Composition object and the name of a file to
+    write it to.
+
+    Returns a tuple of (the rows written, the rows read back, list of
+    errors from reading the file). See packing.exercise_rows().
+    """
+    from counterpoint import setup_midi
+    write_composition(file_name, composition)
+    read, errors = setup_midi(file_name)
+    return exercise_rows(composition), exercise_rows(read), errors
+
+def row_differences(written, read):
+    """
+    Takes the rows written and the rows read back (see round_trip()).
+
+    Returns a list of strings, each describing a difference between them,
+    for each voice up to its first note that differs. Empty bars read back
+    after the last bar written are ignored.
+    """
+    if [row[0] for row in written] != [row[0] for row in read]:
+        return ['voices %s read back as %s' % (
+            ', '.join([row[0] for row in written]), ', '.join([row[0] for row in read]))]
+
+    differences = []
+    for (name, key, meter, bars, notes), (_, read_key, read_meter, read_bars, read_notes) in zip(written, read):
+        if read_bars > bars and not [note for note in read_notes if note[0] >= bars]:
+            read_bars = bars
+        if (key, meter, bars) != (read_key, read_meter, read_bars):
+            differences.append('%s: key %s, meter %s, %d bars read back as key %s, meter %s, %d bars' % (
+                name, key, meter, bars, read_key, read_meter, read_bars))
+        for i, (note, read_note) in enumerate(izip_longest(notes, read_notes)):
+            if note != read_note:
+                differences.append('%s: note %d %r read back as %r' % (name, i, note, read_note))
+                break
+    return differences
+
+def compare_round_trips(exercises, directory, out=sys.stdout):
+    """
+    Takes a list of (str: name, mingus.containers.Composition, int: species)
+    tuples, a directory to write the files in, and an (optional) file to
+    print to.
+
+    Prints any exercise that doesn't read back as it was written, and a
+    summary.
+
+    Returns the number of exercises that didn't.
+    """
+    failures = 0
+    for i, (name, composition, species) in enumerate(exercises):
+        file_name = os.path.join(directory, '%05d.mid' % i)
+        try:
+            written, read, errors = round_trip(composition, file_name)
+            differences = errors + row_differences(written, read)
+        except Exception, e:
+            differences = ['%s: %s' % (type(e).__name__, e)]
+        if differences:
+            failures += 1
+            print >> out, 'CHANGED: %s (%s)' % (name, file_name)
+            for difference in differences:
+                print >> out, '    %s' % difference
+    print >> out, '%d exercise(s), %d changed by the round trip.' % (len(exercises), failures)
+    return failures
+
+def main():
+    parser = OptionParser(usage='%prog [options] [MIDI_FILE ...]')
+    parser.add_option('-g', '--generate', dest='generate', help='Also write and read back COUNT generated exercises. Defaults to 100.', metavar='COUNT', type='int', default=100)
+    parser.add_option('--seed', dest='seed', help='Random seed for the generated exercises.', metavar='SEED', type='int', default=0)
+    parser.add_option('-t', action='store_true', dest='from_tracks', help='Also write and read back the music in tracks.py.')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4. Limits the generated exercises to one species.', metavar='SPECIES', type='int')
+    parser.add_option('-k', '--keep', dest='keep', help='Write the files into DIRECTORY, and keep them. By default they are written to a temporary directory, and removed.', metavar='DIRECTORY')
+
+    options, args = parser.parse_args()
+    exercises = generated_exercises(options.generate, options.seed, options.species)
+    if args or options.from_tracks:
+        exercises.extend(stored_exercises(args, options.species or 1, options.from_tracks))
+
+    if options.keep:
+        directory = options.keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    else:
+        directory = tempfile.mkdtemp(prefix='roundtrip-')
+    try:
+        failures = compare_round_trips(exercises, directory)
+    finally:
+        if not options.keep:
+            shutil.rmtree(directory)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+
+###
+# Rule parameters. Instructors disagree about which intervals are allowed, so
+# the lists the rules check against can be loaded from a rulebook file. A
+# rulebook file is a JSON object with any of the keys in default_parameters;
+# anything left out keeps its default value. For example:
+#
+#     {
+#         "illegal_direct_intervals": ["5", "1", "8"],
+#         "max_consecutive_parallel": 2
+#     }
+#
+# Intervals are named as in mingus' shorthand ('b3', '5', etc.) without
+# octaves, as returned by get_interval().
+###
+
+default_parameters = {
+    # intervals that may be repeated in parallel.
+    'allowed_parallel_intervals': ['3', '6'],
+    # the number of times any one interval may be repeated consecutively.
+    'max_consecutive_parallel': 3,
+    # consonant vertical intervals.
+    'allowed_vertical_intervals': ['1', 'b3', '3', '4', '5', 'b6', '6'],
+    # melodic intervals between consecutive notes.
+    'allowed_movements': ['1', 'b2', '2', 'b3', '3', '4', '5', 'b6', '6'],
+    # melodic intervals outlined between turning points, or strong beats.
+    'allowed_indirect_intervals': ['1', 'b2', '2', 'b3', '3', '4', '5', 'b6', '6'],
+    # intervals that may not be approached by similar motion.
+    'illegal_direct_intervals': ['5', '1'],
+    # the number of times a chain of suspensions may be broken.
+    'max_suspension_breaks': 2,
+}
+
+def compile_rulebook(parameters, name='default'):
+    """
+    Takes a dict of rule parameters (see default_parameters) and an
+    (optional) name.
+
+    Returns a dict of the same parameters, ready for the rules to use:
+    lists of intervals are converted to frozensets, so each check takes
+    constant time, and missing parameters are filled in with their defaults.
+    The name is kept under the 'name' key.
+
+    Raises ValueError if a parameter is unknown, or of the wrong type.
+    """
+    rulebook = {'name': name}
+    for key, value in default_parameters.items():
+        value = parameters.get(key, value)
+        if type(default_parameters[key]) is list:
+            if not isinstance(value, (list, tuple)):
+                raise ValueError('Rulebook parameter "%s" must be a list of intervals' % key)
+            value = frozenset([str(interval) for interval in value])
+        elif not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError('Rulebook parameter "%s" must be an integer' % key)
+        rulebook[key] = value
+
+    unknown = [key for key in parameters if key not in default_parameters]
+    if unknown:
+        raise ValueError('Unknown rulebook parameter(s): %s' % ', '.join(sorted(unknown)))
+    return rulebook
+
+def load_rulebook(file_name):
+    """
+    Takes the name of a rulebook file.
+
+    Returns the compiled rulebook (see compile_rulebook()), named after the
+    file.
+    """
+    f = open(file_name)
+    try:
+        parameters = json.load(f)
+    finally:
+        f.close()
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    return compile_rulebook(parameters, name)
+
+default_rulebook = compile_rulebook(default_parameters)
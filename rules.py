@@ -3,7 +3,9 @@
 from mingus.core import intervals as mintervals
 from mingus.containers import Note
 from mingus.core.diatonic import get_notes
-from structures import create_note_lists
+from collections import deque
+from structures import NoteLists, create_note_lists, downbeat, weak_beat
+from rulebook import default_rulebook
 from views import *
 
 
@@ -17,20 +19,61 @@ def all_notes_line_up(a_list, b_list):
     a_list = [x for x in a_list if not x.is_rest] # copy NoteList to list
     b_list = [x for x in b_list if not x.is_rest] # copy NoteList to list
 
-    # remove matched notes
-    for a_note in a_list[:]:
-        for b_note in b_list[:]:
-            if (a_note.start, a_note.end) == (b_note.start, b_note.end):
-                # remove the matched pair from their respective lists
-                a_list.remove(a_note)
-                b_list.remove(b_note)
-                break
+    # index the b_list notes by their (start, end) times
+    b_times = {}
+    for i, b_note in enumerate(b_list):
+        b_times.setdefault((b_note.start, b_note.end), deque()).append(i)
+
+    # match each a_list note with the first unmatched b_list note that has
+    # the same times.
+    a_unmatched = []
+    b_matched = set()
+    for a_note in a_list:
+        candidates = b_times.get((a_note.start, a_note.end))
+        if candidates:
+            b_matched.add(candidates.popleft())
+        else:
+            a_unmatched.append(a_note)
 
-    return a_list, b_list
+    b_unmatched = [b for i, b in enumerate(b_list) if i not in b_matched]
+    return a_unmatched, b_unmatched
 
-def illegal_parallel_intervals(a_list, b_list):
+def illegal_parallel_runs(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes two NoteList objects.
+    Takes two NoteList objects, and an (optional) rulebook.
+
+    Returns a tuple of three lists, each in the format returned by
+    parallel_motion() above:
+    (
+        illegal sets of parallel intervals (see illegal_parallel_intervals()),
+        sets of parallel intervals that repeat too many times
+            (see illegal_consecutive_parallels()),
+        all sets of parallel intervals between consecutive downbeats
+    )
+
+    All three are found in a single pass over the intervals between the
+    two voices.
+    """
+    allowed_parallel_intervals = rulebook['allowed_parallel_intervals']
+    max_consecutive_parallel = rulebook['max_consecutive_parallel']
+
+    illegal = []
+    consecutive = []
+    downbeat = []
+    for downbeats_only, run in parallel_runs(a_list, b_list):
+        if downbeats_only:
+            downbeat.append(run)
+            continue
+        if run[0][0][0] not in allowed_parallel_intervals:
+            illegal.append(run)
+        if len(run) > max_consecutive_parallel:
+            consecutive.append(run)
+
+    return illegal, consecutive, downbeat
+
+def illegal_parallel_intervals(a_list, b_list, rulebook=default_rulebook):
+    """
+    Takes two NoteList objects, and an (optional) rulebook.
 
     Return format is identical to parallel_motion() above.
     Sub-lists here will only contain illegal sets of parallel intervals,
@@ -39,17 +82,11 @@ def illegal_parallel_intervals(a_list, b_list):
     From the rules of first species counterpoint:
         Only 3rds and 6ths (and their octaves) may be repeated.
     """
-    allowed_parallel_intervals = ['3', '6']
-    consecutives = parallel_motion(a_list, b_list)
-
-    return [
-        c for c in consecutives
-        if c[0][0][0] not in allowed_parallel_intervals
-    ]
+    return illegal_parallel_runs(a_list, b_list, rulebook)[0]
 
-def illegal_consecutive_parallels(a_list, b_list):
+def illegal_consecutive_parallels(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes two NoteList objects.
+    Takes two NoteList objects, and an (optional) rulebook.
 
     Return format is identical to parallel_motion() above.
     Sub-lists here will only contain illegal sets of parallel intervals,
@@ -58,10 +95,7 @@ def illegal_consecutive_parallels(a_list, b_list):
     From the rules of first species counterpoint:
         Any one interval may be repeated a maximum of three times consecutively.
     """
-    max_consecutive_parallel = 3
-    consecutives = parallel_motion(a_list, b_list)
-
-    return [c for c in consecutives if len(c) > max_consecutive_parallel]
+    return illegal_parallel_runs(a_list, b_list, rulebook)[1]
 
 def coincident_maxima(a_list, b_list):
     """
@@ -72,7 +106,7 @@ def coincident_maxima(a_list, b_list):
     in both provided NoteList melodies, however.
     """
     a_maxima = local_maxima(a_list)
-    b_maxima = local_maxima(b_list)
+    b_maxima = set(local_maxima(b_list))
 
     return [x for x in a_maxima if x in b_maxima]
 
@@ -92,8 +126,10 @@ def voice_crossing(b_list, a_list, note_spacing=2, note_filter_fn=None):
 
     Returns a list of tuples, each of the form:
         (NoteNode, NoteNode)
+    in order of the earlier of the two notes.
     """
     crossings = []
+    seen = set() # (id(c), id(d)) for each (c, d) in crossings
 
     def f_v_c(c_list, d_list, comparator):
         c_notes = [c for c in c_list]
@@ -114,54 +150,188 @@ def voice_crossing(b_list, a_list, note_spacing=2, note_filter_fn=None):
                 if c is None or d is None or c.is_rest or d.is_rest:
                     continue
                 if comparator(int(c), int(d)):
-                    if (d, c) not in crossings:
+                    if (id(d), id(c)) not in seen:
+                        seen.add((id(c), id(d)))
                         crossings.append((c, d))
 
     f_v_c(a_list, b_list, lambda a,b: a >= b)
     f_v_c(b_list, a_list, lambda a,b: a <= b)
+    # in order of time, like the other rules, rather than of the passes
+    # above, so a piece checked in chunks gives them in the same order (see
+    # chunking.py).
+    crossings.sort(key=lambda pair: min([(note.bar, note.beat) for note in pair]))
     return crossings
 
-def illegal_vertical_intervals(a_list, b_list):
+def illegal_vertical_intervals(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes two NoteList objects.
+    Takes two NoteList objects, and an (optional) rulebook.
 
     Return format is identical to vertical_intervals() above.
 
     Returned tuples here, however, will only represent intervals that are
-    not explicitly allowed by the allowed_intervals list.
+    not explicitly allowed by the rulebook's allowed_vertical_intervals.
     """
-    allowed_intervals = ['1', 'b3', '3', '4', '5', 'b6', '6']
+    allowed_intervals = rulebook['allowed_vertical_intervals']
     pairs = vertical_intervals(a_list, b_list)
     return [(i, t) for i, t in pairs if i[0] not in allowed_intervals]
 
-def illegal_horizontal_intervals(a_list):
+def illegal_third_species_dissonances(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes a single NoteList object.
+    Takes two NoteList objects, and an (optional) rulebook.
+
+    Returns a tuple of two lists, each in the format returned by
+    vertical_intervals() above:
+    (
+        dissonant intervals on downbeats,
+        dissonant intervals off the downbeat that are not explained by a
+            passing tone, a neighbour tone or a cambiata
+    )
+
+    From the rules of third species counterpoint:
+        The first note of each bar must be consonant.
+        Other notes may be dissonant if they are passing tones, neighbour
+        tones, or the second note of a cambiata.
+
+    Rests are ignored. Each onset is only compared with its neighbouring
+    notes, so this takes linear time.
+    """
+    allowed_intervals = rulebook['allowed_vertical_intervals']
+
+    strong = []
+    weak = []
+    for interval, time in iter_vertical_intervals(a_list, b_list):
+        if interval[0] in allowed_intervals or interval[0] == ' ':
+            continue
+        if a_list.beat_strength(*time) == downbeat:
+            strong.append((interval, time))
+            continue
+
+        # find the note that moved into the dissonance.
+        moved = [
+            note for note in (a_list.get(*time), b_list.get(*time))
+            if note is not None and not note.is_rest
+        ]
+        if len(moved) != 1 or non_harmonic_tone(moved[0]) is None:
+            weak.append((interval, time))
+
+    return strong, weak
+
+def illegal_fourth_species_suspensions(a_list, b_list, rulebook=default_rulebook):
+    """
+    Takes two NoteList objects, and an (optional) rulebook.
+
+    Returns a tuple of three lists, each in the format returned by
+    vertical_intervals() above:
+    (
+        dissonant intervals on downbeats that are not suspensions,
+        suspensions that were not prepared by a consonance,
+        suspensions that do not resolve down by step to a consonance
+    )
+
+    From the rules of fourth species counterpoint:
+        Dissonances are okay on downbeats if the downbeat is tied from a
+        consonant interval before it, and the dissonance is resolved
+        downward by step on the next note, to a consonant interval.
+
+    Ties are looked up in the tie runs built with each NoteList, so each
+    suspension is classified in constant time.
+    """
+    allowed_intervals = rulebook['allowed_vertical_intervals']
+
+    def is_consonant(note, other_list):
+        other = other_list.get_note_playing_at(*note.start)
+        if other is None or other.is_rest:
+            return True
+        return get_interval(note, other)[0] in allowed_intervals
+
+    unsuspended = []
+    unprepared = []
+    unresolved = []
+    for interval, time in iter_vertical_intervals(a_list, b_list):
+        if a_list.beat_strength(*time) != downbeat:
+            continue
+        if interval[0] in allowed_intervals or interval[0] == ' ':
+            continue
+
+        # find the voice that holds the suspension.
+        suspended = None
+        for c_list, d_list in [(a_list, b_list), (b_list, a_list)]:
+            note = c_list.get(*time)
+            if note is not None and note.is_tied:
+                suspended = note, d_list
+                break
+
+        if suspended is None:
+            unsuspended.append((interval, time))
+            continue
+
+        note, other_list = suspended
+        if not is_consonant(note.tie_run[0], other_list):
+            unprepared.append((interval, time))
+
+        resolution = note.tie_run[-1].next_actual_note
+        if resolution is None \
+                or cmp(int(resolution), int(note)) != -1 \
+                or get_semitones(get_interval(note, resolution)) > 2 \
+                or not is_consonant(resolution, other_list):
+            unresolved.append((interval, time))
+
+    return unsuspended, unprepared, unresolved
+
+def broken_suspension_chains(a_list, rulebook=default_rulebook):
+    """
+    Takes a single NoteList object, and an (optional) rulebook.
+
+    Returns a list of NoteNode objects that break the chain of suspensions
+    when they should not.
+
+    From the rules of fourth species counterpoint:
+        All half-notes starting on strong beats must be tied from the
+        previous note. The chain may be broken twice, but not in
+        consecutive bars.
+
+    The first note of the melody and the final note are not considered.
+    """
+    max_breaks = rulebook['max_suspension_breaks']
+
+    breaks = []
+    errors = []
+    for note in a_list[1:-1]:
+        if note.is_rest or note.strength != downbeat or note.is_tied:
+            continue
+        if len(breaks) >= max_breaks or (breaks and breaks[-1].bar == note.bar - 1):
+            errors.append(note)
+        breaks.append(note)
+    return errors
+
+def illegal_horizontal_intervals(a_list, rulebook=default_rulebook):
+    """
+    Takes a single NoteList object, and an (optional) rulebook.
 
     Return format is identical to horizontal_intervals() above.
 
     Returned tuples here will only represent those intervals that are not
-    explicitly allowed by the allowed_movements list below.
+    explicitly allowed by the rulebook's allowed_movements.
     """
-    allowed_movements = ['1', 'b2', '2', 'b3', '3', '4', '5', 'b6', '6']
+    allowed_movements = rulebook['allowed_movements']
     intervals = horizontal_intervals(a_list)
     return [(i, a_list[x+1]) for x,i in enumerate(intervals) if i[0] not in allowed_movements]
 
-def illegal_indirect_horizontal_intervals(a_list):
+def illegal_indirect_horizontal_intervals(a_list, rulebook=default_rulebook):
     """
-    Takes a single NoteList object.
+    Takes a single NoteList object, and an (optional) rulebook.
 
     Return format is identical to indirect_horizontal_intervals() above.
 
     Intervals represented here, however, are only those that are not
-    explicitly allowed by the allowed_intervals list below.
+    explicitly allowed by the rulebook's allowed_indirect_intervals.
     """
-    allowed_intervals = ['1', 'b2', '2', 'b3', '3', '4', '5', 'b6', '6']
+    allowed_intervals = rulebook['allowed_indirect_intervals']
     intervals = indirect_horizontal_intervals(a_list)
     return [x for x in intervals if x[0][0] not in allowed_intervals]
 
-def illegal_strong_beat_horizontal_intervals(a_list):
-    allowed_intervals = ['1', 'b2', '2', 'b3', '3', '4', '5', 'b6', '6']
+def illegal_strong_beat_horizontal_intervals(a_list, rulebook=default_rulebook):
+    allowed_intervals = rulebook['allowed_indirect_intervals']
     intervals = strong_beat_horizontal_intervals(a_list)
     return [x for x in intervals if x[0][0] not in allowed_intervals]
 
@@ -177,56 +347,31 @@ def missed_leap_turnarounds(a_list):
     direction.
     """
     # immediately after a leap of (P5, m6, M6, P8), must move by step (m2, M2)
-    # in opposite direction
-    largest_leap_without_turnaround = 6 # semitones
-
-    # get horizontal intervals as semitones
-    h_i_semitones = [get_semitones(x) for x in horizontal_intervals(a_list)]
-
-    # get list of directions for each interval
-    dirs = directions(a_list)
-
-    # figure out if the next movement after this one is a step in the opposite direction
-    def turns_around_after(i):
-        # is this the last interval?
-        leap_dir, leap_time = dirs[i+1]
-        leap_int = h_i_semitones[i]
-
-        while i < len(h_i_semitones):
-            i += 1
-
-            next_dir, next_time = dirs[i+1]
-            next_int = h_i_semitones[i]
-
-            if next_int == 0: # doesn't move yet?
-                continue
-            elif next_dir == -leap_dir and next_int <= 2: # moves by step in opposite dir?
-                return True
-            else: # doesn't move by step in opposite dir :(
-                return False
-        return False
-
-    # find all intervals that qualify as a leap
-    invalid_leaps = [i for i,interval in enumerate(h_i_semitones)
-               if interval > largest_leap_without_turnaround
-               and not turns_around_after(i)]
+    # in opposite direction. These are melodic_contour()'s defaults, which
+    # the other views take it with, so every voice's contour is only walked
+    # once.
+    extremities, leaps = melodic_contour(a_list)
 
     # return a list of the beats (notes) that have the leaped-to note
     # the note following these ones need to move in opposite direction by step
-    return [dirs[i+1][1] for i in invalid_leaps]
+    return [
+        leap_to.start
+        for interval, leap_from, leap_to, turned_around in leaps
+        if not turned_around
+    ]
 
-def illegal_direct_motion(a_list, b_list):
+def illegal_direct_motion(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes two NoteList objects.
+    Takes two NoteList objects, and an (optional) rulebook.
 
     Return format is identical to vertical_intervals() above.
 
     Intervals returned here, however, only represent intervals explicitly
-    defined in the illegal_direct_intervals list below, which have been
+    defined in the rulebook's illegal_direct_intervals, which have been
     approached through similar motion (ie. both voices moving in the same
     direction)
     """
-    illegal_direct_intervals = ['5', '1']
+    illegal_direct_intervals = rulebook['illegal_direct_intervals']
     illegal_direct_motions = []
     direct_motions = direct_motion(a_list, b_list)
 
@@ -307,9 +452,9 @@ def accidentals(a_list):
         and not note.is_rest
     ]
 
-def legal_dissonances(a_list, b_list):
+def legal_dissonances(a_list, b_list, rulebook=default_rulebook):
     """
-    Takes two NoteList objects.
+    Takes two NoteList objects, and an (optional) rulebook.
 
     Return format is identical to vertical_intervals() above.
 
@@ -328,6 +473,12 @@ def legal_dissonances(a_list, b_list):
         a_note = a_list.get(*t)
         b_note = b_list.get(*t)
 
+        # a note at the very start or end of the music can't be approached
+        # or left by step.
+        for note in [a_note, b_note]:
+            if note is not None and (note.prev is None or note.next is None):
+                return False
+
         if a_note is not None and b_note is not None:
             # both voices moved at the same time to get into the dissonance.
             # that means neither is cf, so both must leave by step
@@ -355,9 +506,9 @@ def legal_dissonances(a_list, b_list):
             movements
         ))
 
-    allowed_intervals = ['1', 'b3', '3', '4', '5', 'b6', '6']
+    allowed_intervals = rulebook['allowed_vertical_intervals']
     pairs = vertical_intervals(a_list, b_list)
-    weak_intervals = [(i, t) for i, t in pairs if t[1] == 0.5]
+    weak_intervals = [(i, t) for i, t in pairs if a_list.beat_strength(*t) == weak_beat]
     weak_dissonances = [(i, t) for i, t in weak_intervals if i[0] not in allowed_intervals]
     safe_dissonances = [
         x for x in weak_dissonances
@@ -366,11 +517,14 @@ def legal_dissonances(a_list, b_list):
     return safe_dissonances
 
 
-def get_and_split_note_lists(composition):
+def get_and_split_voices(composition):
     """
-    Takes a mingus.containers.Composition object.
+    Takes a mingus.containers.Composition object, or a dict of NoteLists
+    that have already been built (key => track name; value => NoteList).
 
-    Converts the Composition to a categorized set of NoteLists.
+    Converts the Composition to a categorized set of voices, without
+    building any of their NoteLists: each is built when a rule first looks
+    it up (see structures.NoteLists).
 
     Assumes that composition will have Soprano, Alto, Tenor, Bass tracks.
     Also assumes that at least two of these tracks have content.
@@ -379,38 +533,44 @@ def get_and_split_note_lists(composition):
     Returns a tuple:
     (
         dict of all voices (key => track name; value => NoteList),
-        NoteList that represents the high voice,
-        NoteList that represents the low voice,
-        List of NoteLists that represent the inner voices,
+        name of the high voice,
+        name of the low voice,
+        List of the names of the inner voices,
         List of all possible combinations of voices, each represented by a tuple (a, b)
     )
     """
-    lists = create_note_lists(composition)
-
-    # create a dict of all tracks with notes in them
-    n = {}
-    for voice in lists:
-        if len(lists[voice]):
-            n[voice] = lists[voice]
+    if isinstance(composition, NoteLists):
+        n = composition.with_notes()
+    elif isinstance(composition, dict):
+        # create a dict of all tracks with notes in them
+        n = {}
+        for voice in composition:
+            if len(composition[voice]):
+                n[voice] = composition[voice]
+    else:
+        n = create_note_lists(composition).with_notes()
 
-    descending_voices = [x for x in ['Soprano', 'Alto', 'Tenor', 'Bass'] if x in n]
-    ascending_voices = [x for x in['Bass', 'Tenor', 'Alto', 'Soprano'] if x in n]
+    # the voices' names are taken from n, as their tracks are named (maybe
+    # in unicode), so that every key a rule is given is named alike.
+    voice_order = ['Soprano', 'Alto', 'Tenor', 'Bass']
+    descending_voices = sorted([x for x in n if x in voice_order], key=voice_order.index)
+    ascending_voices = descending_voices[::-1]
 
     # find the high voice
     for voice in descending_voices:
-        high_voice = n[voice]
+        high_voice = voice
         break
 
     # find the low voice
     for voice in ascending_voices:
-        low_voice = n[voice]
+        low_voice = voice
         break
 
     # find the inner voices
     inner_voices = []
-    for voice in ['Tenor', 'Alto']:
-        if voice in n and n[voice] not in [high_voice, low_voice]:
-            inner_voices.append(n[voice])
+    for voice in ascending_voices:
+        if voice in ['Tenor', 'Alto'] and voice not in [high_voice, low_voice]:
+            inner_voices.append(voice)
 
     # find all possible combinations of voices
     voice_combos = []
@@ -420,3 +580,25 @@ def get_and_split_note_lists(composition):
 
     return n, high_voice, low_voice, inner_voices, voice_combos
 
+def get_and_split_note_lists(composition):
+    """
+    Takes a mingus.containers.Composition object, or a dict of NoteLists
+    that have already been built (key => track name; value => NoteList).
+
+    Converts the Composition to a categorized set of NoteLists.
+
+    Returns a tuple:
+    (
+        dict of all voices (key => track name; value => NoteList),
+        NoteList that represents the high voice,
+        NoteList that represents the low voice,
+        List of NoteLists that represent the inner voices,
+        List of all possible combinations of voices, each represented by a tuple (a, b)
+    )
+
+    The high, low and inner voices' NoteLists are built, if they haven't
+    been already. Use get_and_split_voices() to leave them until needed.
+    """
+    n, high_voice, low_voice, inner_voices, voice_combos = get_and_split_voices(composition)
+    return n, n[high_voice], n[low_voice], [n[voice] for voice in inner_voices], voice_combos
+
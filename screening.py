@@ -0,0 +1,390 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from array import array
+from collections import defaultdict
+from multiprocessing import Pool
+from optparse import OptionParser
+from mingus.core.notes import note_to_int
+from mingus.core.diatonic import get_notes
+from structures import metric_grid
+from errors import standardize_errors, get_error_text, jazz_to_classical
+from rulebook import default_rulebook, load_rulebook, compile_rulebook
+from packing import voice_names, exercise_rows, load_corpus, unpack_rows, unpack_exercise
+
+###
+# Screening exercises before checking them. Most exercises that fail, fail
+# on something blatant: a note out of the key, parallel fifths or octaves,
+# or notes that don't line up. These can be found from each voice's MIDI
+# pitches and onsets alone, as arrays of integers, without spelling a
+# single interval, so an exercise can be screened far faster than it can
+# be checked.
+#
+# The screen only reports a problem where the full check is sure to find an
+# error too:
+#
+#     accidental_errors: a pitch class that isn't in the voice's key can't
+#         be spelled as a note of the key.
+#     parallel_errors: two onsets in a row the same perfect interval apart,
+#         in the same direction, when the rulebook doesn't allow it in
+#         parallel. Intervals are named from the lower pitch up, as by
+#         get_interval(), so a G below a C is a '4', and a G above a C a
+#         '5', whichever voice is higher. Between notes spelled in the key,
+#         a unison, fourth or fifth can only be spelled one way, so the
+#         spelled intervals are the same too; and notes that aren't spelled
+#         in the key are accidentals.
+#     alignment_errors: in first species, notes in one voice that don't
+#         start and end with a note in another.
+#     cantus_firmus: from second species on, no voice is all whole notes.
+#
+# So an exercise that fails the screen fails the full check, and only those
+# that pass need to be checked. --verify checks that it does.
+###
+
+# every onset is (bar, position in the bar), as one integer.
+bar_positions = 1 << 20
+
+# the names of the intervals the screen can find in parallel, and the
+# semitones from the lower pitch up to the higher, less any octaves.
+perfect_intervals = [('1', 0), ('4', 5), ('5', 7)]
+
+pitch_class_cache = {}
+
+def pitch_class(name):
+    if name not in pitch_class_cache:
+        pitch_class_cache[name] = note_to_int(name)
+    return pitch_class_cache[name]
+
+key_cache = {}
+
+def key_pitch_classes(key):
+    """
+    Takes the name of a key.
+
+    Returns a frozenset of the pitch classes (0 for C to 11 for B) of the
+    notes in the key, or None if the key isn't known. Worked out once per
+    key.
+    """
+    if key not in key_cache:
+        try:
+            key_cache[key] = frozenset([pitch_class(name) for name in get_notes(key)])
+        except Exception:
+            key_cache[key] = None
+    return key_cache[key]
+
+def onset(bar, beat):
+    return bar * bar_positions + int(round(beat * metric_grid))
+
+def voice_arrays(row):
+    """
+    Takes a voice's row, as returned by packing.exercise_rows().
+
+    Returns a tuple of:
+    (
+        str: voice name,
+        str: key,
+        array of the onset of each note (see onset()),
+        array of when each note ends, in the same form,
+        array of the MIDI pitch of each note, or -1 for a rest
+    )
+    """
+    name, key, meter, bar_count, notes = row
+    starts, ends, pitches = array('i'), array('i'), array('i')
+    for bar, beat, duration, note_name, octave in notes:
+        starts.append(onset(bar, beat))
+        ends.append(onset(bar, beat + 1. / duration))
+        if note_name is None:
+            pitches.append(-1)
+        else:
+            pitches.append(octave * 12 + pitch_class(note_name) + 12)
+    return name, key, starts, ends, pitches
+
+def event(voices, name, time):
+    return (voices, name, time // bar_positions, float(time % bar_positions) / metric_grid)
+
+def out_of_key(voice):
+    # notes whose pitch class isn't in the voice's key.
+    name, key, starts, ends, pitches = voice
+    in_key = key_pitch_classes(key)
+    if in_key is None:
+        return
+    for start, pitch in zip(starts, pitches):
+        if pitch >= 0 and pitch % 12 not in in_key:
+            yield (
+                (event(name, 'out of key', start),),
+                'accidental_errors'
+            )
+
+def sounding(voice, times):
+    # the pitch sounding in a voice at each of a sorted list of times, or
+    # None if nothing (not even a rest) is.
+    name, key, starts, ends, pitches = voice
+    i = 0
+    result = []
+    for t in times:
+        while i < len(starts) and ends[i] <= t:
+            i += 1
+        if i < len(starts) and starts[i] <= t:
+            result.append(pitches[i])
+        else:
+            result.append(None)
+    return result
+
+def parallel_perfects(upper, lower, perfect):
+    # two onsets in a row (in either voice) with the same perfect interval
+    # between the voices, in the same direction. The interval is named from
+    # the lower pitch up, whichever voice it's in.
+    times = sorted(set(upper[2]) | set(lower[2]))
+    voices = (upper[0], lower[0])
+    last = None
+    for t, a, b in zip(times, sounding(upper, times), sounding(lower, times)):
+        if a is None or b is None or a < 0 or b < 0:
+            last = None
+            continue
+        semitones = a - b
+        if last is not None and semitones == last[1] and abs(semitones) % 12 in perfect:
+            name = perfect[abs(semitones) % 12]
+            yield (
+                (event(voices, name, last[0]), event(voices, name, t)),
+                'Parallel %s' % jazz_to_classical[name],
+                'parallel_errors'
+            )
+        last = (t, semitones)
+
+def misaligned(upper, lower):
+    # notes in either voice that don't start and end with a note in the
+    # other, counting notes with the same times as many times as they occur.
+    counts = defaultdict(int)
+    for s, e, p in zip(*upper[2:]):
+        if p >= 0:
+            counts[(s, e)] += 1
+    for s, e, p in zip(*lower[2:]):
+        if p >= 0:
+            counts[(s, e)] -= 1
+    unmatched = [times for times in counts if counts[times]]
+    if unmatched:
+        first = min(unmatched)
+        voice = upper[0] if counts[first] > 0 else lower[0]
+        yield (
+            (event(voice, 'misaligned note', first[0]),),
+            'Notes do not line up between the %s and %s' % (upper[0], lower[0]),
+            'alignment_errors'
+        )
+
+def screen_rows(rows, species=1, rulebook=default_rulebook):
+    """
+    Takes an exercise's rows (see packing.exercise_rows()), an (optional)
+    species and an (optional) rulebook.
+
+    Yields the problems the screen finds (see above), as errors in the
+    standard format (see errors.py), cheapest checks first. Stop at the
+    first one for a quick verdict.
+    """
+    voices = [voice_arrays(row) for row in rows if len(row[4])]
+    by_name = dict([(voice[0], voice) for voice in voices])
+    pairs = [
+        (by_name[a], by_name[b])
+        for i, a in enumerate(voice_names) for b in voice_names[i+1:]
+        if a in by_name and b in by_name
+    ]
+
+    if species > 1:
+        # every voice but the cantus firmus moves in shorter notes.
+        if voices and not [row for row in rows if len(row[4]) and all([note[2] == 1 for note in row[4]])]:
+            yield (
+                ((voices[0][0], 'no cantus firmus', 0, 0.0),),
+                'No voice is all whole notes',
+                'cantus_firmus'
+            )
+            return
+
+    for voice in voices:
+        for problem in out_of_key(voice):
+            yield problem
+
+    if species == 1:
+        for upper, lower in pairs:
+            for problem in misaligned(upper, lower):
+                yield problem
+
+    allowed = rulebook['allowed_parallel_intervals']
+    perfect = dict([(semitones, name) for name, semitones in perfect_intervals if name not in allowed])
+    if perfect:
+        for upper, lower in pairs:
+            if upper[1] == lower[1]:
+                for problem in parallel_perfects(upper, lower, perfect):
+                    yield problem
+
+def screen(rows, species=1, rulebook=default_rulebook):
+    """
+    Takes an exercise's rows, an (optional) species and an (optional)
+    rulebook.
+
+    Returns the first problem the screen finds (see screen_rows()), or None
+    if the exercise passes, and needs the full check.
+    """
+    for problem in screen_rows(rows, species, rulebook):
+        return problem
+    return None
+
+def screen_composition(composition, species=1, rulebook=default_rulebook):
+    # as screen(), for a mingus.containers.Composition object.
+    return screen(exercise_rows(composition), species, rulebook)
+
+def confirmed(problem, error_dict):
+    """
+    Takes a problem the screen found in an exercise, and the error dict the
+    species function returns for the same exercise.
+
+    Returns whether the full check found an error of the same kind, as the
+    screen promises it will. Parallels between notes that aren't spelled in
+    the key may be found as accidentals instead.
+    """
+    if error_dict.get('cantus_firmus', True) is None:
+        kinds = set(['cantus_firmus'])
+    else:
+        kinds = set([error[-1] for error in standardize_errors(error_dict)])
+    if problem[-1] == 'parallel_errors' and 'accidental_errors' in kinds:
+        return True
+    return problem[-1] in kinds
+
+# exercises the screen has got wrong before, each as a tuple of (str: name,
+# melodies as in tracks.py, int: species, rulebook parameters). --verify
+# screens them along with the others.
+regressions = [
+    ('parallel fourths, with fourths allowed', {
+        'Soprano': [('C-5', 1), ('D-5', 1), ('E-5', 1)],
+        'Alto': [('G-4', 1), ('A-4', 1), ('B-4', 1)],
+    }, 1, {'allowed_parallel_intervals': ['3', '6', '4']}),
+    ('parallel fifths, with fourths allowed', {
+        'Soprano': [('G-4', 1), ('A-4', 1), ('B-4', 1)],
+        'Alto': [('C-4', 1), ('D-4', 1), ('E-4', 1)],
+    }, 1, {'allowed_parallel_intervals': ['3', '6', '4']}),
+]
+
+# the packed corpus and settings each worker process uses, set by start_worker().
+worker = {}
+
+def start_worker(corpus, species, rulebook, full, verify=False):
+    worker['corpus'] = corpus
+    worker['arguments'] = (species, rulebook, full, verify)
+
+def screen_exercise(i):
+    """
+    Takes the index of an exercise in the packed corpus, the name of a MIDI
+    file, or a tuple of (str: name, mingus.containers.Composition, int:
+    species, rulebook or None for the worker's).
+
+    Returns a tuple of (str: name, first problem or None, number of errors
+    found by the full check, or None if it wasn't run or couldn't be, bool:
+    whether the full check was run on a problem and didn't find it).
+    Runs in a worker process.
+    """
+    species, rulebook, full, verify = worker['arguments']
+    corpus = worker['corpus']
+    if isinstance(i, int):
+        name, rows = corpus['names'][i], unpack_rows(corpus, i)
+        composition = None
+    elif isinstance(i, tuple):
+        name, composition, species, exercise_rulebook = i
+        rulebook = exercise_rulebook or rulebook
+        rows = exercise_rows(composition)
+    else:
+        from counterpoint import setup_midi
+        name = i
+        composition, errors = setup_midi(i)
+        if errors:
+            return name, ((), '; '.join(errors), 'unreadable'), None, False
+        rows = exercise_rows(composition)
+
+    problem = screen(rows, species, rulebook)
+    if not (full and problem is None or verify and problem is not None):
+        return name, problem, None, False
+
+    from species import first_species, second_species, third_species, fourth_species
+    species_fn = [first_species, second_species, third_species, fourth_species][species-1]
+    if composition is None:
+        composition = unpack_exercise(corpus, i)
+    error_dict = species_fn(composition, rulebook=rulebook)
+    if problem is not None:
+        return name, problem, None, not confirmed(problem, error_dict)
+    if error_dict.get('cantus_firmus', True) is None:
+        return name, None, None, False
+    return name, None, len(standardize_errors(error_dict)), False
+
+def main():
+    parser = OptionParser(usage='%prog [options] [MIDI_FILE ...]')
+    parser.add_option('-s', '--species', dest='species', help='One of 1, 2, 3, or 4.', metavar='SPECIES', type='int', default=1)
+    parser.add_option('-p', '--packed', dest='packed', help='Screen the exercises in PACKED_FILE, made with packing.py, instead of MIDI files.', metavar='PACKED_FILE')
+    parser.add_option('-g', '--generate', dest='generate', help='Also screen COUNT randomly generated exercises (see equivalence.py).', metavar='COUNT', type='int', default=0)
+    parser.add_option('--seed', dest='seed', help='With --generate, the random seed. Defaults to 0.', metavar='SEED', type='int', default=0)
+    parser.add_option('--full', action='store_true', dest='full', help='Check the exercises that pass the screen in full, and print how many errors each has.')
+    parser.add_option('--verify', action='store_true', dest='verify', help='Check the exercises that fail the screen in full, and report any that the full check finds no such error in. Also screens the exercises the screen has got wrong before.')
+    parser.add_option('--rulebook', dest='rulebook_file', help='Use the parallel intervals allowed in RULEBOOK_FILE instead of the default rules.', metavar='RULEBOOK_FILE')
+    parser.add_option('-j', '--jobs', dest='jobs', help='Screen in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+    parser.add_option('-q', '--quiet', action='store_true', dest='quiet', help='Only print the totals.')
+
+    options, args = parser.parse_args()
+    if not args and not options.packed and not options.generate and not options.verify:
+        parser.error('MIDI files, a packed corpus or a number of exercises to generate are required. Use the -h argument to display help.')
+    try:
+        rulebook = options.rulebook_file and load_rulebook(options.rulebook_file) or default_rulebook
+    except (IOError, ValueError), e:
+        parser.error('Could not load rulebook: %s' % e)
+
+    if options.packed:
+        corpus = load_corpus(options.packed)
+        todo = range(len(corpus['names']))
+    else:
+        corpus = None
+        todo = list(args)
+    if options.generate:
+        from equivalence import generated_exercises
+        todo.extend([
+            (name, composition, species, None)
+            for name, composition, species in generated_exercises(options.generate, options.seed, options.species)
+        ])
+    if options.verify:
+        from structures import composition_from_melodies
+        todo.extend([
+            (name, composition_from_melodies(melodies), species, compile_rulebook(parameters, name))
+            for name, melodies, species, parameters in regressions
+        ])
+
+    started = time.time()
+    initargs = (corpus, options.species, rulebook, options.full, options.verify)
+    if options.jobs == 1:
+        start_worker(*initargs)
+        results = (screen_exercise(x) for x in todo)
+    else:
+        pool = Pool(options.jobs, start_worker, initargs)
+        results = pool.imap(screen_exercise, todo, 16)
+
+    failed = 0
+    unsound = 0
+    for name, problem, error_count, unconfirmed in results:
+        if unconfirmed:
+            unsound += 1
+            print 'UNSOUND  %s: the full check found no %s: %s' % (name, problem[-1], get_error_text(problem))
+        elif problem is not None:
+            failed += 1
+            if not options.quiet:
+                print 'FAIL  %s: %s' % (name, problem[-2] if not problem[0] else get_error_text(problem))
+        elif not options.quiet:
+            if error_count is None:
+                print 'PASS  %s' % name
+            else:
+                print 'PASS  %s: %d error(s) in full' % (name, error_count)
+
+    if options.jobs != 1:
+        pool.close()
+        pool.join()
+    print '%d of %d exercise(s) failed the screen, in %d ms.' % (failed + unsound, len(todo), (time.time() - started) * 1000)
+    if unsound:
+        print '%d of them had no such error in full.' % unsound
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
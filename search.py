@@ -0,0 +1,424 @@
+#!/usr/bin/env python2.6
+# -*- coding: utf-8 -*-
+
+import time
+import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from multiprocessing import Pool
+from optparse import OptionParser
+from structures import NoteList
+from rules import get_and_split_voices
+from views import horizontal_intervals, iter_vertical_intervals
+from packing import voice_names, save_columns, load_columns, load_corpus, unpack_exercise
+
+###
+# An index of the melodic and vertical intervals in a corpus, to find every
+# occurrence of a pattern of intervals, or the lines most like a given one,
+# without reading the corpus again.
+#
+# Each melody (and each pair of voices) is a line of interval tokens, like
+# '+2', '-b3' or '5^1' (a fifth and an octave). Every n consecutive tokens
+# of a line are packed into one integer key, 8 bits per token, with the
+# token at the start of the line in the highest bits. Keys near the end of a
+# line are padded with 0. Since keys are exact rather than hashed, the keys
+# that start with a shorter pattern are all next to each other once sorted,
+# so patterns of any length can be looked up.
+#
+# The index is saved in the same way as a packed corpus (see packing.py),
+# and is mapped into memory when it is used:
+#
+#     keys: the sorted, distinct keys
+#     key_start: where the postings of each key start, and one past the last
+#     posting_line, posting_position, posting_bar, posting_beat: one posting
+#         for every key in every line, sorted by key, then line, then
+#         position: the line, the token's position in it, and its onset
+#     line_exercise, line_voice, line_other_voice: one entry per line; the
+#         other voice is -1 for a melody
+#     line_keys: the number of distinct keys in each line
+###
+
+file_magic = 'COUNTERPOINT-INDEX-1\n'
+
+columns = [
+    ('keys', 'I'),
+    ('key_start', 'i'),
+    ('posting_line', 'i'),
+    ('posting_position', 'i'),
+    ('posting_bar', 'i'),
+    ('posting_beat', 'd'),
+    ('line_exercise', 'i'),
+    ('line_voice', 'b'),
+    ('line_other_voice', 'b'),
+    ('line_keys', 'i'),
+]
+
+# the longest n-gram that fits in a key.
+max_gram_length = 4
+
+def interval_token(interval, direction=None):
+    """
+    Takes an interval, as returned by get_interval(), and an (optional)
+    direction: 1 for up, -1 for down, 0 for neither.
+
+    Returns the interval as a token, like '+2', '-b3', '5^1' or 'rest'.
+    """
+    name, octaves = interval
+    if name == ' ':
+        return 'rest'
+    token = {1: '+', -1: '-'}.get(direction, '') + name
+    if octaves:
+        token += '^%d' % octaves
+    return token
+
+def melody_line(a_list):
+    """
+    Takes a NoteList.
+
+    Returns a tuple of (list of tokens, list of (bar, beat) onsets), one
+    for each interval between consecutive notes (see horizontal_intervals()).
+    """
+    notes = [a for a in a_list if not a.is_rest and a.next_actual_note is not None]
+    tokens = [
+        interval_token(interval, cmp(int(a.next_actual_note), int(a)))
+        for a, interval in zip(notes, horizontal_intervals(a_list))
+    ]
+    return tokens, [a.start for a in notes]
+
+def vertical_line(a_list, b_list):
+    """
+    Takes two NoteLists.
+
+    Returns a tuple of (list of tokens, list of (bar, beat) onsets), one
+    for each onset in either voice (see iter_vertical_intervals()).
+    """
+    tokens = []
+    times = []
+    for interval, onset in iter_vertical_intervals(a_list, b_list):
+        tokens.append(interval_token(interval))
+        times.append(onset)
+    return tokens, times
+
+def exercise_lines(n):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList).
+
+    Returns a list of (int: voice, int: other voice or -1, list of tokens,
+    list of onsets) tuples: one for the melody in each voice, and one for
+    the intervals between each pair of voices. Voices are indices into
+    packing.voice_names.
+    """
+    n, high_voice, low_voice, inner_voices, voice_combos = get_and_split_voices(n)
+    lines = []
+    for voice in sorted(n, key=voice_names.index):
+        tokens, times = melody_line(n[voice])
+        lines.append((voice_names.index(voice), -1, tokens, times))
+    for a, b in voice_combos:
+        tokens, times = vertical_line(n[a], n[b])
+        lines.append((voice_names.index(a), voice_names.index(b), tokens, times))
+    return lines
+
+def composition_lines(name, composition):
+    # (name, lines, reason it couldn't be indexed) for one exercise.
+    try:
+        n = dict([(track.name, NoteList(track)) for track in composition])
+        return name, exercise_lines(n), None
+    except Exception, e:
+        return name, None, '%s: %s' % (type(e).__name__, e)
+
+def midi_file_lines(midi_file):
+    from counterpoint import setup_midi
+    try:
+        composition, errors = setup_midi(midi_file)
+    except Exception, e:
+        errors = ['%s: %s' % (type(e).__name__, e)]
+    if errors:
+        return midi_file, None, '; '.join(errors)
+    return composition_lines(midi_file, composition)
+
+# the packed corpus each worker process reads from, set by attach_corpus().
+packed_corpus = {}
+
+def attach_corpus(corpus):
+    packed_corpus.clear()
+    packed_corpus.update(corpus)
+
+def packed_exercise_lines(i):
+    return composition_lines(packed_corpus['names'][i], unpack_exercise(packed_corpus, i))
+
+def pack_key(ids, n):
+    # the key of a gram of token ids, padded with 0 to n tokens.
+    key = 0
+    for i in range(n):
+        key = key << 8 | (ids[i] if i < len(ids) else 0)
+    return key
+
+def build_index(results, n=max_gram_length):
+    """
+    Takes an iterable of (str: exercise name, list of lines (see
+    exercise_lines()) or None, str: reason it couldn't be read, or None)
+    tuples and an (optional) number of tokens in each key.
+
+    Returns the index, as a dict of columns (see above), and:
+        'names': list of exercise names
+        'failed': dict of exercise name => reason it couldn't be indexed
+        'tokens': list of tokens, indexed by token id; 0 is the padding
+        'gram_length': n
+    """
+    if not 1 <= n <= max_gram_length:
+        raise ValueError('Keys must hold between 1 and %d tokens' % max_gram_length)
+
+    index = {'names': [], 'failed': {}, 'tokens': [''], 'gram_length': n}
+    for column, typecode in columns:
+        index[column] = array.array(typecode)
+    token_table = {}
+
+    # postings, sorted afterwards by key, line and position together.
+    order = []
+    bars = array.array('i')
+    beats = array.array('d')
+    line_first = array.array('i')
+
+    for name, lines, reason in results:
+        if lines is None:
+            index['failed'][name] = reason
+            continue
+        exercise = len(index['names'])
+        index['names'].append(name)
+        for voice, other_voice, tokens, times in lines:
+            line = len(index['line_exercise'])
+            ids = []
+            for token in tokens:
+                if token not in token_table:
+                    if len(index['tokens']) > 255:
+                        raise ValueError('Too many distinct intervals to index')
+                    token_table[token] = len(index['tokens'])
+                    index['tokens'].append(token)
+                ids.append(token_table[token])
+
+            line_first.append(len(bars))
+            line_keys = set()
+            for position, (bar, beat) in enumerate(times):
+                key = pack_key(ids[position:position+n], n)
+                line_keys.add(key)
+                order.append(key << 56 | line << 24 | position)
+                bars.append(bar)
+                beats.append(beat)
+
+            index['line_exercise'].append(exercise)
+            index['line_voice'].append(voice)
+            index['line_other_voice'].append(other_voice)
+            index['line_keys'].append(len(line_keys))
+
+    order.sort()
+    for composite in order:
+        key = composite >> 56
+        if not index['keys'] or index['keys'][-1] != key:
+            index['keys'].append(key)
+            index['key_start'].append(len(index['posting_line']))
+        line = composite >> 24 & 0xffffffff
+        position = composite & 0xffffff
+        # each line's onsets were added together, in order.
+        i = line_first[line] + position
+        index['posting_line'].append(line)
+        index['posting_position'].append(position)
+        index['posting_bar'].append(bars[i])
+        index['posting_beat'].append(beats[i])
+    index['key_start'].append(len(index['posting_line']))
+    return index
+
+def save_index(index, file_name):
+    header = {
+        'names': index['names'],
+        'failed': index['failed'],
+        'tokens': index['tokens'],
+        'gram_length': index['gram_length'],
+    }
+    save_columns(file_name, file_magic, header, columns, index)
+
+def load_index(file_name):
+    """
+    Takes the name of a file saved by save_index().
+
+    Returns the index, with its columns mapped from the file rather than
+    read into memory (see packing.load_columns()).
+    """
+    header, index = load_columns(file_name, file_magic, columns)
+    index.update({
+        'names': header['names'],
+        'failed': header['failed'],
+        'tokens': [str(token) for token in header['tokens']],
+        'gram_length': header['gram_length'],
+    })
+    return index
+
+def postings(index, ids):
+    """
+    Takes an index and a list of at most gram_length token ids.
+
+    Returns an xrange of the postings whose keys start with those tokens.
+    """
+    n = index['gram_length']
+    lo = pack_key(ids, n)
+    hi = pack_key(ids + [255] * (n - len(ids)), n)
+    first = bisect_left(index['keys'], lo)
+    last = bisect_right(index['keys'], hi)
+    return xrange(index['key_start'][first], index['key_start'][last])
+
+def is_vertical_line(index, line):
+    return index['line_other_voice'][line] != -1
+
+def token_ids(index, tokens):
+    # the id of each token, or None for tokens that aren't in the index.
+    table = dict([(token, i) for i, token in enumerate(index['tokens']) if i])
+    return [table.get(token) for token in tokens]
+
+def find_pattern(index, tokens, vertical=False):
+    """
+    Takes an index, a list of tokens (see interval_token()) and whether to
+    search the intervals between voices rather than the melodies.
+
+    Returns a list of (int: line, int: position, (int: bar, float: beat))
+    tuples, one for every place the tokens occur, in order.
+    """
+    ids = token_ids(index, tokens)
+    if not ids or None in ids:
+        return []
+    n = index['gram_length']
+    line, position = index['posting_line'], index['posting_position']
+
+    # find where the first n tokens occur, then check that each following
+    # n tokens occur at the right distance after them.
+    found = {}
+    for p in postings(index, ids[:n]):
+        if is_vertical_line(index, line[p]) == vertical:
+            found[(line[p], position[p])] = p
+    for offset in range(n, len(ids), n):
+        following = set([(line[p], position[p] - offset) for p in postings(index, ids[offset:offset+n])])
+        found = dict([(k, p) for k, p in found.items() if k in following])
+
+    return sorted([
+        (k[0], k[1], (index['posting_bar'][p], index['posting_beat'][p]))
+        for k, p in found.items()
+    ])
+
+def similar_lines(index, tokens, vertical=False, top=10):
+    """
+    Takes an index, a list of tokens (see interval_token()), whether they
+    are intervals between voices rather than a melody, and the (optional)
+    number of lines to return.
+
+    Returns a list of (float: similarity, int: line) tuples, most similar
+    first. Similarity is the share of distinct keys that the two lines have
+    in common (their Jaccard index), so 1.0 is a copy of the whole line.
+    """
+    n = index['gram_length']
+    ids = token_ids(index, tokens)
+    if not ids:
+        return []
+    query_keys = set()
+    for position in range(len(ids)):
+        gram = ids[position:position+n]
+        if None not in gram:
+            query_keys.add(pack_key(gram, n))
+
+    keys = index['keys']
+    posting_line = index['posting_line']
+    shared = defaultdict(int)
+    for key in query_keys:
+        k = bisect_left(keys, key)
+        if k == len(keys) or keys[k] != key:
+            continue
+        last_line = None
+        for p in xrange(index['key_start'][k], index['key_start'][k+1]):
+            line = posting_line[p]
+            if line != last_line and is_vertical_line(index, line) == vertical:
+                shared[line] += 1
+            last_line = line
+
+    # tokens that aren't in the index still make the query longer.
+    query_size = len(set([
+        tuple(ids[position:position+n]) for position in range(len(ids))
+    ]))
+    scores = [
+        (float(count) / (query_size + index['line_keys'][line] - count), line)
+        for line, count in shared.items()
+    ]
+    scores.sort(key=lambda x: (-x[0], x[1]))
+    return scores[:top]
+
+def line_name(index, line):
+    name = index['names'][index['line_exercise'][line]]
+    voice = voice_names[index['line_voice'][line]]
+    if is_vertical_line(index, line):
+        return '%s, between %s and %s' % (name, voice, voice_names[index['line_other_voice'][line]])
+    return '%s, %s' % (name, voice)
+
+def main():
+    parser = OptionParser(usage='%prog -i INDEX_FILE [options] [MIDI_FILE ...]')
+    parser.add_option('-i', '--index', dest='index', help='The index file to build or search.', metavar='INDEX_FILE')
+    parser.add_option('--build', action='store_true', dest='build', help='Build INDEX_FILE from the MIDI files given, and the exercises in PACKED_FILE.')
+    parser.add_option('-p', '--packed', dest='packed', help='With --build, also index the exercises in PACKED_FILE, made with packing.py.', metavar='PACKED_FILE')
+    parser.add_option('-n', dest='gram_length', help='With --build, the number of intervals in each key, from 1 to %d. Defaults to %d.' % (max_gram_length, max_gram_length), metavar='LENGTH', type='int', default=max_gram_length)
+    parser.add_option('-j', '--jobs', dest='jobs', help='With --build, read exercises in JOBS worker processes. Defaults to one per CPU.', metavar='JOBS', type='int')
+    parser.add_option('-f', '--find', dest='pattern', help='Find every occurrence of PATTERN, a list of intervals like "+2 +2 -b3".', metavar='PATTERN')
+    parser.add_option('--similar', dest='similar', help='Rank the lines most like the lines in MIDI_FILE.', metavar='MIDI_FILE')
+    parser.add_option('-v', '--voice', dest='voice', help='With --similar, only look for lines like the one in VOICE.', metavar='VOICE')
+    parser.add_option('--vertical', action='store_true', dest='vertical', help='Search the intervals between voices, rather than melodies.')
+    parser.add_option('-k', '--top', dest='top', help='With --similar, show the TOP most similar lines. Defaults to 10.', metavar='TOP', type='int', default=10)
+
+    options, args = parser.parse_args()
+    if not options.index:
+        parser.error('An index file is required. Use the -h argument to display help.')
+
+    if options.build:
+        if not args and not options.packed:
+            parser.error('No MIDI files or packed corpus to index.')
+        results = []
+        if options.packed:
+            corpus = load_corpus(options.packed)
+            pool = Pool(options.jobs, attach_corpus, (corpus,))
+            results.extend(pool.imap(packed_exercise_lines, range(len(corpus['names'])), 64))
+            pool.close()
+            pool.join()
+            for name, reason in corpus['failed'].items():
+                results.append((name, None, reason))
+        if args:
+            pool = Pool(options.jobs)
+            results.extend(pool.imap(midi_file_lines, args))
+            pool.close()
+            pool.join()
+        index = build_index(results, options.gram_length)
+        save_index(index, options.index)
+        print '%d exercise(s), %d line(s), %d posting(s) indexed in %s.' % (
+            len(index['names']), len(index['line_exercise']), len(index['posting_line']), options.index)
+        for name, reason in sorted(index['failed'].items()):
+            print '%s: skipped: %s' % (name, reason)
+        return
+
+    index = load_index(options.index)
+
+    if options.pattern:
+        started = time.time()
+        found = find_pattern(index, options.pattern.split(), options.vertical)
+        for line, position, (bar, beat) in found:
+            print '%s: mm. %d beat %.2f' % (line_name(index, line), bar + 1, beat * 4 + 1)
+        print '%d occurrence(s) found in %d ms.' % (len(found), (time.time() - started) * 1000)
+
+    if options.similar:
+        name, lines, reason = midi_file_lines(options.similar)
+        if lines is None:
+            parser.error('Could not read %s: %s' % (options.similar, reason))
+        for voice, other_voice, tokens, times in lines:
+            if (other_voice != -1) != bool(options.vertical):
+                continue
+            if options.voice and voice_names[voice] != options.voice:
+                continue
+            started = time.time()
+            print 'Most like the %s in %s:' % (voice_names[voice], options.similar)
+            for score, line in similar_lines(index, tokens, options.vertical, options.top):
+                print '    %.3f  %s' % (score, line_name(index, line))
+            print '    (%d ms)' % ((time.time() - started) * 1000)
+
+if __name__ == "__main__":
+    main()
@@ -4,90 +4,358 @@ from mingus.core import intervals as mintervals
 from mingus.containers import Note
 from rules import *
 from views import *
+from errors import standardize_errors
+from rulebook import default_rulebook
+from inspect import getargspec
+from functools import partial
 
-def first_species(composition):
+def rule_arguments(n, key):
     """
-    Takes a mingus.containers.Composition object.
+    Takes a dict of NoteLists (key => track name; value => NoteList) and a
+    key, which is either a voice name or a tuple of two voice names.
 
-    Returns a dict of possible errors according to the rules of
-    First Species counterpoint.
+    Returns a list of the NoteLists that the key refers to.
     """
-    n, high_voice, low_voice, inner_voices, voice_combos = \
-        get_and_split_note_lists(composition)
-
-    # find errors in specific voices
-    high_voice_beginning_error = starts_with_tonic_or_fifth(high_voice)
-    high_voice_ending_error = ends_with_lt_tonic(high_voice)
-    low_voice_beginning_error = starts_with_tonic(low_voice)
-
-    # find errors in each melody
-    horizontal_errors = {}
-    indirect_horizontal_errors = {}
-    turnaround_errors = {}
-    accidental_errors = {}
-    for x in n:
-        horizontal_errors[x] = illegal_horizontal_intervals(n[x])
-        indirect_horizontal_errors[x] = illegal_indirect_horizontal_intervals(n[x])
-        turnaround_errors[x] = missed_leap_turnarounds(n[x])
-        accidental_errors[x] = accidentals(n[x])
-
-    # find errors between pairs of voices.
-    alignment_errors = {}
-    parallel_errors = {}
-    consecutive_parallel_errors = {}
-    high_point_errors = {}
-    voice_crossing_errors = {}
-    vertical_interval_errors = {}
-    direct_motion_errors = {}
-    for x, y in voice_combos:
-        alignment_errors[(x, y)] = all_notes_line_up(n[x], n[y])
-        parallel_errors[(x, y)] = illegal_parallel_intervals(n[x], n[y])
-        consecutive_parallel_errors[(x, y)] = illegal_consecutive_parallels(n[x], n[y])
-        high_point_errors[(x, y)] = coincident_maxima(n[x], n[y])
-        voice_crossing_errors[(x, y)] = voice_crossing(n[x], n[y])
-        vertical_interval_errors[(x, y)] = illegal_vertical_intervals(n[x], n[y])
-        direct_motion_errors[(x, y)] = illegal_direct_motion(n[x], n[y])
-
-    return dict(
-        # find errors in specific voices
-        high_voice_beginning_error = {high_voice.track.name: high_voice_beginning_error},
-        high_voice_ending_error = {high_voice.track.name: high_voice_ending_error},
-        low_voice_beginning_error = {low_voice.track.name: low_voice_beginning_error},
-        # intra-voice errors
-        horizontal_errors = horizontal_errors,
-        indirect_horizontal_errors = indirect_horizontal_errors,
-        turnaround_errors = turnaround_errors,
-        accidental_errors = accidental_errors,
-        # inter-voice errors
-        alignment_errors = alignment_errors,
-        parallel_errors = parallel_errors,
-        consecutive_parallel_errors = consecutive_parallel_errors,
-        high_point_errors = high_point_errors,
-        voice_crossing_errors = voice_crossing_errors,
-        vertical_interval_errors = vertical_interval_errors,
-        direct_motion_errors = direct_motion_errors,
+    if type(key) is tuple:
+        return [n[voice] for voice in key]
+    return [n[key]]
+
+bound_rules = {}
+
+def with_rulebook(rules, rulebook=None):
+    """
+    Takes a list of rules (see evaluate_rules()) and an (optional) rulebook.
+
+    Returns the list of rules, with each rule that takes a rulebook bound
+    to the given one. The same rule bound to the same rulebook is always the
+    same function, so results can still be cached by rule.
+    """
+    if rulebook is None or rulebook is default_rulebook:
+        return rules
+
+    bound = []
+    for names, rule, keys in rules:
+        if 'rulebook' in getargspec(rule)[0]:
+            if (rule, id(rulebook)) not in bound_rules:
+                # keep the rulebook alive, so its id isn't reused.
+                bound_rules[(rule, id(rulebook))] = (rulebook, partial(rule, rulebook=rulebook))
+            rule = bound_rules[(rule, id(rulebook))][1]
+        bound.append((names, rule, keys))
+    return bound
+
+def select_rules(rules, only=None):
+    """
+    Takes a list of rules (see evaluate_rules()) and an (optional) function,
+    which takes an error name and returns True for the errors to look for.
+
+    Returns the rules that find at least one of those errors.
+    """
+    if only is None:
+        return rules
+
+    selected = []
+    for names, rule, keys in rules:
+        if type(names) is tuple:
+            found = [name for name in names if name is not None]
+        else:
+            found = [names]
+        if any([only(name) for name in found]):
+            selected.append((names, rule, keys))
+    return selected
+
+def evaluate_rulebooks(species_fn, composition, rulebooks, max_errors=None, cache=None):
+    """
+    Takes one of the species functions below, a mingus.containers.Composition
+    object, a list of rulebooks (see rulebook.py), an (optional) error budget
+    for each rulebook and an (optional) cache dict.
+
+    Returns a list of error dicts, one for each rulebook, in the same order.
+
+    Rules that don't take a rulebook are only evaluated once for all of
+    the rulebooks.
+    """
+    if cache is None:
+        cache = {}
+    if not isinstance(composition, (dict, NoteLists)):
+        # each voice is built once, for all of the rulebooks.
+        composition = create_note_lists(composition)
+    return [
+        species_fn(composition, max_errors=max_errors, cache=cache, rulebook=rulebook)
+        for rulebook in rulebooks
+    ]
+
+def evaluate_rules(n, rules, max_errors=None, cache=None, only=None, only_keys=None):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList), a list
+    of rules, an (optional) error budget, an (optional) cache dict, an
+    (optional) function to choose which errors to look for (see
+    select_rules()) and an (optional) function which takes a key and returns
+    True for the keys to look at.
+
+    Each rule is a tuple of the form:
+    (
+        str: error name,
+        function: rule,
+        list of keys (voice names or tuples of two voice names)
     )
+    Rules should be listed cheapest first.
 
-def second_species(composition):
+    A rule that finds several kinds of error at once may give a tuple of
+    error names instead, and return a tuple of results in the same order.
+    Results named None are discarded.
+
+    Returns a tuple:
+    (
+        dict of errors (key => error name; value => dict of key => errors),
+        bool: whether more than max_errors errors were found
+    )
+
+    If max_errors is given, rules are evaluated one at a time, and evaluation
+    stops as soon as the number of standardized errors exceeds max_errors.
+    Rules that were not reached are left empty in the returned dict, as are
+    the rules that weren't chosen, and the keys that weren't chosen are left
+    out. The dict is filled in the same order whichever rules and keys are
+    chosen, so its errors are standardized in the same order too (see
+    chunking.check_in_chunks() and grouping.check_in_groups()). Each key is
+    offered to only_keys once, in the order the rules take them.
+
+    If a cache is given, each result is kept in it, keyed by the rule and
+    the fingerprints of the voices it was given. Results for voices whose
+    notes haven't changed since the last call are reused rather than
+    evaluated again. Entries for voices that have changed, or gone, are
+    dropped; the rest are kept, even if they weren't used, so one cache can
+    be shared by calls with different rules, as for several rulebooks (see
+    evaluate_rulebooks()).
     """
-    Takes a mingus.containers.Composition object.
+    def split(names, result):
+        if type(names) is tuple:
+            return [(n, r) for n, r in zip(names, result) if n is not None]
+        return [(names, result)]
+
+    if cache is not None:
+        used = {}
+
+    def fingerprint(voice):
+        # only the voices a rule is given are built (see
+        # structures.NoteLists); each remembers its own fingerprint.
+        return n[voice].fingerprint()
+
+    def run(rule, key):
+        if cache is None:
+            return rule(*rule_arguments(n, key))
+        if type(key) is tuple:
+            cache_key = (rule, key, tuple([fingerprint(v) for v in key]))
+        else:
+            cache_key = (rule, key, fingerprint(key))
+        if cache_key in cache:
+            result = cache[cache_key]
+        else:
+            result = rule(*rule_arguments(n, key))
+        used[cache_key] = result
+        return result
+
+    def current(key):
+        # the fingerprints the voices of a key have now, or None if any of
+        # them is gone.
+        voices = key if type(key) is tuple else (key,)
+        if [voice for voice in voices if voice not in n]:
+            return None
+        if type(key) is tuple:
+            return tuple([fingerprint(v) for v in key])
+        return fingerprint(key)
+
+    def finish(budget_exceeded):
+        if cache is not None:
+            for cache_key in cache.keys():
+                rule, key, fingerprints = cache_key
+                if cache_key not in used and current(key) != fingerprints:
+                    del cache[cache_key]
+            cache.update(used)
+        return error_dict, budget_exceeded
+
+    error_dict = {}
+    for names, rule, keys in rules:
+        if type(names) is not tuple:
+            names = (names,)
+        for name in names:
+            if name is not None:
+                error_dict[name] = {}
+
+    # every key, in the order the rules take them.
+    all_keys = []
+    for name, rule, keys in rules:
+        all_keys.extend([key for key in keys if key not in all_keys])
+    if only_keys is not None:
+        all_keys = [key for key in all_keys if only_keys(key)]
+    rules = select_rules(rules, only)
+
+    if max_errors is None:
+        # evaluate every rule, grouped by voice or pair of voices.
+
+        for key in all_keys:
+            for names, rule, keys in rules:
+                if key in keys:
+                    for name, r in split(names, run(rule, key)):
+                        error_dict[name][key] = r
+        return finish(False)
+
+    error_count = 0
+    for names, rule, keys in rules:
+        found = {}
+        for key in [key for key in keys if key in all_keys]:
+            for name, r in split(names, run(rule, key)):
+                error_dict[name][key] = r
+                found[name] = error_dict[name]
+        error_count += len(standardize_errors(found))
+        if error_count > max_errors:
+            return finish(True)
+    return finish(False)
+
+def first_species(composition, max_errors=None, cache=None, rulebook=None, only=None, only_keys=None):
+    """
+    Takes a mingus.containers.Composition object, an (optional) error
+    budget, an (optional) cache dict to reuse results from, across calls
+    (see evaluate_rules()), an (optional) rulebook (see rulebook.py), an
+    (optional) function to choose which errors to look for (see
+    select_rules()) and an (optional) function to choose which voices and
+    pairs of voices to look at (see evaluate_rules()).
 
     Returns a dict of possible errors according to the rules of
     First Species counterpoint.
 
-    NOTE: this huge function is a bit of a hack, and should really be factored
-          into smaller bits
+    If max_errors is given, evaluation stops once more than max_errors errors
+    have been found, and the 'budget_exceeded' key of the returned dict is set.
     """
     n, high_voice, low_voice, inner_voices, voice_combos = \
-        get_and_split_note_lists(composition)
+        get_and_split_voices(composition)
+    voices = list(n)
+
+    # rules are listed cheapest first.
+    rules = [
+        # find errors in specific voices
+        ('high_voice_beginning_error', starts_with_tonic_or_fifth, [high_voice]),
+        ('high_voice_ending_error', ends_with_lt_tonic, [high_voice]),
+        ('low_voice_beginning_error', starts_with_tonic, [low_voice]),
+        # find errors in each melody
+        ('accidental_errors', accidentals, voices),
+        ('horizontal_errors', illegal_horizontal_intervals, voices),
+        ('turnaround_errors', missed_leap_turnarounds, voices),
+        ('indirect_horizontal_errors', illegal_indirect_horizontal_intervals, voices),
+        # find errors between pairs of voices.
+        ('alignment_errors', all_notes_line_up, voice_combos),
+        ('vertical_interval_errors', illegal_vertical_intervals, voice_combos),
+        (('parallel_errors', 'consecutive_parallel_errors', None),
+            illegal_parallel_runs, voice_combos),
+        ('direct_motion_errors', illegal_direct_motion, voice_combos),
+        ('high_point_errors', coincident_maxima, voice_combos),
+        ('voice_crossing_errors', voice_crossing, voice_combos),
+    ]
+
+    error_dict, budget_exceeded = evaluate_rules(n, with_rulebook(rules, rulebook), max_errors, cache, only, only_keys)
+    error_dict['budget_exceeded'] = budget_exceeded
+    return error_dict
+
+def repeated_notes(a_list):
+    """
+    Takes a single NoteList object.
+
+    Returns a list of (NoteNode, NoteNode) tuples, one for each pair of
+    consecutive notes that repeat the same pitch.
+    """
+    repeated = []
+    note = a_list.get_first_actual_note()
+    while note is not None:
+        next = note.next_actual_note
+        if next is not None and get_interval(note, next) == ('1', 0):
+            repeated.append((note, next))
+        note = next
+    return repeated
+
+def strong_beat_leaps(a_list):
+    """
+    Takes a single NoteList object.
+
+    Return format is identical to illegal_horizontal_intervals().
+
+    Returned tuples here will only represent leaps greater than a 5th
+    that land on a strong beat.
+    """
+    intervals = horizontal_intervals(a_list)
+    return [
+        (interval, a_list[i+1])
+        for i,interval in enumerate(intervals)
+        if get_semitones(interval) > 7 # leap is greater than 5th
+        and a_list[i+1].strength == downbeat # note falls on a strong beat
+    ]
+
+def second_species_vertical_intervals(a_list, b_list, rulebook=default_rulebook):
+    """
+    Takes two NoteList objects, and an (optional) rulebook.
+
+    Return format is identical to illegal_vertical_intervals().
+
+    Dissonances allowed by legal_dissonances() are not included.
+    """
+    dissonances = illegal_vertical_intervals(a_list, b_list, rulebook)
+    legal_dissonance = legal_dissonances(a_list, b_list, rulebook)
+    return [
+        d for d in dissonances
+        if d not in legal_dissonance
+    ]
+
+def second_species_voice_crossing(a_list, b_list):
+    """
+    Takes two NoteList objects.
+
+    Return format is identical to voice_crossing().
+
+    Voice crossing in the form of a unison on a weak beat is not included.
+    """
+    voice_crossings = voice_crossing(a_list, b_list)
+    weak_beat_filter = lambda x: x.strength == weak_beat
+    legal_crossings = [
+        v
+        for v in voice_crossing(
+            a_list, b_list,
+            note_spacing=1,
+            note_filter_fn=weak_beat_filter
+        ) # find all weak beat voice crossings
+        if get_interval(v[0], v[1]) == ('1', 0) # filter to perfect unisons
+    ]
+    return [v for v in voice_crossings if v not in legal_crossings]
+
+def find_cantus_firmus(n):
+    """
+    Takes a dict of NoteLists (key => track name; value => NoteList).
 
-    # find the cantus firmus. In 2nd species, this is the voice that is
-    # all whole notes.
-    cantus_firmus = None
+    Returns the name of the cantus firmus, or None if there isn't one.
+    From second species on, this is the voice that is all whole notes.
+    """
     for voice in n:
         if all([note.duration == 1 for note in n[voice]]):
-            cantus_firmus = voice
-            break
+            return voice
+    return None
+
+def second_species(composition, max_errors=None, cache=None, rulebook=None, only=None, only_keys=None):
+    """
+    Takes a mingus.containers.Composition object, an (optional) error
+    budget, an (optional) cache dict to reuse results from, across calls
+    (see evaluate_rules()), an (optional) rulebook (see rulebook.py), an
+    (optional) function to choose which errors to look for (see
+    select_rules()) and an (optional) function to choose which voices and
+    pairs of voices to look at (see evaluate_rules()).
+
+    Returns a dict of possible errors according to the rules of
+    Second Species counterpoint.
+
+    If max_errors is given, evaluation stops once more than max_errors errors
+    have been found, and the 'budget_exceeded' key of the returned dict is set.
+    """
+    n, high_voice, low_voice, inner_voices, voice_combos = \
+        get_and_split_voices(composition)
+    voices = list(n)
+
+    cantus_firmus = find_cantus_firmus(n)
 
     # if we can't find the C.F. return right away.
     if cantus_firmus == None:
@@ -110,112 +378,145 @@ def second_species(composition):
         if n[voice][-2].duration not in [1, 0.5]:
             invalid_durations.append(n[voice][-2])
 
-    # find errors in specific voices
-    high_voice_beginning_error = starts_with_tonic_or_fifth(high_voice)
-    high_voice_ending_error = ends_with_lt_tonic(high_voice)
-    low_voice_beginning_error = starts_with_tonic(low_voice)
-
-    # find errors in each melody
-    horizontal_errors = {}
-    weak_horizontal_errors  = {}
-    turnaround_errors = {}
-    accidental_errors = {}
-    repeated_notes = {}
-    strong_beat_horizontals = {}
-    for x in n:
-        horizontal_errors[x] = illegal_horizontal_intervals(n[x])
-        turnaround_errors[x] = missed_leap_turnarounds(n[x])
-        accidental_errors[x] = accidentals(n[x])
-
+    # rules are listed cheapest first.
+    rules = [
+        # find errors in specific voices
+        ('high_voice_beginning_error', starts_with_tonic_or_fifth, [high_voice]),
+        ('high_voice_ending_error', ends_with_lt_tonic, [high_voice]),
+        ('low_voice_beginning_error', starts_with_tonic, [low_voice]),
+        # find errors in each melody
+        ('accidental_errors', accidentals, voices),
+        ('horizontal_errors', illegal_horizontal_intervals, voices),
+        ('weak_horizontal_errors', strong_beat_leaps, voices),
+        ('strong_beat_horizontals', illegal_strong_beat_horizontal_intervals, voices),
+        ('turnaround_errors', missed_leap_turnarounds, voices),
         # no voice is allowed to repeat notes
-        repeated = []
-        note = n[x].get_first_actual_note()
-        while note is not None:
-            next = note.next_actual_note
-            if next is not None and get_interval(note, next) == ('1', 0):
-                repeated.append((note, next))
-            note = next
-        repeated_notes[x] = repeated
-
-        # leaps greater than a 5th may only go from strong to weak beats
-        intervals = horizontal_intervals(n[x])
-        weak_horizontal_errors[x] = [
-            (interval, n[x][i+1])
-            for i,interval in enumerate(intervals)
-            if get_semitones(interval) > 7 # leap is greater than 5th
-            and n[x][i+1].beat == 0 # note falls on a strong beat
-        ]
-
-        # find invalid intervals between consecutive downbeats.
-        strong_beat_horizontals[x] = \
-            illegal_strong_beat_horizontal_intervals(n[x])
-
-    # find errors between pairs of voices.
-    parallel_errors = {}
-    parallel_downbeat_errors = {}
-    consecutive_parallel_errors = {}
-    high_point_errors = {}
-    voice_crossing_errors = {}
-    vertical_interval_errors = {}
-    direct_motion_errors = {}
-    for x, y in voice_combos:
-        parallel_errors[(x, y)] = illegal_parallel_intervals(n[x], n[y])
+        ('repeated_notes', repeated_notes, voices),
+        # find errors between pairs of voices.
         # We also have to consider consecutive downbeats, now, when looking for
         # parallel intervals.
-        downbeat_filter = lambda x: x[1][1] == 0
-        parallel_downbeat_errors[(x, y)] = \
-            parallel_motion(n[x], n[y], filter_fn=downbeat_filter)
-        consecutive_parallel_errors[(x, y)] = illegal_consecutive_parallels(n[x], n[y])
-        high_point_errors[(x, y)] = coincident_maxima(n[x], n[y])
-
+        (('parallel_errors', 'consecutive_parallel_errors', 'parallel_downbeat_errors'),
+            illegal_parallel_runs, voice_combos),
+        ('direct_motion_errors', illegal_direct_motion, voice_combos),
         # second species has different rules for vertical intervals
-        dissonances = illegal_vertical_intervals(n[x], n[y])
-        legal_dissonance = legal_dissonances(n[x], n[y])
-        vertical_interval_errors[(x, y)] = [
-            d for d in dissonances
-            if d not in legal_dissonance
-        ]
+        ('vertical_interval_errors', second_species_vertical_intervals, voice_combos),
+        ('high_point_errors', coincident_maxima, voice_combos),
+        # voice crossing in the form of unison on weak beat is okay now.
+        ('voice_crossing_errors', second_species_voice_crossing, voice_combos),
+    ]
 
-        direct_motion_errors[(x, y)] = illegal_direct_motion(n[x], n[y])
+    error_dict, budget_exceeded = evaluate_rules(n, with_rulebook(rules, rulebook), max_errors, cache, only, only_keys)
+    error_dict['cantus_firmus'] = cantus_firmus
+    error_dict['budget_exceeded'] = budget_exceeded
+    return error_dict
 
-        # voice crossing in the form of unison on weak beat is okay now.
-        voice_crossings = voice_crossing(n[x], n[y])
-        weak_beat_filter = lambda x: x.beat == 0.5
-        legal_crossings = [
-            v
-            for v in voice_crossing(
-                n[x], n[y],
-                note_spacing=1,
-                note_filter_fn=weak_beat_filter
-            ) # find all weak beat voice crossings
-            if get_interval(v[0], v[1]) == ('1', 0) # filter to perfect unisons
-        ]
-        voice_crossing_errors[(x, y)] = [v for v in voice_crossings if v not in legal_crossings]
-
-    return dict(
-        cantus_firmus = cantus_firmus,
+def third_species(composition, max_errors=None, cache=None, rulebook=None, only=None, only_keys=None):
+    """
+    Takes a mingus.containers.Composition object, an (optional) error
+    budget, an (optional) cache dict to reuse results from, across calls
+    (see evaluate_rules()), an (optional) rulebook (see rulebook.py), an
+    (optional) function to choose which errors to look for (see
+    select_rules()) and an (optional) function to choose which voices and
+    pairs of voices to look at (see evaluate_rules()).
+
+    Returns a dict of possible errors according to the rules of
+    Third Species counterpoint.
+
+    If max_errors is given, evaluation stops once more than max_errors errors
+    have been found, and the 'budget_exceeded' key of the returned dict is set.
+    """
+    n, high_voice, low_voice, inner_voices, voice_combos = \
+        get_and_split_voices(composition)
+    voices = list(n)
+
+    cantus_firmus = find_cantus_firmus(n)
+
+    # if we can't find the C.F. return right away.
+    if cantus_firmus == None:
+        return dict(
+            cantus_firmus = None
+        )
+
+    # rules are listed cheapest first.
+    rules = [
         # find errors in specific voices
-        high_voice_beginning_error = {high_voice.track.name: high_voice_beginning_error},
-        high_voice_ending_error = {high_voice.track.name: high_voice_ending_error},
-        low_voice_beginning_error = {low_voice.track.name: low_voice_beginning_error},
-        # intra-voice errors
-        horizontal_errors = horizontal_errors,
-        turnaround_errors = turnaround_errors,
-        weak_horizontal_errors = weak_horizontal_errors,
-        accidental_errors = accidental_errors,
-        strong_beat_horizontals = strong_beat_horizontals,
-        # inter-voice errors
-        parallel_errors = parallel_errors,
-        consecutive_parallel_errors = consecutive_parallel_errors,
-        high_point_errors = high_point_errors,
-        voice_crossing_errors = voice_crossing_errors,
-        vertical_interval_errors = vertical_interval_errors,
-        direct_motion_errors = direct_motion_errors,
-    )
+        ('high_voice_beginning_error', starts_with_tonic_or_fifth, [high_voice]),
+        ('high_voice_ending_error', ends_with_lt_tonic, [high_voice]),
+        ('low_voice_beginning_error', starts_with_tonic, [low_voice]),
+        # find errors in each melody
+        ('accidental_errors', accidentals, voices),
+        ('horizontal_errors', illegal_horizontal_intervals, voices),
+        ('turnaround_errors', missed_leap_turnarounds, voices),
+        # find errors between pairs of voices.
+        # dissonances are allowed off the downbeat, as passing tones,
+        # neighbour tones and cambiatas.
+        (('strong_beat_dissonance_errors', 'weak_beat_dissonance_errors'),
+            illegal_third_species_dissonances, voice_combos),
+        (('parallel_errors', 'consecutive_parallel_errors', 'parallel_downbeat_errors'),
+            illegal_parallel_runs, voice_combos),
+        ('direct_motion_errors', illegal_direct_motion, voice_combos),
+        ('high_point_errors', coincident_maxima, voice_combos),
+        ('voice_crossing_errors', voice_crossing, voice_combos),
+    ]
+
+    error_dict, budget_exceeded = evaluate_rules(n, with_rulebook(rules, rulebook), max_errors, cache, only, only_keys)
+    error_dict['cantus_firmus'] = cantus_firmus
+    error_dict['budget_exceeded'] = budget_exceeded
+    return error_dict
+
+def fourth_species(composition, max_errors=None, cache=None, rulebook=None, only=None, only_keys=None):
+    """
+    Takes a mingus.containers.Composition object, an (optional) error
+    budget, an (optional) cache dict to reuse results from, across calls
+    (see evaluate_rules()), an (optional) rulebook (see rulebook.py), an
+    (optional) function to choose which errors to look for (see
+    select_rules()) and an (optional) function to choose which voices and
+    pairs of voices to look at (see evaluate_rules()).
+
+    Returns a dict of possible errors according to the rules of
+    Fourth Species counterpoint.
 
-def third_species(composition):
-    return {}
+    If max_errors is given, evaluation stops once more than max_errors errors
+    have been found, and the 'budget_exceeded' key of the returned dict is set.
+    """
+    n, high_voice, low_voice, inner_voices, voice_combos = \
+        get_and_split_voices(composition)
+    voices = list(n)
+
+    cantus_firmus = find_cantus_firmus(n)
+
+    # if we can't find the C.F. return right away.
+    if cantus_firmus == None:
+        return dict(
+            cantus_firmus = None
+        )
+
+    other_voices = [voice for voice in n if voice != cantus_firmus]
+
+    # rules are listed cheapest first.
+    rules = [
+        # find errors in specific voices
+        ('high_voice_beginning_error', starts_with_tonic_or_fifth, [high_voice]),
+        ('high_voice_ending_error', ends_with_lt_tonic, [high_voice]),
+        ('low_voice_beginning_error', starts_with_tonic, [low_voice]),
+        # find errors in each melody
+        ('accidental_errors', accidentals, voices),
+        ('broken_chain_errors', broken_suspension_chains, other_voices),
+        ('horizontal_errors', illegal_horizontal_intervals, voices),
+        ('turnaround_errors', missed_leap_turnarounds, voices),
+        # find errors between pairs of voices.
+        # dissonances are allowed on the downbeat, as prepared suspensions.
+        (('strong_beat_dissonance_errors', 'unprepared_suspension_errors', 'suspension_resolution_errors'),
+            illegal_fourth_species_suspensions, voice_combos),
+        (('parallel_errors', 'consecutive_parallel_errors', 'parallel_downbeat_errors'),
+            illegal_parallel_runs, voice_combos),
+        ('direct_motion_errors', illegal_direct_motion, voice_combos),
+        ('high_point_errors', coincident_maxima, voice_combos),
+        ('voice_crossing_errors', voice_crossing, voice_combos),
+    ]
 
-def fourth_species(composition):
-    return {}
+    error_dict, budget_exceeded = evaluate_rules(n, with_rulebook(rules, rulebook), max_errors, cache, only, only_keys)
+    error_dict['cantus_firmus'] = cantus_firmus
+    error_dict['budget_exceeded'] = budget_exceeded
+    return error_dict
 
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from bisect import bisect_right
+from UserDict import DictMixin
 from mingus.containers import Note, NoteContainer, Bar, Composition, Instrument, Track
 
 # Set up our vocal classes
@@ -22,9 +24,98 @@ class Bass(Instrument):
     range = (Note('E', 2), Note('E', 4))
     clef = 'bass'
 
+###
+# How strong each beat is, by meter. A bar is divided into its beats, two or
+# three at a time, and each beat is then halved (or divided in three, in
+# compound meters) down to a grid of metric_grid positions per whole note.
+# The strength of a position is how many divisions it takes to reach it: 0
+# for the downbeat, 1 for the weak beats that first divide the bar (beat 3
+# in 4/4, beats 2 and 3 in 3/4, the second dotted quarter in 6/8), and so
+# on. Positions off the grid are weaker than any on it.
+###
+
+# positions per whole note: enough for 256th notes, and for triplets.
+metric_grid = 768
+
+downbeat = 0
+weak_beat = 1
+
+# meter => list of the strength of each position in the bar
+beat_strength_tables = {}
+
+def metric_divisions(meter):
+    """
+    Takes a meter, as a tuple of (beats, beat unit).
+
+    Returns the list of numbers each level of the bar is divided by, from
+    the whole bar down to the smallest note.
+    """
+    beats, unit = meter
+    if beats % 3 == 0 and beats > 3:
+        # compound meters are counted in dotted beats, each three notes long.
+        beats /= 3
+        divisions_of_beat = [3]
+    else:
+        divisions_of_beat = []
+
+    divisions = []
+    while beats > 1:
+        for factor in (2, 3, beats):
+            if beats % factor == 0:
+                divisions.append(factor)
+                beats /= factor
+                break
+    return divisions + divisions_of_beat + [2] * 16
+
+def beat_strengths(meter):
+    """
+    Takes a meter, as a tuple of (beats, beat unit).
+
+    Returns a list of the strength of each of the positions in a bar of that
+    meter, metric_grid to a whole note. Each meter's list is only worked
+    out once.
+    """
+    meter = tuple(meter)
+    if meter not in beat_strength_tables:
+        length = metric_grid * meter[0] / meter[1]
+        weakest = None
+        table = [None] * length
+        step = length
+        for level, division in enumerate([1] + metric_divisions(meter)):
+            if step % division:
+                break
+            step /= division
+            for position in range(0, length, step):
+                if table[position] is None:
+                    table[position] = level
+            weakest = level + 1
+        beat_strength_tables[meter] = [weakest if s is None else s for s in table]
+    return beat_strength_tables[meter]
+
+def beat_strength(meter, beat):
+    """
+    Takes a meter and a beat, as a fraction of a whole note from the start of
+    the bar.
+
+    Returns how strong the beat is (see beat_strengths()): downbeat (0) for
+    the first beat of the bar, weak_beat (1) for the beats that first divide
+    the bar, and larger numbers for weaker beats.
+    """
+    return strength_in(beat_strengths(meter), beat)
+
+def strength_in(table, beat):
+    # the strength of a beat, from a meter's list of strengths.
+    position = beat * metric_grid
+    if position != int(position) or not 0 <= position < len(table):
+        return max(table) + 1
+    return table[int(position)]
+
 class NoteNode(Note):
     prev = None
     next = None
+    tie_run = None # list of consecutive NoteNodes of this pitch, if not a rest
+    pitch = None # int(self), worked out once, if not a rest
+    strength = None # how strong the beat the note starts on is (see beat_strength())
 
     bar = 0
     beat = 0
@@ -44,6 +135,7 @@ class NoteNode(Note):
             self.is_rest = False
             note = noteContainer[0]
             Note.__init__(self, note)
+            self.pitch = Note.__int__(self)
 
     def __repr__(self):
         name = Note.__repr__(self)
@@ -52,6 +144,12 @@ class NoteNode(Note):
     def __eq__(self, other):
         return self is other
 
+    def __int__(self):
+        # NoteNodes are never transposed, so the pitch can't go stale.
+        if self.pitch is None:
+            return Note.__int__(self)
+        return self.pitch
+
     @property
     def prev_actual_note(self):
         prev = self.prev
@@ -79,24 +177,45 @@ class NoteNode(Note):
         # when does this pitch end?
         # NB: this method treats all consecutive identical pitches as
         #     one long tied note.
-        cur = self
-        while cur.next is not None and int(cur.next) == int(self):
-            cur = cur.next
+        if self.tie_run is not None:
+            cur = self.tie_run[-1]
+        else:
+            cur = self
+            while cur.next is not None and int(cur.next) == int(self):
+                cur = cur.next
         end_beat = cur.beat + 1./cur.duration
         return (cur.bar, end_beat)
 
+    @property
+    def is_tied(self):
+        # is this note a continuation of the previous note's pitch?
+        return self.tie_run is not None and self.tie_run[0] is not self
+
 class NoteList(object):
     notes = None
     track = None
+    starts = None # (bar, beat) of each note, in the same order as notes
+    onsets = None # dict of (bar, beat) => first note starting then
+    tie_runs = None # lists of consecutive notes of the same pitch
+    memo = None # views of this voice, computed once (see views.memoize_view)
 
-    def __init__(self, track):
+    def __init__(self, track, first_bar=0, last_bar=None):
+        # only the bars from first_bar up to (not including) last_bar are
+        # read, but notes keep their bar numbers in the whole track.
         self.notes = []
+        self.starts = []
+        self.onsets = {}
+        self.tie_runs = []
+        self.memo = {}
         self.track = track
 
         bars = track.bars
-        for i in range(0, len(bars)):
+        if last_bar is None or last_bar > len(bars):
+            last_bar = len(bars)
+        for i in range(first_bar, last_bar):
             last_beat = 0.0
             bar = bars[i]
+            strengths = beat_strengths(bar.meter)
             for n in bar:
                 beat, duration, noteContainer = n
 
@@ -105,31 +224,81 @@ class NoteList(object):
                     # Insert a rest.
                     rest_duration = int(1./(beat - last_beat))
                     rest = NoteNode(None, i, last_beat, rest_duration)
+                    rest.strength = strength_in(strengths, last_beat)
                     self.append(rest)
 
                 note = NoteNode(noteContainer, i, beat, duration)
+                note.strength = strength_in(strengths, beat)
                 self.append(note)
                 last_beat = note.end[1]
 
 
     def append(self, note):
+        # anything computed from the old notes is out of date.
+        self.memo.clear()
+
         if len(self.notes):
             note.prev = self.notes[-1]
             self.notes[-1].next = note
         self.notes.append(note)
 
+        # consecutive notes of the same pitch are treated as one tied note.
+        if not note.is_rest:
+            prev = note.prev
+            if prev is not None and not prev.is_rest and int(prev) == int(note):
+                note.tie_run = prev.tie_run
+                note.tie_run.append(note)
+            else:
+                note.tie_run = [note]
+                self.tie_runs.append(note.tie_run)
+
+        self.starts.append(note.start)
+        if note.start not in self.onsets:
+            self.onsets[note.start] = note
+
     def get(self, bar, beat):
-        for note in self.notes:
-            if note.bar == bar and note.beat == beat:
-                return note
-        return None
+        return self.onsets.get((bar, beat))
+
+    def beat_strength(self, bar, beat):
+        # how strong a beat of this voice is, in the meter of its bar.
+        bars = self.track.bars
+        meter = bars[min(bar, len(bars) - 1)].meter
+        return beat_strength(meter, beat)
 
     def get_note_playing_at(self, bar, beat):
-        for n in self.notes:
-            if n.bar == bar and n.beat <= beat and n.end[1] > beat:
-                return n
+        # notes are in chronological order and never overlap, so the only
+        # note that can be playing is the last one to start by (bar, beat).
+        i = bisect_right(self.starts, (bar, beat))
+        if i == 0:
+            return None
+        n = self.notes[i-1]
+        if n.bar == bar and n.beat <= beat and n.end[1] > beat:
+            return n
         return None
 
+    def fingerprint(self):
+        # everything a rule can see of this voice: its key, its meter and
+        # its notes, with how strong a beat each starts on, in case the
+        # meter changes. Equal fingerprints give equal rule results.
+        if 'fingerprint' in self.memo:
+            return self.memo['fingerprint']
+        first_bar = self.track.bars[0]
+        self.memo['fingerprint'] = (
+            getattr(first_bar.key, 'name', first_bar.key),
+            tuple(first_bar.meter),
+            tuple([
+                (n.name, n.octave, n.bar, n.beat, n.duration, n.strength)
+                for n in self.notes
+            ])
+        )
+        return self.memo['fingerprint']
+
+    def forget_pair_views(self):
+        # drop the views memoized with other voices (see
+        # views.memoize_pair_view()), so they are freed now, rather than
+        # with the other voices, but keep the views of this voice alone.
+        self.memo.pop('pair views', None)
+
     def get_first_actual_note(self):
         # return the first non-rest note.
         note = self.notes[0]
@@ -146,9 +315,90 @@ class NoteList(object):
     def __len__(self):
         return len(self.notes)
 
+def composition_from_melodies(melodies, key='C', meter=(4, 4), author=''):
+    """
+    Takes a dict of melodies (key => voice name; value => list of
+    ("note name-octave number", duration) tuples, as in tracks.py), and an
+    (optional) key, meter and author.
+
+    Returns a mingus.containers.Composition object with a track for each
+    voice that has notes.
+
+    Raises ValueError if a note is too long for the bar it falls in, as a
+    whole note is in 3/4 or 6/8, since mingus would leave it out.
+    """
+    # Create a composition, and add the vocal tracks to it.
+    composition = Composition()
+    composition.set_title('Counterpoint Exercise', '')
+    composition.set_author(author, '')
+
+    for voice in [Soprano, Alto, Tenor, Bass]:
+        if len(melodies.get(voice.name, [])):
+            track = Track(instrument=voice())
+            track.add_bar(Bar(key=key, meter=meter))
+            track.name = voice.name
+            for i, note in enumerate(melodies[voice.name]):
+                if not track.add_notes(*note):
+                    raise ValueError('Note %d of the %s (%s, %s) does not fit in bar %d, in %d/%d' % (
+                        i + 1, voice.name, note[0], note[1], len(track.bars), meter[0], meter[1]))
+            composition.add_track(track)
+    return composition
+
+def track_has_notes(track):
+    # whether a track's NoteList would have any notes (or rests) in it,
+    # without building it.
+    for bar in track.bars:
+        if len(bar):
+            return True
+    return False
+
+class NoteLists(DictMixin):
+    """
+    A dict of NoteLists (key => track name; value => NoteList) for the
+    tracks of a composition. Each voice's NoteList is only built when it is
+    first looked up, and then kept, so voices that no rule looks at are
+    never built at all.
+    """
+    def __init__(self, tracks, built=None):
+        self.tracks = tracks # track name => track
+        self.built = built if built is not None else {} # track name => NoteList
+
+    def __getitem__(self, voice):
+        if voice not in self.built:
+            self.built[voice] = NoteList(self.tracks[voice])
+        return self.built[voice]
+
+    def keys(self):
+        return self.tracks.keys()
+
+    def __contains__(self, voice):
+        return voice in self.tracks
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def with_notes(self):
+        """
+        Returns a NoteLists of only the voices with notes in them, sharing
+        the NoteLists built so far, and from now on, with this one.
+        """
+        tracks = dict([
+            (voice, track) for voice, track in self.tracks.items()
+            if (len(self.built[voice]) if voice in self.built else track_has_notes(track))
+        ])
+        return NoteLists(tracks, self.built)
+
 def create_note_lists(composition):
-    lists = {}
-    for track in composition:
-        lists[track.name] = NoteList(track)
+    """
+    Takes a mingus.containers.Composition object.
 
-    return lists
+    Returns a dict of NoteLists (key => track name; value => NoteList), each
+    built when it is first looked up (see NoteLists).
+    """
+    tracks = {}
+    for track in composition:
+        tracks[track.name] = track
+    return NoteLists(tracks)
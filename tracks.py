@@ -60,7 +60,7 @@ melodies = {
 
 cantus_firmus = 'Bass' # one of 'Soprano', 'Alto', 'Tenor', 'Bass'
 key = 'C' # currently only major keys supported
-meter = (4, 4) # currently only 4/4 supported
+meter = (4, 4) # strong and weak beats follow the meter, but the cantus firmus is in whole notes, so a bar must hold one exactly, eg. (4, 4) or (2, 2)
 species = 1 # 1, 2, or 4
 author = 'Anthony Theocharis'
 
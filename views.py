@@ -3,22 +3,80 @@
 from mingus.core import intervals as mintervals
 from mingus.containers import Note
 from mingus.core.diatonic import get_notes
-from structures import create_note_lists
+from structures import create_note_lists, downbeat
 from views import *
+from functools import wraps
+from inspect import getargspec
+from weakref import WeakKeyDictionary
+
+def memoize_view(fn):
+    """
+    Decorates a view of a single voice, so that its result is computed once
+    per NoteList and kept in the NoteList's memo. The memo is cleared if
+    notes are appended. Callers must not modify the result.
+
+    Lists of NoteNodes that aren't NoteLists are not memoized. Arguments
+    left out are keyed by their defaults, so a call with and without them
+    shares one result.
+    """
+    names = getargspec(fn)[0][1:]
+    defaults = getargspec(fn)[3] or ()
+    @wraps(fn)
+    def view(a_list, *args):
+        memo = getattr(a_list, 'memo', None)
+        if memo is None:
+            return fn(a_list, *args)
+        key = (fn.__name__,) + args + defaults[len(defaults) - len(names) + len(args):]
+        if key not in memo:
+            memo[key] = fn(a_list, *args)
+        return memo[key]
+    return view
+
+def memoize_pair_view(fn):
+    """
+    Decorates a view of a pair of voices, so that its result is computed
+    once per pair of NoteLists and kept in the first NoteList's memo (see
+    NoteList.forget_pair_views()). Callers must not modify the result.
+
+    The memo only holds the second NoteList weakly, so when nothing else
+    holds it (like each of the candidates ranked against one cantus firmus)
+    it is freed, and its views with it.
+    """
+    @wraps(fn)
+    def view(a_list, b_list, *args):
+        memo = getattr(a_list, 'memo', None)
+        if memo is None or getattr(b_list, 'memo', None) is None:
+            return fn(a_list, b_list, *args)
+        if 'pair views' not in memo:
+            memo['pair views'] = WeakKeyDictionary() # NoteList => views
+        pair_memo = memo['pair views'].setdefault(b_list, {})
+        key = (fn.__name__,) + args
+        if key not in pair_memo:
+            pair_memo[key] = fn(a_list, b_list, *args)
+        return pair_memo[key]
+    return view
+
+# (name, octave, name, octave) => interval, for every pair of pitches seen.
+interval_cache = {}
 
 def get_interval(note_a, note_b):
     """
     Takes two NoteNode objects.
     Returns a tuple of the form:
         (str: interval name, int: octaves between)
+
+    The interval between two pitches never changes, so each one is only
+    worked out by mingus once.
     """
     if note_a.is_rest or note_b.is_rest:
-        name = ' '
-        octave = 0
-    else:
+        return (' ', 0)
+
+    key = (note_a.name, note_a.octave, note_b.name, note_b.octave)
+    if key not in interval_cache:
         name = mintervals.determine(note_a, note_b, True)
         octave = abs(int(note_a) - int(note_b))/12
-    return (name, octave)
+        interval_cache[key] = (name, octave)
+    return interval_cache[key]
 
 def get_semitones(interval_tuplet):
     """
@@ -43,6 +101,7 @@ def compare_times(time_a, time_b):
     else:
         return cmp(time_a[1], time_b[1])
 
+@memoize_pair_view
 def note_onsets(a_list, b_list):
     """
     Takes two lists of NoteNode objects. These may be NoteList objects.
@@ -52,12 +111,15 @@ def note_onsets(a_list, b_list):
     a_list, b_list, or both.
     """
     changes = []
+    seen = set()
     for l in [a_list, b_list]:
         for note in l:
-            if note.start not in changes:
+            if note.start not in seen:
+                seen.add(note.start)
                 changes.append(note.start)
     return changes
 
+@memoize_pair_view
 def vertical_intervals(a_list, b_list):
     """
     Takes two NoteList objects.
@@ -82,6 +144,46 @@ def vertical_intervals(a_list, b_list):
 
     return zip(intervals, changes)
 
+def iter_vertical_intervals(a_list, b_list):
+    """
+    Takes two NoteList objects.
+
+    Yields tuples of the form returned by vertical_intervals(), one for each
+    note onset in either list, in chronological order.
+
+    Both lists are walked once, side by side, so this takes linear time and
+    holds only the current note of each voice in memory.
+    """
+    def playing(note, bar, beat):
+        if note is not None and note.bar == bar \
+                and note.beat <= beat and note.end[1] > beat:
+            return note
+        return None
+
+    a_iter = iter(a_list)
+    b_iter = iter(b_list)
+    a_next = next(a_iter, None)
+    b_next = next(b_iter, None)
+    a_note = b_note = None
+
+    while a_next is not None or b_next is not None:
+        if b_next is None or (a_next is not None and a_next.start <= b_next.start):
+            time = a_next.start
+        else:
+            time = b_next.start
+
+        if a_next is not None and a_next.start == time:
+            a_note = a_next
+            a_next = next(a_iter, None)
+        if b_next is not None and b_next.start == time:
+            b_note = b_next
+            b_next = next(b_iter, None)
+
+        bar, beat = time
+        interval = get_interval(playing(a_note, bar, beat), playing(b_note, bar, beat))
+        yield (interval, time)
+
+@memoize_view
 def directions(a_list):
     """
     Takes a NoteList object and a list of (bar, beat) tuples of the form
@@ -148,6 +250,96 @@ def combined_directions(a_list, b_list):
         for time in onsets
     ]
 
+@memoize_view
+def melodic_contour(a_list, largest_leap_without_turnaround=6, largest_step=2):
+    """
+    Takes a NoteList object and two (optional) ints, in semitones.
+
+    Walks the melody once, and returns a tuple:
+    (
+        list of extremities,
+        list of leaps
+    )
+
+    Each extremity is a tuple of the form:
+    (
+        int: 1 for a local maximum, -1 for a local minimum,
+        NoteNode: the note at the extremity
+    )
+    Extremities are in chronological order, and maxima and minima alternate.
+
+    Each leap is a tuple of the form:
+    (
+        (str: interval name, int: octaves between),
+        NoteNode: the note leaped from,
+        NoteNode: the note leaped to,
+        bool: True if the melody next moves by step in the opposite direction
+    )
+    A leap is any interval larger than largest_leap_without_turnaround.
+    Repeated notes after a leap are skipped when looking for the turnaround.
+    """
+    extremities = []
+    leaps = []
+
+    # state of the search for maxima and for minima, respectively:
+    # direction and note of the last note considered.
+    searches = {1: [0, None], -1: [0, None]}
+    first_note = None
+    dir = 0
+    pending_leap = None
+
+    for note in a_list:
+        prev = note.prev_actual_note
+        if note.is_rest or prev is None:
+            dir = 0
+        else:
+            dir = cmp(int(note), int(prev))
+
+        if dir != 0 and first_note is None:
+            # The melody starts on a high/low note.
+            # If the melody starts with a rest, just looking at the directions
+            # will imply that the rest is an extremity, so we must find the
+            # first non-rest note in the melody.
+            first_note = a_list.get_first_actual_note()
+            if first_note is not None:
+                extremities.append((-dir, first_note))
+
+        for extremity_dir, search in searches.items():
+            prev_d, prev_note = search
+            if prev_d == extremity_dir:
+                if dir == 0:
+                    continue
+                if dir == -extremity_dir:
+                    extremities.append((extremity_dir, prev_note))
+            search[0] = dir
+            search[1] = note
+
+        if note.is_rest or prev is None:
+            continue
+
+        interval = get_interval(prev, note)
+        semitones = get_semitones(interval)
+        if pending_leap is not None and semitones != 0:
+            # the first movement after a leap must be a step in the
+            # opposite direction.
+            leap_interval, leap_from, leap_to, leap_dir = pending_leap
+            turned_around = dir == -leap_dir and semitones <= largest_step
+            leaps.append((leap_interval, leap_from, leap_to, turned_around))
+            pending_leap = None
+        if semitones > largest_leap_without_turnaround:
+            pending_leap = (interval, prev, note, dir)
+
+    # ended on a high/low note
+    if dir != 0:
+        extremities.append((dir, note))
+
+    # a leap at the very end of the melody is never turned around.
+    if pending_leap is not None:
+        leap_interval, leap_from, leap_to, leap_dir = pending_leap
+        leaps.append((leap_interval, leap_from, leap_to, False))
+
+    return extremities, leaps
+
 def local_extremities(a_list, maxima=True):
     """
     Takes a NoteList object and an (optional) Boolean.
@@ -165,39 +357,8 @@ def local_extremities(a_list, maxima=True):
         # if finding minima
         extremity_dir = -1
 
-    dirs = directions(a_list)
-    extremities = []
-
-    # started on a high/low note?
-    for cur, time in dirs:
-        if cur == 0:
-            continue
-        elif cur == -extremity_dir:
-            # This is a bit tricky.
-            # If the melody starts with a rest, just looking at the directions
-            # will imply that the rest is a minimum, so we must find the first
-            # non-rest note in the melody. That will be our minimum.
-            note = a_list.get_first_actual_note()
-            if note is not None:
-                extremities.append((note.bar, note.beat))
-        break
-
-    prev_d = 0
-    prev_t = ()
-    for dir, time in dirs:
-        if prev_d == extremity_dir:
-            if dir == 0:
-                continue
-            if dir == -extremity_dir:
-                extremities.append(prev_t)
-        prev_d = dir
-        prev_t = time
-
-    # ended on a high/low note
-    if dir == extremity_dir:
-        extremities.append(time)
-
-    return extremities
+    extremities, leaps = melodic_contour(a_list)
+    return [note.start for dir, note in extremities if dir == extremity_dir]
 
 def local_minima(a_list):
     """
@@ -219,6 +380,7 @@ def local_maxima(a_list):
     """
     return local_extremities(a_list, maxima=True)
 
+@memoize_view
 def horizontal_intervals(a_list):
     """
     Takes a single NoteList object.
@@ -248,27 +410,18 @@ def indirect_horizontal_intervals(a_list):
         (int: bar #, float: beat #)
     )
     """
-    # Get the extremities lists
-    maxima = local_maxima(a_list)
-    minima = local_minima(a_list)
-    # Combine the lists into one ordered list.
-    # We don't care if each individual onset is a maximum or a minimum, but we
+    # Get the extremities, in order.
+    # We don't care if each individual note is a maximum or a minimum, but we
     # can be assured that no two consecutive extremities will be of the same
     # type, as maxima and minima must alternate.
-    extremities = maxima + minima
-    extremities.sort(compare_times)
+    extremities, leaps = melodic_contour(a_list)
+    notes = [note for dir, note in extremities]
 
     # Generate tuples for all neighbouring maxima/minima
-    onset_pairs = [
-        (extremities[i], extremities[i+1])
-        for i,x in enumerate(extremities)
-        if (i+1) < len(extremities)
-    ]
-
-    # Find the actual note objects for each pair of onsets
     note_pairs = [
-        (a_list.get(*x), a_list.get(*b))
-        for a, b in onset_pairs
+        (notes[i], notes[i+1])
+        for i,x in enumerate(notes)
+        if (i+1) < len(notes)
     ]
 
     # Find the interval between the notes for each tuple
@@ -281,6 +434,51 @@ def indirect_horizontal_intervals(a_list):
 
     return intervals
 
+def non_harmonic_tone(note):
+    """
+    Takes a single NoteNode object.
+
+    Returns a string describing how the note is approached and left:
+        'passing'   approached and left by step in the same direction
+        'neighbour' approached and left by step in opposite directions
+        'cambiata'  approached by step down, left by a leap of a third down,
+                    after which the melody moves up by step
+    Returns None if the note is none of these.
+
+    Only the neighbouring notes are looked at, so this takes constant time.
+    """
+    def motion(a, b):
+        # (direction, semitones) from a to b
+        return cmp(int(b), int(a)), get_semitones(get_interval(a, b))
+
+    def is_step(m):
+        return m[0] != 0 and m[1] <= 2
+
+    if note is None or note.is_rest:
+        return None
+    prev = note.prev_actual_note
+    next = note.next_actual_note
+    if prev is None or next is None:
+        return None
+
+    approach = motion(prev, note)
+    departure = motion(note, next)
+
+    if is_step(approach) and is_step(departure):
+        if approach[0] == departure[0]:
+            return 'passing'
+        return 'neighbour'
+
+    if is_step(approach) and approach[0] == -1 \
+            and departure[0] == -1 and departure[1] in [3, 4]:
+        after = next.next_actual_note
+        if after is not None:
+            resolution = motion(next, after)
+            if is_step(resolution) and resolution[0] == 1:
+                return 'cambiata'
+
+    return None
+
 def strong_beat_horizontal_intervals(a_list):
     """
     Takes a single NoteList object.
@@ -293,7 +491,7 @@ def strong_beat_horizontal_intervals(a_list):
     )
     For each pair of NoteNodes (a, b) that are on conse cutive downbeats.
     """
-    strong_beat_notes = sbn = [x for x in a_list if x.start[1] == 0]
+    strong_beat_notes = sbn = [x for x in a_list if x.strength == downbeat]
 
     strong_beat_pairs = [
         (sbn[i], sbn[i+1])
@@ -340,6 +538,45 @@ def parallel_motion(a_list, b_list, filter_fn=None):
 
     return consecutives
 
+def parallel_runs(a_list, b_list):
+    """
+    Takes two NoteList objects.
+
+    Yields a tuple for each run of two or more consecutive identical
+    intervals, of the form:
+    (
+        bool: True if the run only considers downbeats,
+        list of tuples of the form returned by vertical_intervals()
+    )
+
+    Two runs are tracked at once: one over every note onset (as in
+    parallel_motion()), and one over downbeats only. The intervals between
+    the voices are consumed once, in chronological order, so only the
+    current run of each kind is held in memory.
+    """
+    run = []
+    downbeat_run = []
+
+    for cur in iter_vertical_intervals(a_list, b_list):
+        # cur of form ((interval, octaves), (bar, beat))
+        if run and cur[0] != run[-1][0]:
+            if len(run) > 1:
+                yield (False, run)
+            run = []
+        run.append(cur)
+
+        if a_list.beat_strength(*cur[1]) == downbeat:
+            if downbeat_run and cur[0] != downbeat_run[-1][0]:
+                if len(downbeat_run) > 1:
+                    yield (True, downbeat_run)
+                downbeat_run = []
+            downbeat_run.append(cur)
+
+    if len(run) > 1:
+        yield (False, run)
+    if len(downbeat_run) > 1:
+        yield (True, downbeat_run)
+
 def direct_motion(a_list, b_list):
     """
     Takes two NoteList objects.